@@ -0,0 +1,290 @@
+import threading
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from common.constants import CANDLE_INTERVAL_1M, CANDLE_INTERVALS
+from .models import Candle
+
+CACHE_KEY_CANDLE_VERSION = "analytics:candle_version:{symbol}"
+HIGHER_INTERVALS = [(name, secs) for name, secs in CANDLE_INTERVALS.items() if name != CANDLE_INTERVAL_1M]
+CANDLE_FIELDS = ["open", "high", "low", "close", "volume", "quote_volume", "trade_count"]
+# Same cap as upstream klines.
+KLINES_MAX_LIMIT = 1000
+
+
+class OpenCandle:
+    """A candle still being built. `open_time` is in epoch seconds."""
+
+    __slots__ = ("open_time", "open", "high", "low", "close", "volume", "quote_volume", "trade_count")
+
+    def __init__(self, open_time: int, price):
+        self.open_time = open_time
+        self.open = self.high = self.low = self.close = price
+        self.volume = Decimal("0")
+        self.quote_volume = Decimal("0")
+        self.trade_count = 0
+
+    def add(self, price, amount) -> None:
+        self.high = max(self.high, price)
+        self.low = min(self.low, price)
+        self.close = price
+        self.volume += amount
+        self.quote_volume += price * amount
+        self.trade_count += 1
+
+    def merge(self, other: "OpenCandle") -> None:
+        """Fold in a later candle of a shorter interval."""
+        self.high = max(self.high, other.high)
+        self.low = min(self.low, other.low)
+        self.close = other.close
+        self.volume += other.volume
+        self.quote_volume += other.quote_volume
+        self.trade_count += other.trade_count
+
+    @classmethod
+    def starting_with(cls, open_time: int, other: "OpenCandle") -> "OpenCandle":
+        candle = cls(open_time, other.open)
+        candle.merge(other)
+        return candle
+
+    @classmethod
+    def from_model(cls, row: Candle) -> "OpenCandle":
+        candle = cls(int(row.open_time.timestamp()), row.open)
+        for field in CANDLE_FIELDS:
+            setattr(candle, field, getattr(row, field))
+        return candle
+
+    def to_model(self, market_symbol: str, interval: str) -> Candle:
+        return Candle(
+            market_symbol=market_symbol,
+            interval=interval,
+            open_time=datetime.fromtimestamp(self.open_time, dt_timezone.utc),
+            **{field: getattr(self, field) for field in CANDLE_FIELDS},
+        )
+
+
+class CandleSeries:
+    """Open candles of every interval for one market.
+
+    Trades only touch the open 1m candle. When it closes it is folded into the
+    open candle of each longer interval, closing those as their bucket ends,
+    so the longer intervals are built from 1m candles rather than from trades.
+    """
+
+    def __init__(self, market_symbol: str, version: int):
+        self.market_symbol = market_symbol
+        self.version = version
+        self.minute = None
+        self.open = {name: None for name, _ in HIGHER_INTERVALS}
+        self.closed = []
+        self.lock = threading.Lock()
+
+    def add_trade(self, ts: int, price, amount) -> None:
+        minute = ts - ts % 60
+        if self.minute is None or minute > self.minute.open_time:
+            if self.minute is not None:
+                self.close_minute(self.minute)
+            self.minute = OpenCandle(minute, price)
+            self.roll(minute)
+        # A trade stamped before the open minute (late commit) lands in it.
+        self.minute.add(price, amount)
+
+    def close_minute(self, candle: OpenCandle, persist: bool = True) -> None:
+        if persist:
+            self.closed.append((CANDLE_INTERVAL_1M, candle))
+        for name, secs in HIGHER_INTERVALS:
+            bucket = candle.open_time - candle.open_time % secs
+            current = self.open[name]
+            if current is None or bucket > current.open_time:
+                if current is not None:
+                    self.closed.append((name, current))
+                self.open[name] = OpenCandle.starting_with(bucket, candle)
+            else:
+                current.merge(candle)
+
+    def roll(self, minute: int) -> None:
+        """Close longer candles whose bucket ended before `minute` began."""
+        for name, secs in HIGHER_INTERVALS:
+            current = self.open[name]
+            if current is not None and minute - minute % secs > current.open_time:
+                self.closed.append((name, current))
+                self.open[name] = None
+
+    def live_candle(self, interval: str):
+        """The in-progress candle of `interval`, or None if there is none in memory."""
+        if interval == CANDLE_INTERVAL_1M:
+            return self.minute
+        current = self.open[interval]
+        if self.minute is None:
+            return current
+        if current is None:
+            secs = CANDLE_INTERVALS[interval]
+            return OpenCandle.starting_with(self.minute.open_time - self.minute.open_time % secs, self.minute)
+        merged = OpenCandle.starting_with(current.open_time, current)
+        merged.merge(self.minute)
+        return merged
+
+    def take_closed(self) -> list:
+        """`(interval, candle)` pairs closed since the last call, in closing order."""
+        closed, self.closed = self.closed, []
+        return closed
+
+
+def persist_closed(market_symbol: str, closed: list) -> None:
+    persist_candles([candle.to_model(market_symbol, interval) for interval, candle in closed])
+
+
+def persist_candles(candles: list) -> None:
+    if candles:
+        Candle.objects.bulk_create(
+            candles,
+            update_conflicts=True,
+            unique_fields=["market_symbol", "interval", "open_time"],
+            update_fields=CANDLE_FIELDS,
+        )
+
+
+_series = {}
+_series_lock = threading.Lock()
+
+
+def _shared_version(market_symbol: str) -> int:
+    return cache.get(CACHE_KEY_CANDLE_VERSION.format(symbol=market_symbol)) or 0
+
+
+def _bump_shared_version(market_symbol: str) -> int:
+    key = CACHE_KEY_CANDLE_VERSION.format(symbol=market_symbol)
+    cache.add(key, 0, None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+        return 1
+
+
+def load_series(market_symbol: str, version: int) -> CandleSeries:
+    """Rebuild open candles from today's stored 1m candles and trades not yet in one.
+
+    A 1m candle is stored when the next trade closes it, so the trades after
+    the last stored one are normally those of the minute still open. They are
+    read from the trade table rather than a stored in-progress candle because
+    another worker may be adding to that minute: committed trades are the only
+    record that holds all of it.
+    """
+    from apps.trading.models import Trade
+
+    series = CandleSeries(market_symbol, version)
+    now = int(timezone.now().timestamp())
+    day_start = datetime.fromtimestamp(now - now % CANDLE_INTERVALS["1d"], dt_timezone.utc)
+    since = day_start
+    stored = Candle.objects.filter(market_symbol=market_symbol, interval=CANDLE_INTERVAL_1M, open_time__gte=day_start)
+    for row in stored.order_by("open_time"):
+        series.close_minute(OpenCandle.from_model(row), persist=False)
+        since = row.open_time + timezone.timedelta(minutes=1)
+    trades = (
+        Trade.objects.filter(market_symbol=market_symbol, created_at__gte=since)
+        .order_by("created_at", "id")
+        .values_list("created_at", "price", "amount")
+    )
+    for created_at, price, amount in trades.iterator():
+        series.add_trade(int(created_at.timestamp()), price, amount)
+    # Longer candles that closed during the rebuild may never have been written.
+    persist_closed(market_symbol, series.take_closed())
+    return series
+
+
+def get_series(market_symbol: str) -> CandleSeries:
+    series = _series.get(market_symbol)
+    version = _shared_version(market_symbol)
+    if series is None or series.version != version:
+        series = load_series(market_symbol, version)
+        with _series_lock:
+            _series[market_symbol] = series
+    return series
+
+
+def discard_series(market_symbol: str | None = None) -> None:
+    with _series_lock:
+        if market_symbol is None:
+            _series.clear()
+        else:
+            _series.pop(market_symbol, None)
+
+
+def record_candle_trades(market_symbol: str, trades) -> None:
+    """Fold committed `(created_at, price, amount)` trades in and write candles that closed."""
+    version = _bump_shared_version(market_symbol)
+    series = _series.get(market_symbol)
+    if series is not None and series.version + 1 == version:
+        with series.lock:
+            for created_at, price, amount in trades:
+                series.add_trade(int(created_at.timestamp()), price, amount)
+            series.version = version
+            closed = series.take_closed()
+            live = [(interval, series.live_candle(interval)) for interval in CANDLE_INTERVALS]
+        persist_closed(market_symbol, closed)
+        publish_klines(market_symbol, closed, live)
+        return
+    # Cold, or trades recorded elsewhere in between: the batch has committed,
+    # so a rebuild from the database already contains it.
+    series = load_series(market_symbol, version)
+    with _series_lock:
+        _series[market_symbol] = series
+    with series.lock:
+        live = [(interval, series.live_candle(interval)) for interval in CANDLE_INTERVALS]
+    publish_klines(market_symbol, [], live)
+
+
+def publish_klines(market_symbol: str, closed: list, live: list) -> None:
+    """Final messages for candles that closed, then the in-progress candle of each interval."""
+    from apps.realtime.services import broadcast_kline
+
+    for interval, candle in closed:
+        broadcast_kline(market_symbol, interval, _kline(candle, interval), closed=True)
+    for interval, candle in live:
+        if candle is not None:
+            broadcast_kline(market_symbol, interval, _kline(candle, interval), closed=False)
+
+
+def get_live_kline(market_symbol: str, interval: str):
+    series = get_series(market_symbol)
+    with series.lock:
+        candle = series.live_candle(interval)
+    return _kline(candle, interval) if candle is not None else None
+
+
+def _kline(candle, interval: str) -> list:
+    """Binance kline layout."""
+    open_ms = candle.open_time * 1000
+    return [
+        open_ms,
+        f"{candle.open:.8f}",
+        f"{candle.high:.8f}",
+        f"{candle.low:.8f}",
+        f"{candle.close:.8f}",
+        f"{candle.volume:.8f}",
+        open_ms + CANDLE_INTERVALS[interval] * 1000 - 1,
+        f"{candle.quote_volume:.8f}",
+        candle.trade_count,
+        "0",
+        "0",
+        "0",
+    ]
+
+
+def get_internal_klines(market_symbol: str, interval: str, limit: int = 500) -> list:
+    """The latest `limit` candles of one of CANDLE_INTERVALS, oldest first."""
+    limit = max(1, min(limit, KLINES_MAX_LIMIT))
+    series = get_series(market_symbol)
+    with series.lock:
+        live = series.live_candle(interval)
+    stored = Candle.objects.filter(market_symbol=market_symbol, interval=interval).order_by("-open_time")[:limit]
+    by_time = {}
+    for candle in map(OpenCandle.from_model, stored):
+        by_time[candle.open_time] = candle
+    if live is not None:
+        by_time[live.open_time] = live
+    return [_kline(by_time[t], interval) for t in sorted(by_time)[-limit:]]
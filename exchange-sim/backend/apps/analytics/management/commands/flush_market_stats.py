@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from apps.analytics.rolling_stats import minute_of, shared_version, write_market_stats
+from apps.markets.registry import active_markets
+
+
+class Command(BaseCommand):
+    help = (
+        "Keep MarketStats rows current: rewrite a market's 24h stats when it has traded "
+        "since the last pass, and every market once a minute as old trades leave the window"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=5.0, help="Seconds between passes")
+        parser.add_argument("--once", action="store_true", help="Write every market once and exit")
+
+    def handle(self, *args, **options):
+        written = {}
+        while True:
+            close_old_connections()
+            minute = minute_of(timezone.now())
+            count = 0
+            for market in active_markets():
+                state = (shared_version(market.symbol), minute)
+                if written.get(market.symbol) == state:
+                    continue
+                if write_market_stats(market.symbol, state[0]):
+                    count += 1
+                written[market.symbol] = state
+            if options["once"]:
+                self.stdout.write(self.style.SUCCESS(f"Wrote stats for {count} markets"))
+                return
+            time.sleep(options["interval"])
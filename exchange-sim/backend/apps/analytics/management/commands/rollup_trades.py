@@ -0,0 +1,42 @@
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.analytics.services import rollup_trades
+from apps.trading.models import Trade
+
+
+class Command(BaseCommand):
+    help = "Roll trades past the retention horizon into 1m candles and delete them, one UTC day at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retention-days",
+            type=int,
+            default=None,
+            help="Days of raw trades to keep (default TRADE_RETENTION_DAYS)",
+        )
+
+    def handle(self, *args, **options):
+        days = options["retention_days"]
+        if days is None:
+            days = getattr(settings, "TRADE_RETENTION_DAYS", 30)
+        horizon = timezone.now() - timedelta(days=days)
+        horizon = datetime.combine(horizon.date(), dt_time.min, tzinfo=dt_timezone.utc)
+
+        oldest = Trade.objects.order_by("created_at").values_list("created_at", flat=True).first()
+        if oldest is None or oldest >= horizon:
+            self.stdout.write("Nothing to roll up")
+            return
+        day = datetime.combine(oldest.astimezone(dt_timezone.utc).date(), dt_time.min, tzinfo=dt_timezone.utc)
+        total_candles = total_trades = 0
+        while day < horizon:
+            candles, trades = rollup_trades(day, day + timedelta(days=1))
+            if trades:
+                self.stdout.write(f"{day.date()}: {trades} trades -> {candles} candles")
+            total_candles += candles
+            total_trades += trades
+            day += timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(f"Rolled {total_trades} trades into {total_candles} candles"))
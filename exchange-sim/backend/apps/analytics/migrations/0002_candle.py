@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:52
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Candle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('market_symbol', models.CharField(max_length=20)),
+                ('interval', models.CharField(max_length=4)),
+                ('open_time', models.DateTimeField()),
+                ('open', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('high', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('low', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('close', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('volume', models.DecimalField(decimal_places=8, default=Decimal('0'), max_digits=28)),
+                ('quote_volume', models.DecimalField(decimal_places=8, default=Decimal('0'), max_digits=28)),
+                ('trade_count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['open_time'],
+                'constraints': [models.UniqueConstraint(fields=('market_symbol', 'interval', 'open_time'), name='analytics_candle_unique')],
+            },
+        ),
+    ]
@@ -10,3 +10,24 @@ class MarketStats(models.Model):
     low_24h = models.DecimalField(max_digits=28, decimal_places=8, default=Decimal("0"))
     trades_24h = models.PositiveIntegerField(default=0)
     updated_at = models.DateTimeField(auto_now=True)
+
+
+class Candle(models.Model):
+    """OHLCV summary of a market's trades over one interval starting at `open_time`."""
+
+    market_symbol = models.CharField(max_length=20)
+    interval = models.CharField(max_length=4)
+    open_time = models.DateTimeField()
+    open = models.DecimalField(max_digits=28, decimal_places=8)
+    high = models.DecimalField(max_digits=28, decimal_places=8)
+    low = models.DecimalField(max_digits=28, decimal_places=8)
+    close = models.DecimalField(max_digits=28, decimal_places=8)
+    volume = models.DecimalField(max_digits=28, decimal_places=8, default=Decimal("0"))
+    quote_volume = models.DecimalField(max_digits=28, decimal_places=8, default=Decimal("0"))
+    trade_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["market_symbol", "interval", "open_time"], name="analytics_candle_unique"),
+        ]
+        ordering = ["open_time"]
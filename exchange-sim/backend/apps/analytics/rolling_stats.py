@@ -0,0 +1,256 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Max, Min, Sum
+from django.db.models.functions import TruncMinute
+from django.utils import timezone
+
+from common.money import FIXED_ZERO, Fixed
+
+logger = logging.getLogger(__name__)
+
+WINDOW_MINUTES = 1440
+CACHE_KEY_STATS_VERSION = "analytics:stats_version:{symbol}"
+
+
+def minute_of(ts) -> int:
+    return int(ts.timestamp()) // 60
+
+
+class MinuteBucket:
+    __slots__ = ("minute", "volume", "high", "low", "count")
+
+    def __init__(self, minute: int, high, low):
+        self.minute = minute
+        self.volume = FIXED_ZERO
+        self.high = high
+        self.low = low
+        self.count = 0
+
+
+class RollingStats:
+    """24h stats for one market from 1440 one-minute buckets in a ring.
+
+    Totals are adjusted as buckets enter and leave the window, and high/low
+    come from monotonic deques of bucket extremes, so recording a trade and
+    expiring old minutes are both O(1) amortized.
+    """
+
+    def __init__(self, market_symbol: str, version: int):
+        self.market_symbol = market_symbol
+        self.version = version
+        self.ring = [None] * WINDOW_MINUTES
+        self.volume = FIXED_ZERO
+        self.count = 0
+        self.highs = deque()
+        self.lows = deque()
+        self.newest = None
+        self.last_price = None
+
+    def advance(self, minute: int) -> None:
+        """Expire buckets that fell out of the window ending at `minute`."""
+        if self.newest is not None and minute <= self.newest:
+            return
+        oldest_kept = minute - WINDOW_MINUTES + 1
+        if self.newest is None or minute - self.newest >= WINDOW_MINUTES:
+            # Nothing in the ring survives; skip walking empty minutes.
+            self.ring = [None] * WINDOW_MINUTES
+            self.volume = FIXED_ZERO
+            self.count = 0
+        else:
+            for m in range(self.newest - WINDOW_MINUTES + 1, oldest_kept):
+                bucket = self.ring[m % WINDOW_MINUTES]
+                if bucket is not None and bucket.minute == m:
+                    self.volume -= bucket.volume
+                    self.count -= bucket.count
+                    self.ring[m % WINDOW_MINUTES] = None
+        while self.highs and self.highs[0][0] < oldest_kept:
+            self.highs.popleft()
+        while self.lows and self.lows[0][0] < oldest_kept:
+            self.lows.popleft()
+        self.newest = minute
+
+    def add_bucket(self, minute: int, volume: Fixed, count: int, high, low) -> None:
+        """Fold trades of `minute` in; a minute older than the newest seen counts as the newest."""
+        if self.newest is not None:
+            minute = max(minute, self.newest)
+        self.advance(minute)
+        slot = minute % WINDOW_MINUTES
+        bucket = self.ring[slot]
+        if bucket is None or bucket.minute != minute:
+            bucket = self.ring[slot] = MinuteBucket(minute, high, low)
+        bucket.volume += volume
+        bucket.count += count
+        bucket.high = max(bucket.high, high)
+        bucket.low = min(bucket.low, low)
+        self.volume += volume
+        self.count += count
+        while self.highs and self.highs[-1][1] <= bucket.high:
+            self.highs.pop()
+        self.highs.append((minute, bucket.high))
+        while self.lows and self.lows[-1][1] >= bucket.low:
+            self.lows.pop()
+        self.lows.append((minute, bucket.low))
+
+    def add_trade(self, minute: int, price, amount) -> None:
+        volume = Fixed.from_decimal(price) * Fixed.from_decimal(amount)
+        self.add_bucket(minute, volume, 1, price, price)
+        self.last_price = price
+
+    @property
+    def high(self):
+        return self.highs[0][1] if self.highs else None
+
+    @property
+    def low(self):
+        return self.lows[0][1] if self.lows else None
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+_dirty = set()
+_last_flush = 0.0
+
+
+def _bump_shared_version(market_symbol: str) -> int:
+    key = CACHE_KEY_STATS_VERSION.format(symbol=market_symbol)
+    cache.add(key, 0, None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+        return 1
+
+
+def shared_version(market_symbol: str) -> int:
+    return cache.get(CACHE_KEY_STATS_VERSION.format(symbol=market_symbol), 0)
+
+
+def load_rolling_stats(market_symbol: str, version: int) -> RollingStats:
+    """Rebuild a market's window from per-minute aggregates of stored trades."""
+    from apps.trading.models import Trade
+
+    stats = RollingStats(market_symbol, version)
+    since = timezone.now() - timezone.timedelta(minutes=WINDOW_MINUTES - 1)
+    rows = (
+        Trade.objects.filter(market_symbol=market_symbol, created_at__gte=since.replace(second=0, microsecond=0))
+        .annotate(minute=TruncMinute("created_at"))
+        .values("minute")
+        .annotate(volume=Sum(F("price") * F("amount")), high=Max("price"), low=Min("price"), count=Count("id"))
+        .order_by("minute")
+    )
+    for row in rows:
+        stats.add_bucket(minute_of(row["minute"]), Fixed.from_decimal(row["volume"]), row["count"], row["high"], row["low"])
+    stats.advance(minute_of(timezone.now()))
+    last = Trade.objects.filter(market_symbol=market_symbol).order_by("-created_at", "-id").values_list("price", flat=True).first()
+    stats.last_price = last
+    return stats
+
+
+def record_trades(market_symbol: str, trades) -> None:
+    """Fold committed `(created_at, price, amount)` trades into the market's window.
+
+    Each batch bumps a shared counter; a process that sees it jump by more than
+    one missed another process's trades and reloads from the database.
+    """
+    version = _bump_shared_version(market_symbol)
+    with _stats_lock:
+        stats = _stats.get(market_symbol)
+        current = stats is not None and stats.version + 1 == version
+        if current:
+            for created_at, price, amount in trades:
+                stats.add_trade(minute_of(created_at), price, amount)
+            stats.version = version
+            _dirty.add(market_symbol)
+    if not current:
+        # The trades have committed, so the reload already includes them.
+        stats = load_rolling_stats(market_symbol, version)
+        with _stats_lock:
+            _stats[market_symbol] = stats
+            _dirty.add(market_symbol)
+    maybe_flush()
+
+
+def discard_rolling_stats(market_symbol: str | None = None) -> None:
+    with _stats_lock:
+        if market_symbol is None:
+            _stats.clear()
+            _dirty.clear()
+        else:
+            _stats.pop(market_symbol, None)
+            _dirty.discard(market_symbol)
+
+
+def _row_values(stats: RollingStats) -> dict:
+    return {
+        "last_price": stats.last_price,
+        "volume_24h_quote": stats.volume.to_decimal(),
+        "high_24h": stats.high if stats.high is not None else stats.last_price,
+        "low_24h": stats.low if stats.low is not None else stats.last_price,
+        "trades_24h": stats.count,
+    }
+
+
+def write_market_stats(market_symbol: str, version: int) -> bool:
+    """Rebuild a market's window from the database and write its row.
+
+    For processes that do not record the trades themselves. Returns False for
+    a market without trades, which has no row to write.
+    """
+    from .models import MarketStats
+
+    stats = load_rolling_stats(market_symbol, version)
+    if stats.last_price is None:
+        return False
+    MarketStats.objects.update_or_create(market_symbol=market_symbol, defaults=_row_values(stats))
+    return True
+
+
+def maybe_flush() -> None:
+    """Flush dirty markets if the flush interval has passed since the last one.
+
+    Runs on the thread that committed the trades, so rows are never written
+    concurrently with another transaction from this process. Markets left
+    dirty are written by the next trade's flush, or by `manage.py
+    flush_market_stats` if trading stops.
+    """
+    interval = getattr(settings, "MARKET_STATS_FLUSH_INTERVAL", 1.0)
+    if time.monotonic() - _last_flush >= interval:
+        flush_market_stats()
+
+
+def flush_market_stats() -> None:
+    """Write the current window of every market changed since the last flush.
+
+    A market stays dirty until its row is written; one whose write fails is
+    logged and retried on the next flush.
+    """
+    from .models import MarketStats
+
+    global _last_flush
+    with _stats_lock:
+        _last_flush = time.monotonic()
+        now_minute = minute_of(timezone.now())
+        rows = []
+        for symbol in list(_dirty):
+            stats = _stats.get(symbol)
+            if stats is None or stats.last_price is None:
+                _dirty.discard(symbol)
+                continue
+            stats.advance(now_minute)
+            rows.append((symbol, stats.version, _row_values(stats)))
+    for symbol, version, values in rows:
+        try:
+            MarketStats.objects.update_or_create(market_symbol=symbol, defaults=values)
+        except Exception:
+            logger.exception(f"Failed to flush market stats for {symbol}")
+            continue
+        with _stats_lock:
+            stats = _stats.get(symbol)
+            # Trades folded in since the snapshot keep the market dirty.
+            if stats is None or stats.version == version:
+                _dirty.discard(symbol)
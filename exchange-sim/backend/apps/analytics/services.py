@@ -1,38 +1,57 @@
-from decimal import Decimal
-from django.utils import timezone
-from django.db.models import Sum, Min, Max, Count, F
+from django.db import transaction
 
-from .models import MarketStats
+from common.constants import CANDLE_INTERVAL_1M
+from .models import Candle
+from .candles import persist_candles, record_candle_trades
+from .rolling_stats import record_trades
 from apps.trading.models import Trade
 
 
-def update_market_stats_after_trade(market_symbol: str, trade_price: Decimal, trade_amount: Decimal) -> None:
-    since = timezone.now() - timezone.timedelta(hours=24)
-    qs = Trade.objects.filter(market_symbol=market_symbol, created_at__gte=since)
-    agg = qs.aggregate(
-        volume=Sum(F("price") * F("amount")),
-        low=Min("price"),
-        high=Max("price"),
-        count=Count("id"),
-    )
-    volume_24h = agg["volume"] or Decimal("0")
-    low_24h = agg["low"] if agg["low"] is not None else trade_price
-    high_24h = agg["high"] if agg["high"] is not None else trade_price
-    trades_24h = agg["count"] or 0
-    stats, created = MarketStats.objects.get_or_create(
-        market_symbol=market_symbol,
-        defaults={
-            "last_price": trade_price,
-            "volume_24h_quote": volume_24h,
-            "high_24h": high_24h,
-            "low_24h": low_24h,
-            "trades_24h": trades_24h,
-        },
-    )
-    if not created:
-        stats.last_price = trade_price
-        stats.volume_24h_quote = volume_24h
-        stats.low_24h = low_24h
-        stats.high_24h = high_24h
-        stats.trades_24h = trades_24h
-        stats.save(update_fields=["last_price", "volume_24h_quote", "low_24h", "high_24h", "trades_24h", "updated_at"])
+def update_market_stats_after_trades(market_symbol: str, trades) -> None:
+    """Fold a batch of fills into the market's rolling 24h window once it commits."""
+    rows = [(trade.created_at, trade.price, trade.amount) for trade in trades]
+    transaction.on_commit(lambda: record_trades(market_symbol, rows), robust=True)
+    transaction.on_commit(lambda: record_candle_trades(market_symbol, rows), robust=True)
+
+
+def minute_candles(trades) -> list:
+    """Fold `(market_symbol, created_at, price, amount)` rows, in time order, into 1m candles."""
+    candles = {}
+    for market_symbol, created_at, price, amount in trades:
+        open_time = created_at.replace(second=0, microsecond=0)
+        candle = candles.get((market_symbol, open_time))
+        if candle is None:
+            candle = candles[(market_symbol, open_time)] = Candle(
+                market_symbol=market_symbol,
+                interval=CANDLE_INTERVAL_1M,
+                open_time=open_time,
+                open=price,
+                high=price,
+                low=price,
+                close=price,
+            )
+        candle.high = max(candle.high, price)
+        candle.low = min(candle.low, price)
+        candle.close = price
+        candle.volume += amount
+        candle.quote_volume += price * amount
+        candle.trade_count += 1
+    return list(candles.values())
+
+
+def rollup_trades(start, end) -> tuple:
+    """Replace raw trades in `[start, end)` with 1m candles. Returns `(candles, trades)` counts.
+
+    Candles are rebuilt from the raw rows and overwrite any stored for the same
+    minutes, so rerunning over a partly processed range is harmless.
+    """
+    with transaction.atomic():
+        trades = Trade.objects.filter(created_at__gte=start, created_at__lt=end)
+        candles = minute_candles(
+            trades.order_by("market_symbol", "created_at", "id")
+            .values_list("market_symbol", "created_at", "price", "amount")
+            .iterator()
+        )
+        persist_candles(candles)
+        deleted, _ = trades.delete()
+    return len(candles), deleted
@@ -1 +1,386 @@
-from django.test import TestCase
+import random
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import OperationalError
+from django.core.cache import cache
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from apps.markets.models import Asset, Market
+from apps.trading.models import Order, Trade
+from apps.users.models import User
+from common.constants import ORDER_SIDE_BUY, ORDER_STATUS_FILLED, ORDER_TYPE_LIMIT
+
+from . import candles, rolling_stats
+from .candles import CandleSeries, get_internal_klines, load_series
+from .models import Candle, MarketStats
+from .services import rollup_trades
+from .rolling_stats import WINDOW_MINUTES, RollingStats, flush_market_stats, maybe_flush, minute_of
+
+
+def random_price(rnd: random.Random) -> Decimal:
+    return Decimal(rnd.randrange(1, 10_000_000)).scaleb(-2)
+
+
+class RollingStatsTests(SimpleTestCase):
+    """The rolling window must agree with a scan of the trades inside it."""
+
+    def assert_window(self, stats: RollingStats, trades: list, minute: int) -> None:
+        inside = [(price, amount) for m, price, amount in trades if m > minute - WINDOW_MINUTES]
+        self.assertEqual(stats.count, len(inside))
+        self.assertEqual(stats.volume.to_decimal(), sum((p * a for p, a in inside), Decimal("0")))
+        self.assertEqual(stats.high, max((p for p, _ in inside), default=None))
+        self.assertEqual(stats.low, min((p for p, _ in inside), default=None))
+
+    def test_high_low_exact_after_buckets_are_evicted(self):
+        rnd = random.Random(15)
+        stats = RollingStats("BTCUSDT", 0)
+        trades = []
+        for minute in range(3 * WINDOW_MINUTES):
+            if rnd.random() < 0.3:
+                for _ in range(rnd.randint(1, 3)):
+                    price, amount = random_price(rnd), Decimal(rnd.randrange(1, 10_000)).scaleb(-4)
+                    stats.add_trade(minute, price, amount)
+                    trades.append((minute, price, amount))
+            else:
+                stats.advance(minute)
+            if minute % 7 == 0:
+                self.assert_window(stats, trades, minute)
+
+    def test_extreme_leaves_window_after_1440_minutes(self):
+        stats = RollingStats("BTCUSDT", 0)
+        stats.add_trade(0, Decimal("500"), Decimal("1"))
+        stats.add_trade(1, Decimal("100"), Decimal("1"))
+        stats.add_trade(2, Decimal("300"), Decimal("1"))
+        stats.advance(WINDOW_MINUTES - 1)
+        self.assertEqual((stats.high, stats.low), (Decimal("500"), Decimal("100")))
+        stats.advance(WINDOW_MINUTES)
+        self.assertEqual((stats.high, stats.low), (Decimal("300"), Decimal("100")))
+        stats.advance(WINDOW_MINUTES + 1)
+        self.assertEqual((stats.high, stats.low), (Decimal("300"), Decimal("300")))
+        self.assertEqual(stats.count, 1)
+
+    def test_rollover_across_idle_period(self):
+        stats = RollingStats("BTCUSDT", 0)
+        stats.add_trade(10, Decimal("200"), Decimal("2"))
+        stats.add_trade(900, Decimal("150"), Decimal("1"))
+
+        stats.advance(10 + WINDOW_MINUTES)
+        self.assertEqual(stats.count, 1)
+        self.assertEqual(stats.volume.to_decimal(), Decimal("150"))
+        self.assertEqual((stats.high, stats.low), (Decimal("150"), Decimal("150")))
+
+        stats.advance(900 + 5 * WINDOW_MINUTES)
+        self.assertEqual(stats.count, 0)
+        self.assertEqual(stats.volume.to_decimal(), Decimal("0"))
+        self.assertIsNone(stats.high)
+        self.assertIsNone(stats.low)
+        self.assertEqual(stats.last_price, Decimal("150"))
+
+        minute = 900 + 5 * WINDOW_MINUTES + 3
+        stats.add_trade(minute, Decimal("120"), Decimal("1"))
+        self.assertEqual(stats.count, 1)
+        self.assertEqual((stats.high, stats.low), (Decimal("120"), Decimal("120")))
+        # A bucket reusing the ring slot of an evicted minute starts empty.
+        stats.add_trade(minute + WINDOW_MINUTES, Decimal("130"), Decimal("1"))
+        self.assertEqual(stats.count, 1)
+        self.assertEqual(stats.volume.to_decimal(), Decimal("130"))
+
+
+@override_settings(MARKET_STATS_FLUSH_INTERVAL=60)
+class MarketStatsFlushTests(TestCase):
+    symbol = "BTCUSDT"
+
+    def setUp(self):
+        rolling_stats.discard_rolling_stats()
+        rolling_stats._dirty.clear()
+        self.addCleanup(rolling_stats._dirty.clear)
+        self.addCleanup(rolling_stats.discard_rolling_stats)
+
+    def fold(self, price: str, amount: str = "1") -> RollingStats:
+        with rolling_stats._stats_lock:
+            stats = rolling_stats._stats.setdefault(self.symbol, RollingStats(self.symbol, 0))
+            stats.add_trade(minute_of(timezone.now()), Decimal(price), Decimal(amount))
+            stats.version += 1
+            rolling_stats._dirty.add(self.symbol)
+        return stats
+
+    def test_failed_write_keeps_market_dirty(self):
+        self.fold("100")
+        with mock.patch.object(
+            MarketStats.objects, "update_or_create", side_effect=OperationalError("database is locked")
+        ), self.assertLogs("apps.analytics.rolling_stats", "ERROR"):
+            flush_market_stats()
+        self.assertIn(self.symbol, rolling_stats._dirty)
+        self.assertFalse(MarketStats.objects.exists())
+
+        flush_market_stats()
+        self.assertNotIn(self.symbol, rolling_stats._dirty)
+        row = MarketStats.objects.get(market_symbol=self.symbol)
+        self.assertEqual(row.last_price, Decimal("100"))
+        self.assertEqual(row.trades_24h, 1)
+
+    def test_trades_during_write_keep_market_dirty(self):
+        self.fold("100")
+        original = MarketStats.objects.update_or_create
+
+        def write_then_trade(**kwargs):
+            result = original(**kwargs)
+            self.fold("110")
+            return result
+
+        with mock.patch.object(MarketStats.objects, "update_or_create", side_effect=write_then_trade):
+            flush_market_stats()
+        self.assertIn(self.symbol, rolling_stats._dirty)
+        flush_market_stats()
+        self.assertEqual(MarketStats.objects.get(market_symbol=self.symbol).trades_24h, 2)
+
+    def test_flush_is_rate_limited_and_reads_do_not_write(self):
+        self.fold("100")
+        flush_market_stats()
+        self.fold("120")
+        maybe_flush()
+        self.assertEqual(MarketStats.objects.get(market_symbol=self.symbol).trades_24h, 1)
+
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user("reader", password="x"))
+        response = client.get("/api/stats/market/", {"symbol": self.symbol})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["trades_24h"], 1)
+        self.assertIn(self.symbol, rolling_stats._dirty)
+
+    def test_command_writes_stats_from_stored_trades(self):
+        Market.objects.create(
+            symbol=self.symbol,
+            base_asset=Asset.objects.create(code="BTC", name="Bitcoin"),
+            quote_asset=Asset.objects.create(code="USDT", name="Tether"),
+        )
+        for price in ("100", "120"):
+            Trade.objects.create(
+                market_symbol=self.symbol, price=Decimal(price), amount=Decimal("1"),
+                buy_order_id=1, sell_order_id=2, taker_side=ORDER_SIDE_BUY,
+            )
+        out = StringIO()
+        call_command("flush_market_stats", "--once", stdout=out)
+        self.assertIn("Wrote stats for 1 markets", out.getvalue())
+        row = MarketStats.objects.get(market_symbol=self.symbol)
+        self.assertEqual((row.trades_24h, row.high_24h, row.last_price), (2, Decimal("120"), Decimal("120")))
+
+
+class RollupTradesTests(TestCase):
+    def setUp(self):
+        self.order = Order.objects.create(
+            user=User.objects.create_user("trader"),
+            market_symbol="BTCUSDT",
+            side=ORDER_SIDE_BUY,
+            type=ORDER_TYPE_LIMIT,
+            price=Decimal("100"),
+            amount=Decimal("100"),
+            filled_amount=Decimal("100"),
+            status=ORDER_STATUS_FILLED,
+        )
+        now = datetime.now(dt_timezone.utc)
+        self.day = datetime(now.year, now.month, now.day, tzinfo=dt_timezone.utc) - timedelta(days=40)
+        self.add_trades()
+
+    def add_trades(self) -> None:
+        # Two markets, two days, several trades in some minutes.
+        for symbol, offset, price, amount in (
+            ("BTCUSDT", timedelta(minutes=5, seconds=1), "100", "1"),
+            ("BTCUSDT", timedelta(minutes=5, seconds=30), "103", "0.5"),
+            ("BTCUSDT", timedelta(minutes=5, seconds=59), "99", "2"),
+            ("BTCUSDT", timedelta(hours=13), "101", "1"),
+            ("ETHUSDT", timedelta(minutes=5, seconds=10), "10", "3"),
+            ("BTCUSDT", timedelta(days=1, minutes=1), "104", "1"),
+            ("BTCUSDT", timedelta(days=39), "110", "1"),
+        ):
+            trade = Trade.objects.create(
+                market_symbol=symbol,
+                price=Decimal(price),
+                amount=Decimal(amount),
+                buy_order=self.order,
+                sell_order=self.order,
+                taker_side=ORDER_SIDE_BUY,
+            )
+            Trade.objects.filter(id=trade.id).update(created_at=self.day + offset)
+
+    def candles(self) -> list:
+        return list(
+            Candle.objects.order_by("market_symbol", "open_time").values_list(
+                "market_symbol", "interval", "open_time", "open", "high", "low", "close",
+                "volume", "quote_volume", "trade_count",
+            )
+        )
+
+    def rollup(self) -> str:
+        out = StringIO()
+        call_command("rollup_trades", retention_days=30, stdout=out)
+        return out.getvalue()
+
+    def test_rollup_builds_minute_candles_and_deletes_the_trades(self):
+        self.assertIn("Rolled 6 trades into 4 candles", self.rollup())
+        self.assertEqual(Trade.objects.count(), 1)
+        first = self.candles()[0]
+        self.assertEqual(
+            first,
+            (
+                "BTCUSDT", "1m", self.day + timedelta(minutes=5),
+                Decimal("100"), Decimal("103"), Decimal("99"), Decimal("99"),
+                Decimal("3.5"), Decimal("349.5"), 3,
+            ),
+        )
+
+    def test_running_twice_gives_the_same_candles(self):
+        self.rollup()
+        candles = self.candles()
+        self.assertIn("Nothing to roll up", self.rollup())
+        self.assertEqual(self.candles(), candles)
+
+    def test_rerun_after_a_partial_range_gives_the_same_candles(self):
+        self.rollup()
+        expected = self.candles()
+        Candle.objects.all().delete()
+        Trade.objects.all().delete()
+        self.add_trades()
+
+        # The first hour of the first day went through before an interruption.
+        rollup_trades(self.day, self.day + timedelta(hours=1))
+        self.rollup()
+        self.assertEqual(self.candles(), expected)
+
+
+
+HOUR = 3600
+
+
+class CandleSeriesTests(SimpleTestCase):
+    def series(self) -> CandleSeries:
+        # Starts on a day boundary, so every interval's bucket starts at 0.
+        return CandleSeries("BTCUSDT", 0)
+
+    def closed(self, series: CandleSeries) -> list:
+        return [
+            (interval, candle.open_time, candle.open, candle.close, candle.trade_count)
+            for interval, candle in series.take_closed()
+        ]
+
+    def test_minute_rollover_closes_the_minute_only(self):
+        series = self.series()
+        series.add_trade(10, Decimal("100"), Decimal("1"))
+        series.add_trade(50, Decimal("102"), Decimal("1"))
+        self.assertEqual(self.closed(series), [])
+        series.add_trade(61, Decimal("101"), Decimal("1"))
+        self.assertEqual(self.closed(series), [("1m", 0, Decimal("100"), Decimal("102"), 2)])
+
+        five = series.live_candle("5m")
+        self.assertEqual(
+            (five.open_time, five.open, five.high, five.close, five.trade_count),
+            (0, Decimal("100"), Decimal("102"), Decimal("101"), 3),
+        )
+        self.assertEqual(series.live_candle("1m").open_time, 60)
+
+    def test_longer_intervals_close_when_their_bucket_ends(self):
+        series = self.series()
+        series.add_trade(0, Decimal("100"), Decimal("1"))
+        series.add_trade(299, Decimal("105"), Decimal("2"))
+        series.add_trade(300, Decimal("110"), Decimal("1"))
+        self.assertEqual(
+            self.closed(series),
+            [
+                ("1m", 0, Decimal("100"), Decimal("100"), 1),
+                ("1m", 240, Decimal("105"), Decimal("105"), 1),
+                ("5m", 0, Decimal("100"), Decimal("105"), 2),
+            ],
+        )
+        fifteen = series.live_candle("15m")
+        self.assertEqual((fifteen.open, fifteen.close, fifteen.volume), (Decimal("100"), Decimal("110"), Decimal("4")))
+
+    def test_idle_gap_closes_every_bucket_it_skips(self):
+        series = self.series()
+        series.add_trade(30, Decimal("100"), Decimal("1"))
+        series.add_trade(HOUR + 30, Decimal("90"), Decimal("1"))
+        self.assertEqual(
+            [(interval, open_time) for interval, open_time, *_ in self.closed(series)],
+            [("1m", 0), ("5m", 0), ("15m", 0), ("1h", 0)],
+        )
+        self.assertEqual(series.live_candle("1h").open_time, HOUR)
+        self.assertEqual(series.live_candle("4h").open, Decimal("100"))
+        self.assertEqual(series.live_candle("1d").trade_count, 2)
+
+    def test_late_trade_lands_in_the_open_minute(self):
+        series = self.series()
+        series.add_trade(70, Decimal("100"), Decimal("1"))
+        series.add_trade(30, Decimal("95"), Decimal("1"))
+        self.assertEqual(self.closed(series), [])
+        minute = series.live_candle("1m")
+        self.assertEqual((minute.open_time, minute.low, minute.trade_count), (60, Decimal("95"), 2))
+
+
+class InternalKlinesTests(TestCase):
+    symbol = "BTCUSDT"
+
+    def setUp(self):
+        cache.clear()
+        candles.discard_series()
+        self.addCleanup(candles.discard_series)
+        self.order = Order.objects.create(
+            user=User.objects.create_user("trader"),
+            market_symbol=self.symbol,
+            side=ORDER_SIDE_BUY,
+            type=ORDER_TYPE_LIMIT,
+            price=Decimal("100"),
+            amount=Decimal("100"),
+            filled_amount=Decimal("100"),
+            status=ORDER_STATUS_FILLED,
+        )
+        now = timezone.now()
+        self.minute = now.replace(second=0, microsecond=0)
+        if self.minute.hour == 0 and self.minute.minute < 3:
+            self.skipTest("Needs three minutes of the current day")
+
+    def trade(self, at: datetime, price: str, amount: str = "1"):
+        trade = Trade.objects.create(
+            market_symbol=self.symbol,
+            price=Decimal(price),
+            amount=Decimal(amount),
+            buy_order=self.order,
+            sell_order=self.order,
+            taker_side=ORDER_SIDE_BUY,
+        )
+        Trade.objects.filter(id=trade.id).update(created_at=at)
+        return at, trade.price, trade.amount
+
+    def test_rebuild_matches_the_series_built_trade_by_trade(self):
+        with mock.patch("apps.realtime.services.broadcast_kline"):
+            for at, price, amount in (
+                (self.minute - timedelta(minutes=2, seconds=-5), "100", "1"),
+                (self.minute - timedelta(minutes=2, seconds=-40), "104", "2"),
+                (self.minute - timedelta(seconds=30), "98", "1"),
+                (self.minute + timedelta(seconds=1), "101", "1"),
+            ):
+                candles.record_candle_trades(self.symbol, [self.trade(at, price, amount)])
+        warm = {interval: get_internal_klines(self.symbol, interval) for interval in ("1m", "5m", "1h")}
+        self.assertEqual([row[4] for row in warm["1m"]], ["104.00000000", "98.00000000", "101.00000000"])
+
+        # Another worker holds nothing in memory: it reads the two stored
+        # minutes and only the trades of the open one.
+        candles.discard_series()
+        series = load_series(self.symbol, candles._shared_version(self.symbol))
+        self.assertEqual(series.live_candle("1m").trade_count, 1)
+        cold = {interval: get_internal_klines(self.symbol, interval) for interval in ("1m", "5m", "1h")}
+        self.assertEqual(cold, warm)
+
+    def test_limit_is_clamped(self):
+        self.trade(self.minute - timedelta(minutes=1), "100")
+        self.trade(self.minute, "101")
+        self.assertEqual(len(get_internal_klines(self.symbol, "1m", 1)), 1)
+        self.assertEqual(len(get_internal_klines(self.symbol, "1m", 5000)), 2)
+
+        response = Client().get(f"/api/markets/{self.symbol}/candles/", {"source": "internal", "interval": "1m", "limit": "-5"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
+
+
+class MarketsConfig(AppConfig):
+    name = "apps.markets"
+
+    def ready(self):
+        from .models import Asset, Market
+        from .registry import invalidate
+
+        for model in (Asset, Market):
+            post_save.connect(invalidate, sender=model, dispatch_uid=f"registry-save-{model.__name__}")
+            post_delete.connect(invalidate, sender=model, dispatch_uid=f"registry-delete-{model.__name__}")
@@ -0,0 +1,227 @@
+"""Single-flight, stale-while-revalidate cache fills for upstream market data.
+
+Values are cached with two deadlines. Until the fresh one they are served
+as-is. Between the two they are still served at once, while one background
+refresh replaces them. After the stale deadline the entry is gone and callers
+wait for a fetch.
+
+Only one caller fetches a key at a time. Threads of the same process wait on
+that caller's result. Other processes see its short lock in the shared cache
+and poll for the value it stores instead of fetching too.
+"""
+import logging
+import threading
+import time
+import uuid
+from typing import Any, NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_FLIGHT_LOCK = "{key}:fetching"
+CACHE_KEY_METRIC = "markets:metrics:{name}"
+POLL_INTERVAL = 0.05
+# After a failed background refresh, keep serving the stale value this long
+# (at most the fresh TTL) before trying the upstream again.
+REFRESH_RETRY_DELAY = 5
+
+METRIC_UPSTREAM_FETCHES = "upstream_fetches"
+METRIC_COALESCED = "coalesced"
+METRIC_LOCK_WAIT_TIMEOUTS = "lock_wait_timeouts"
+METRIC_STALE_SERVED = "stale_served"
+METRIC_REFRESH_FAILURES = "refresh_failures"
+METRICS = (
+    METRIC_UPSTREAM_FETCHES,
+    METRIC_COALESCED,
+    METRIC_LOCK_WAIT_TIMEOUTS,
+    METRIC_STALE_SERVED,
+    METRIC_REFRESH_FAILURES,
+)
+
+
+class Envelope(NamedTuple):
+    """A cached value with its deadlines, in epoch seconds."""
+
+    data: Any
+    fresh_until: float
+    stale_until: float
+
+
+class Flight:
+    __slots__ = ("done", "result")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _lock_timeout() -> float:
+    return getattr(settings, "MARKET_DATA_LOCK_TIMEOUT", 15)
+
+
+def count(name: str) -> None:
+    key = CACHE_KEY_METRIC.format(name=name)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def get_metrics() -> dict:
+    values = cache.get_many([CACHE_KEY_METRIC.format(name=name) for name in METRICS])
+    return {name: values.get(CACHE_KEY_METRIC.format(name=name), 0) for name in METRICS}
+
+
+def _cached(key: str):
+    envelope = cache.get(key)
+    # Anything else is a value written before entries carried deadlines.
+    return envelope if isinstance(envelope, Envelope) else None
+
+
+def _store(key: str, data, fresh_ttl, stale_ttl: int) -> None:
+    if callable(fresh_ttl):
+        fresh_ttl = fresh_ttl(data)
+        # A computed deadline may outlast the stale bound; never expire before it.
+        stale_ttl = max(stale_ttl, fresh_ttl)
+    store_many({key: data}, fresh_ttl, stale_ttl)
+
+
+def store_many(values: dict, fresh_ttl: int, stale_ttl: int) -> None:
+    """Cache values fetched some other way, e.g. several keys from one bulk call."""
+    now = time.time()
+    cache.set_many({key: Envelope(data, now + fresh_ttl, now + stale_ttl) for key, data in values.items()}, stale_ttl)
+
+
+def single_flight(key: str, fresh_ttl, stale_ttl: int, fetch):
+    """The cached value of `key`, fetched by one caller at a time.
+
+    `fetch()` returns the value to cache, or None on failure. A failed fetch
+    is not cached; callers that waited on it get None too. A value past its
+    fresh TTL is returned immediately and refreshed in the background.
+    `fresh_ttl` may be a function of the fetched value.
+    """
+    envelope = _cached(key)
+    if envelope is not None:
+        if time.time() >= envelope.fresh_until:
+            count(METRIC_STALE_SERVED)
+            _refresh_in_background(key, fresh_ttl, stale_ttl, fetch, envelope)
+        return envelope.data
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Flight()
+    if not leader:
+        if not flight.done.wait(_lock_timeout()):
+            count(METRIC_LOCK_WAIT_TIMEOUTS)
+            return None
+        if flight.result is not None:
+            count(METRIC_COALESCED)
+        return flight.result
+    try:
+        flight.result = _fetch_shared(key, fresh_ttl, stale_ttl, fetch)
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+    return flight.result
+
+
+def _fetch_shared(key: str, fresh_ttl, stale_ttl: int, fetch):
+    """Fetch under the shared lock, or pick up the value its holder stores."""
+    lock_key = CACHE_KEY_FLIGHT_LOCK.format(key=key)
+    token = uuid.uuid4().hex
+    lock_timeout = _lock_timeout()
+    deadline = time.monotonic() + lock_timeout
+    while not cache.add(lock_key, token, lock_timeout):
+        time.sleep(POLL_INTERVAL)
+        envelope = _cached(key)
+        if envelope is not None:
+            count(METRIC_COALESCED)
+            return envelope.data
+        if time.monotonic() >= deadline:
+            # The holder is stuck or gone; fetch rather than wait any longer.
+            count(METRIC_LOCK_WAIT_TIMEOUTS)
+            return _fetch(key, fresh_ttl, stale_ttl, fetch)
+    try:
+        # Filled by the previous holder between our miss and taking the lock.
+        envelope = _cached(key)
+        if envelope is not None:
+            count(METRIC_COALESCED)
+            return envelope.data
+        return _fetch(key, fresh_ttl, stale_ttl, fetch)
+    finally:
+        _release(lock_key, token)
+
+
+def _release(lock_key: str, token: str) -> None:
+    """Drop the lock unless it expired and another caller took it meanwhile."""
+    # Not atomic, but the lock would have to expire and be taken again
+    # between these two calls.
+    if cache.get(lock_key) == token:
+        cache.delete(lock_key)
+
+
+def _fetch(key: str, fresh_ttl, stale_ttl: int, fetch):
+    count(METRIC_UPSTREAM_FETCHES)
+    data = fetch()
+    if data:
+        _store(key, data, fresh_ttl, stale_ttl)
+    return data
+
+
+def _refresh_in_background(key: str, fresh_ttl, stale_ttl: int, fetch, envelope: Envelope) -> None:
+    with _flights_lock:
+        if key in _flights:
+            return
+        # Stale readers never wait on this flight; it keeps refreshes to one per
+        # process, and a caller that finds the entry expired meanwhile waits on it.
+        flight = _flights[key] = Flight()
+    thread = threading.Thread(target=_refresh, args=(key, fresh_ttl, stale_ttl, fetch, envelope, flight), daemon=True)
+    thread.start()
+
+
+def _refresh(key: str, fresh_ttl, stale_ttl: int, fetch, envelope: Envelope, flight: Flight) -> None:
+    lock_key = CACHE_KEY_FLIGHT_LOCK.format(key=key)
+    token = uuid.uuid4().hex
+    try:
+        # Another process is already refreshing it.
+        if not cache.add(lock_key, token, _lock_timeout()):
+            return
+        try:
+            current = _cached(key)
+            if current is not None and current.fresh_until > envelope.fresh_until:
+                return
+            count(METRIC_UPSTREAM_FETCHES)
+            data = fetch()
+            if data:
+                _store(key, data, fresh_ttl, stale_ttl)
+                flight.result = data
+                return
+            count(METRIC_REFRESH_FAILURES)
+            # Keep the old value until its hard deadline, retrying now and then.
+            now = time.time()
+            remaining = envelope.stale_until - now
+            if remaining > 0:
+                retry_at = now + (REFRESH_RETRY_DELAY if callable(fresh_ttl) else min(REFRESH_RETRY_DELAY, fresh_ttl))
+                cache.set(key, envelope._replace(fresh_until=retry_at), remaining)
+        finally:
+            _release(lock_key, token)
+    except Exception:
+        logger.exception("Background refresh of %s failed", key)
+    finally:
+        close_old_connections()
+        if flight.result is None:
+            current = _cached(key)
+            flight.result = current.data if current is not None else None
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
@@ -0,0 +1,338 @@
+"""Upstream market data kept current from the Binance WebSocket streams.
+
+`MarketIngestor` holds one combined stream connection for 24h tickers and one
+for klines, covering every active market. Stream events only update state in
+memory on the event loop. Every flush interval that state is written to the
+cache under the keys the API reads, closed klines are stored, and changed
+prices are published to the ticker groups.
+
+Entries are rewritten on each flush, so while the worker runs they stay fresh
+and API requests are served without upstream calls. If it stops, they go
+stale and the API fetches on demand as before.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed
+
+from apps.realtime.services import publish_tickers
+from . import services
+from .kline_store import fetch_tail, store_closed, tail_refresh_at
+from .registry import active_markets
+from .upstream import binance_stream_url
+
+logger = logging.getLogger(__name__)
+
+STREAM_TICKERS = "tickers"
+STREAM_KLINES = "klines"
+STREAM_TYPES = (STREAM_TICKERS, STREAM_KLINES)
+
+# Entries written from the streams stay fresh this long (seconds) without
+# another flush; past it the API goes back to fetching them itself.
+STREAM_FRESH_TTL = 10
+RECONNECT_DELAY_MAX = 30
+CONNECT_TIMEOUT = 10
+# Seconds to wait for the server's half of the closing handshake.
+CLOSE_TIMEOUT = 2
+# Largest message accepted; an upstream event is a few kilobytes at most.
+MAX_MESSAGE_SIZE = 1 << 22
+# Both streams push every second or two; this long without a message means
+# the connection is dead even if it wasn't closed.
+STREAM_IDLE_TIMEOUT = 60
+# Seconds between attempts to load the history of series whose backfill failed.
+BACKFILL_RETRY_INTERVAL = 30
+# Seconds between checks for markets added or deactivated since the streams opened.
+MARKETS_CHECK_INTERVAL = 60
+
+
+async def open_stream(url: str):
+    """Connect to a combined stream; pings are answered by the connection itself."""
+    return await connect(
+        url, open_timeout=CONNECT_TIMEOUT, close_timeout=CLOSE_TIMEOUT, max_size=MAX_MESSAGE_SIZE
+    )
+
+
+def ticker_from_event(event: dict) -> dict:
+    """A `24hrTicker` stream event in the layout of the REST 24h ticker."""
+    return {
+        "symbol": event["s"],
+        "priceChange": event["p"],
+        "priceChangePercent": event["P"],
+        "weightedAvgPrice": event["w"],
+        "prevClosePrice": event["x"],
+        "lastPrice": event["c"],
+        "lastQty": event["Q"],
+        "bidPrice": event["b"],
+        "bidQty": event["B"],
+        "askPrice": event["a"],
+        "askQty": event["A"],
+        "openPrice": event["o"],
+        "highPrice": event["h"],
+        "lowPrice": event["l"],
+        "volume": event["v"],
+        "quoteVolume": event["q"],
+        "openTime": event["O"],
+        "closeTime": event["C"],
+        "firstId": event["F"],
+        "lastId": event["L"],
+        "count": event["n"],
+    }
+
+
+def kline_from_event(k: dict) -> list:
+    """The `k` object of a kline stream event in the REST kline layout."""
+    return [k["t"], k["o"], k["h"], k["l"], k["c"], k["v"], k["T"], k["q"], k["n"], k["V"], k["Q"], "0"]
+
+
+class MarketIngestor:
+    def __init__(self, intervals, flush_interval: float = 1.0):
+        self.intervals = list(intervals)
+        self.flush_interval = flush_interval
+        self.symbols = []
+        self.sockets = {}
+        # Ticker stream state.
+        self.tickers = {}
+        self.changed = {}
+        # Kline stream state, keyed by (symbol, interval). A series is written
+        # to the cache only once its history is loaded (`last_closed` has it);
+        # until then closed klines wait in `held`.
+        self.last_closed = {}
+        self.open = {}
+        self.held = {}
+        self.closed = []
+        self.unready = set()
+        self.klines_open = False
+        self.generation = 0
+        self.backfill_at = None
+        self.backfill_task = None
+        self.loop = None
+        self.stopping = None
+
+    def stop(self) -> None:
+        """Ask `run` to flush and return; callable from any thread."""
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def run(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.symbols = await sync_to_async(self._active_symbols)()
+        tasks = [asyncio.ensure_future(self._run_stream(stream_type)) for stream_type in STREAM_TYPES]
+        try:
+            await self._flush_loop()
+        finally:
+            for task in tasks + [self.backfill_task]:
+                if task is not None:
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _active_symbols(self) -> list:
+        try:
+            return sorted(m.symbol for m in active_markets())
+        finally:
+            close_old_connections()
+
+    def _streams(self, stream_type: str) -> list:
+        if stream_type == STREAM_TICKERS:
+            return [f"{symbol.lower()}@ticker" for symbol in self.symbols]
+        return [f"{symbol.lower()}@kline_{interval}" for symbol in self.symbols for interval in self.intervals]
+
+    async def _sleep(self, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run_stream(self, stream_type: str) -> None:
+        delay = 1
+        while not self.stopping.is_set():
+            streams = self._streams(stream_type)
+            if not streams:
+                await self._sleep(MARKETS_CHECK_INTERVAL)
+                continue
+            try:
+                ws = await open_stream(binance_stream_url(streams))
+            except Exception as e:
+                logger.warning(f"Binance {stream_type} stream connect failed: {e}")
+            else:
+                delay = 1
+                try:
+                    await self._consume(stream_type, ws)
+                except Exception as e:
+                    logger.warning(f"Binance {stream_type} stream lost: {e}")
+                finally:
+                    await ws.close()
+                    self._disconnected(stream_type)
+            if not self.stopping.is_set():
+                logger.info(f"Reconnecting the {stream_type} stream in {delay}s")
+                await self._sleep(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+    async def _consume(self, stream_type: str, ws) -> None:
+        """Apply events until the connection closes."""
+        handle = self._on_ticker if stream_type == STREAM_TICKERS else self._on_kline
+        self.sockets[stream_type] = ws
+        self._connected(stream_type)
+        try:
+            while True:
+                message = await asyncio.wait_for(ws.recv(), STREAM_IDLE_TIMEOUT)
+                try:
+                    handle(json.loads(message)["data"])
+                except Exception:
+                    logger.exception(f"Bad message on the {stream_type} stream")
+        except ConnectionClosed:
+            pass
+        finally:
+            self.sockets.pop(stream_type, None)
+
+    def _connected(self, stream_type: str) -> None:
+        logger.info(f"Binance {stream_type} stream open for {len(self.symbols)} markets")
+        if stream_type == STREAM_KLINES:
+            # Klines may have closed while disconnected: load each series again.
+            self.klines_open = True
+            self.generation += 1
+            self.unready = {(symbol, interval) for symbol in self.symbols for interval in self.intervals}
+            self.backfill_at = 0
+
+    def _disconnected(self, stream_type: str) -> None:
+        """Stop writing what the stream no longer keeps current; it goes stale."""
+        if stream_type == STREAM_TICKERS:
+            self.tickers.clear()
+            self.changed.clear()
+        else:
+            self.klines_open = False
+            self.generation += 1
+            self.last_closed.clear()
+            self.open.clear()
+            self.held.clear()
+            self.unready.clear()
+
+    def _on_ticker(self, event: dict) -> None:
+        ticker = ticker_from_event(event)
+        symbol = ticker["symbol"]
+        previous = self.tickers.get(symbol)
+        self.tickers[symbol] = ticker
+        if previous is None or previous["lastPrice"] != ticker["lastPrice"]:
+            self.changed[symbol] = ticker["lastPrice"]
+
+    def _on_kline(self, event: dict) -> None:
+        k = event["k"]
+        key = (event["s"], k["i"])
+        kline = kline_from_event(k)
+        if not k["x"]:
+            self.open[key] = kline
+            return
+        if key in self.last_closed:
+            self.closed.append((key, kline))
+            self.last_closed[key] = kline[0]
+        else:
+            self.held.setdefault(key, []).append(kline)
+
+    def _take(self):
+        """The state to write, taken on the event loop; events after this go in the next batch."""
+        tails = {}
+        now_ms = time.time() * 1000
+        for key, last_closed in self.last_closed.items():
+            kline = self.open.get(key)
+            still_open = [kline] if kline is not None and (last_closed is None or kline[0] > last_closed) else []
+            tails[key] = {
+                "last_closed": last_closed,
+                "open": still_open,
+                "refresh_at": tail_refresh_at(key[1], last_closed, still_open, now_ms),
+            }
+        batch = (self.symbols, list(self.tickers.values()), self.changed, tails, self.closed)
+        self.changed = {}
+        self.closed = []
+        return batch
+
+    def _write(self, batch) -> None:
+        symbols, tickers, changed, tails, closed = batch
+        try:
+            # Stored before the tails that point at them.
+            series = {}
+            for key, kline in closed:
+                series.setdefault(key, []).append(kline)
+            for (symbol, interval), klines in series.items():
+                store_closed(symbol, interval, klines)
+            if tickers:
+                services.store_tickers(symbols, tickers, STREAM_FRESH_TTL)
+            if tails:
+                services.store_kline_tails(tails, STREAM_FRESH_TTL)
+            if changed:
+                publish_tickers(changed)
+        finally:
+            close_old_connections()
+
+    async def flush(self) -> None:
+        batch = self._take()
+        try:
+            await sync_to_async(self._write)(batch)
+        except Exception:
+            logger.exception("Writing streamed market data failed")
+            # Closed klines may not be stored; load those series again.
+            for key, _ in batch[4]:
+                self.last_closed.pop(key, None)
+                self.unready.add(key)
+            self.backfill_at = time.monotonic()
+
+    async def _flush_loop(self) -> None:
+        markets_checked = time.monotonic()
+        while not self.stopping.is_set():
+            await self._sleep(self.flush_interval)
+            await self.flush()
+            self._maybe_backfill()
+            if time.monotonic() - markets_checked >= MARKETS_CHECK_INTERVAL:
+                markets_checked = time.monotonic()
+                await self._check_markets()
+
+    async def _check_markets(self) -> None:
+        symbols = await sync_to_async(self._active_symbols)()
+        if symbols != self.symbols:
+            logger.info(f"Active markets changed; resubscribing to {len(symbols)}")
+            self.symbols = symbols
+            for ws in list(self.sockets.values()):
+                await ws.close()
+
+    def _maybe_backfill(self) -> None:
+        if not self.klines_open or not self.unready or self.backfill_task is not None:
+            return
+        if self.backfill_at is None or time.monotonic() < self.backfill_at:
+            return
+        self.backfill_task = asyncio.ensure_future(self._backfill(sorted(self.unready), self.generation))
+
+    async def _backfill(self, keys: list, generation: int) -> None:
+        try:
+            tails = await sync_to_async(self._fetch_tails, thread_sensitive=False)(keys)
+        finally:
+            self.backfill_task = None
+        if generation != self.generation:
+            return
+        for key, tail in tails.items():
+            self.unready.discard(key)
+            last_closed = tail["last_closed"]
+            # Klines the stream closed during the fetch that it didn't return.
+            for kline in self.held.pop(key, []):
+                if last_closed is None or kline[0] > last_closed:
+                    self.closed.append((key, kline))
+                    last_closed = kline[0]
+            self.last_closed[key] = last_closed
+            if tail["open"] and key not in self.open:
+                self.open[key] = tail["open"][-1]
+        if self.unready:
+            self.backfill_at = time.monotonic() + BACKFILL_RETRY_INTERVAL
+
+    def _fetch_tails(self, keys: list) -> dict:
+        """Store the history of each series up to now, as an API cache miss would."""
+        tails = {}
+        try:
+            for symbol, interval in keys:
+                tail = fetch_tail(symbol, interval)
+                if tail is not None:
+                    tails[(symbol, interval)] = tail
+        finally:
+            close_old_connections()
+        return tails
@@ -0,0 +1,169 @@
+"""Upstream klines kept in the database, one merged series per symbol and interval.
+
+Closed klines never change, so each is fetched once and stored. A refresh
+asks the upstream only for klines after the newest stored one: normally the
+one that just closed and the one now in progress. The in-progress kline is
+not stored; it travels in the cached tail returned by `fetch_tail`.
+"""
+import logging
+import threading
+import time
+
+from django.db.models import Max
+
+from .models import UpstreamKline
+from .upstream import binance_url, get_client
+
+logger = logging.getLogger(__name__)
+
+# Binance intervals of fixed length, in milliseconds. Others ("1M") aren't stored.
+KLINE_INTERVAL_MS = {
+    "1m": 60_000,
+    "3m": 180_000,
+    "5m": 300_000,
+    "15m": 900_000,
+    "30m": 1_800_000,
+    "1h": 3_600_000,
+    "2h": 7_200_000,
+    "4h": 14_400_000,
+    "6h": 21_600_000,
+    "8h": 28_800_000,
+    "12h": 43_200_000,
+    "1d": 86_400_000,
+    "3d": 259_200_000,
+    "1w": 604_800_000,
+}
+# Most klines the upstream returns per call; also how many are kept per series.
+KLINES_MAX_LIMIT = 1000
+# The in-progress kline changes with every upstream trade: a tail is fetched
+# again after this long (as other klines are, TIMEOUT_KLINES) even if a 1d or
+# 1w kline is open for much longer.
+OPEN_KLINE_REFRESH_MS = 30_000
+
+KLINE_DECIMAL_FIELDS = ["open", "high", "low", "close", "volume"]
+
+
+def to_kline(row: UpstreamKline) -> list:
+    """Binance kline layout, with values at the 8 places the upstream uses."""
+    return [
+        row.open_time,
+        *(f"{getattr(row, field):.8f}" for field in KLINE_DECIMAL_FIELDS),
+        row.close_time,
+        f"{row.quote_volume:.8f}",
+        row.trade_count,
+        f"{row.taker_buy_volume:.8f}",
+        f"{row.taker_buy_quote_volume:.8f}",
+        "0",
+    ]
+
+
+def from_kline(symbol: str, interval: str, kline: list) -> UpstreamKline:
+    return UpstreamKline(
+        symbol=symbol,
+        interval=interval,
+        open_time=kline[0],
+        open=kline[1],
+        high=kline[2],
+        low=kline[3],
+        close=kline[4],
+        volume=kline[5],
+        close_time=kline[6],
+        quote_volume=kline[7],
+        trade_count=kline[8],
+        taker_buy_volume=kline[9],
+        taker_buy_quote_volume=kline[10],
+    )
+
+
+def _series(symbol: str, interval: str):
+    return UpstreamKline.objects.filter(symbol=symbol, interval=interval)
+
+
+def store_closed(symbol: str, interval: str, klines: list) -> int:
+    """Upsert closed klines, oldest first, and prune the series; returns the newest open time."""
+    UpstreamKline.objects.bulk_create(
+        [from_kline(symbol, interval, k) for k in klines],
+        update_conflicts=True,
+        unique_fields=["symbol", "interval", "open_time"],
+        update_fields=KLINE_DECIMAL_FIELDS + [
+            "close_time", "quote_volume", "trade_count", "taker_buy_volume", "taker_buy_quote_volume",
+        ],
+    )
+    last_closed = klines[-1][0]
+    period = KLINE_INTERVAL_MS[interval]
+    _series(symbol, interval).filter(open_time__lte=last_closed - KLINES_MAX_LIMIT * period).delete()
+    return last_closed
+
+
+def fetch_tail(symbol: str, interval: str):
+    """Store klines that closed since the last call and return the rest.
+
+    Returns `{"last_closed", "open", "refresh_at"}`: the open time of the
+    newest stored kline, the klines still in progress, and when (epoch ms) to
+    fetch the tail again (see `tail_refresh_at`). None if the upstream call fails.
+    """
+    period = KLINE_INTERVAL_MS[interval]
+    url = binance_url("/api/v3/klines")
+    params = {"symbol": symbol, "interval": interval, "limit": KLINES_MAX_LIMIT}
+    last_closed = _series(symbol, interval).aggregate(last=Max("open_time"))["last"]
+    try:
+        if last_closed is None:
+            klines = get_client().get_json(url, params=params)
+        else:
+            klines = get_client().get_json(url, params={**params, "startTime": last_closed + period})
+            if len(klines) == KLINES_MAX_LIMIT and klines[-1][6] < time.time() * 1000:
+                # More closed klines than one call returns: the stored series
+                # can't be joined to the present, so start it over.
+                _series(symbol, interval).delete()
+                last_closed = None
+                klines = get_client().get_json(url, params=params)
+    except Exception as e:
+        logger.warning(f"Binance klines tail failed for {symbol} {interval}: {e}")
+        return None
+
+    now_ms = time.time() * 1000
+    closed = [k for k in klines if k[6] < now_ms]
+    still_open = klines[len(closed):]
+    if closed:
+        last_closed = store_closed(symbol, interval, closed)
+    return {
+        "last_closed": last_closed,
+        "open": still_open,
+        "refresh_at": tail_refresh_at(interval, last_closed, still_open, now_ms),
+    }
+
+
+def tail_refresh_at(interval: str, last_closed, still_open: list, now_ms: float) -> float:
+    """When (epoch ms) a tail is due again: the open kline closes or the next one
+    is due, but no later than OPEN_KLINE_REFRESH_MS from now."""
+    period = KLINE_INTERVAL_MS[interval]
+    if still_open:
+        closes_at = still_open[-1][6] + 1
+    else:
+        closes_at = (last_closed + 2 * period) if last_closed is not None else now_ms + period
+    return min(closes_at, now_ms + OPEN_KLINE_REFRESH_MS)
+
+
+_stored = {}
+_stored_lock = threading.Lock()
+
+
+def stored_klines(symbol: str, interval: str, last_closed=None) -> list:
+    """The newest stored klines of a series, oldest first.
+
+    Kept in memory per process and reused while `last_closed` (from the tail)
+    says no kline has closed since; pass None to always read the database.
+    """
+    memo = _stored.get((symbol, interval))
+    if memo is not None and last_closed is not None and memo[0] == last_closed:
+        return memo[1]
+    rows = _series(symbol, interval).order_by("-open_time")[:KLINES_MAX_LIMIT]
+    klines = [to_kline(row) for row in reversed(rows)]
+    with _stored_lock:
+        _stored[(symbol, interval)] = (klines[-1][0] if klines else None, klines)
+    return klines
+
+
+def discard_stored_klines() -> None:
+    with _stored_lock:
+        _stored.clear()
@@ -0,0 +1,35 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from common.constants import CANDLE_INTERVALS
+from apps.markets.ingest import MarketIngestor
+from apps.markets.kline_store import KLINE_INTERVAL_MS
+
+
+class Command(BaseCommand):
+    help = "Keep cached tickers and klines of the active markets current from the upstream streams"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--intervals",
+            default=",".join(i for i in CANDLE_INTERVALS if i in KLINE_INTERVAL_MS),
+            help="Comma-separated kline intervals to stream",
+        )
+        parser.add_argument(
+            "--flush-interval",
+            type=float,
+            default=1.0,
+            help="Seconds between writes to the cache and ticker publishes",
+        )
+
+    def handle(self, *args, **options):
+        intervals = [i for i in options["intervals"].split(",") if i]
+        unknown = [i for i in intervals if i not in KLINE_INTERVAL_MS]
+        if unknown:
+            raise CommandError(f"Unsupported intervals: {', '.join(unknown)}")
+        ingestor = MarketIngestor(intervals, flush_interval=options["flush_interval"])
+        try:
+            asyncio.run(ingestor.run())
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS("Stopped"))
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpstreamKline',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('symbol', models.CharField(max_length=20)),
+                ('interval', models.CharField(max_length=4)),
+                ('open_time', models.BigIntegerField()),
+                ('open', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('high', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('low', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('close', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('volume', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('close_time', models.BigIntegerField()),
+                ('quote_volume', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('trade_count', models.PositiveIntegerField()),
+                ('taker_buy_volume', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('taker_buy_quote_volume', models.DecimalField(decimal_places=8, max_digits=28)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('symbol', 'interval', 'open_time'), name='markets_upstreamkline_unique')],
+            },
+        ),
+    ]
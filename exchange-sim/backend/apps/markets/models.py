@@ -12,3 +12,29 @@ class Market(models.Model):
     base_asset = models.ForeignKey(Asset, on_delete=models.PROTECT, related_name="base_markets")
     quote_asset = models.ForeignKey(Asset, on_delete=models.PROTECT, related_name="quote_markets")
     is_active = models.BooleanField(default=True)
+
+
+class UpstreamKline(models.Model):
+    """A closed Binance kline, kept so later requests only fetch newer ones.
+
+    Times are epoch milliseconds, as the upstream sends them.
+    """
+
+    symbol = models.CharField(max_length=20)
+    interval = models.CharField(max_length=4)
+    open_time = models.BigIntegerField()
+    open = models.DecimalField(max_digits=28, decimal_places=8)
+    high = models.DecimalField(max_digits=28, decimal_places=8)
+    low = models.DecimalField(max_digits=28, decimal_places=8)
+    close = models.DecimalField(max_digits=28, decimal_places=8)
+    volume = models.DecimalField(max_digits=28, decimal_places=8)
+    close_time = models.BigIntegerField()
+    quote_volume = models.DecimalField(max_digits=28, decimal_places=8)
+    trade_count = models.PositiveIntegerField()
+    taker_buy_volume = models.DecimalField(max_digits=28, decimal_places=8)
+    taker_buy_quote_volume = models.DecimalField(max_digits=28, decimal_places=8)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["symbol", "interval", "open_time"], name="markets_upstreamkline_unique"),
+        ]
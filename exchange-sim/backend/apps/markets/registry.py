@@ -0,0 +1,121 @@
+import threading
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+CACHE_KEY_REGISTRY_VERSION = "markets:registry_version"
+
+
+@dataclass(frozen=True)
+class AssetInfo:
+    code: str
+    name: str
+    precision: int
+
+
+@dataclass(frozen=True)
+class MarketInfo:
+    symbol: str
+    base_asset: AssetInfo
+    quote_asset: AssetInfo
+    is_active: bool
+
+    @property
+    def base_code(self) -> str:
+        return self.base_asset.code
+
+    @property
+    def quote_code(self) -> str:
+        return self.quote_asset.code
+
+
+class _Snapshot:
+    def __init__(self, version, assets: dict, markets: dict):
+        self.version = version
+        self.assets = assets
+        self.markets = markets
+        self.loaded_at = self.checked_at = time.monotonic()
+
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+def _shared_version():
+    return cache.get(CACHE_KEY_REGISTRY_VERSION, 0)
+
+
+def _load() -> _Snapshot:
+    from .models import Asset, Market
+
+    version = _shared_version()
+    assets = {a.code: AssetInfo(a.code, a.name, a.precision) for a in Asset.objects.all()}
+    markets = {
+        symbol: MarketInfo(symbol, assets[base], assets[quote], is_active)
+        for symbol, base, quote, is_active in Market.objects.values_list(
+            "symbol", "base_asset__code", "quote_asset__code", "is_active"
+        )
+    }
+    return _Snapshot(version, assets, markets)
+
+
+def _current(force_check: bool = False) -> _Snapshot:
+    """This process's snapshot, reloaded when the shared version moves or it gets too old.
+
+    The age limit catches changes no signal reports, such as `QuerySet.update()`.
+    """
+    global _snapshot
+    snapshot = _snapshot
+    interval = getattr(settings, "MARKET_REGISTRY_CHECK_INTERVAL", 5)
+    max_age = getattr(settings, "MARKET_REGISTRY_MAX_AGE", 60)
+    if snapshot is not None and time.monotonic() - snapshot.loaded_at > max_age:
+        snapshot = None
+    if snapshot is not None and (force_check or time.monotonic() - snapshot.checked_at > interval):
+        if snapshot.version != _shared_version():
+            snapshot = None
+        else:
+            snapshot.checked_at = time.monotonic()
+    if snapshot is None:
+        with _lock:
+            snapshot = _snapshot = _load()
+    return snapshot
+
+
+def get_market(symbol: str) -> MarketInfo | None:
+    """Market metadata without a query; None if the symbol is unknown."""
+    market = _current().markets.get(symbol)
+    if market is None:
+        # It may have been created by another process since our last check.
+        market = _current(force_check=True).markets.get(symbol)
+    return market
+
+
+def get_asset(code: str) -> AssetInfo | None:
+    asset = _current().assets.get(code)
+    if asset is None:
+        asset = _current(force_check=True).assets.get(code)
+    return asset
+
+
+def active_markets() -> list:
+    return [m for m in _current().markets.values() if m.is_active]
+
+
+def _bump_shared_version() -> None:
+    global _snapshot
+    cache.add(CACHE_KEY_REGISTRY_VERSION, 0, None)
+    try:
+        cache.incr(CACHE_KEY_REGISTRY_VERSION)
+    except ValueError:
+        cache.set(CACHE_KEY_REGISTRY_VERSION, 1, None)
+    _snapshot = None
+
+
+def invalidate(**kwargs) -> None:
+    """Signal receiver: drop this process's copy now and tell the others on commit."""
+    global _snapshot
+    _snapshot = None
+    transaction.on_commit(_bump_shared_version, robust=True)
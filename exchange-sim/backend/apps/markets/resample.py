@@ -0,0 +1,106 @@
+"""OHLCV candles from a sampled price series, for any Binance kline interval.
+
+CoinGecko's market charts are (timestamp, price) points and a rolling 24h
+volume at each point, at 5-minute, hourly or daily spacing depending on the
+range asked for. `resample` buckets them into candles aligned like Binance's
+in one vectorized pass. Candles are kept as a structured array; `to_klines`
+formats only the rows that are served.
+"""
+import numpy as np
+
+from .kline_store import KLINE_INTERVAL_MS
+
+DAY_MS = 86_400_000
+# Binance weeks start on Monday; the epoch fell on a Thursday.
+WEEK_OFFSET_MS = 4 * DAY_MS
+
+KLINE_DTYPE = np.dtype([
+    ("open_time", "i8"),
+    ("open", "f8"),
+    ("high", "f8"),
+    ("low", "f8"),
+    ("close", "f8"),
+    ("volume", "f8"),
+    ("close_time", "i8"),
+    ("quote_volume", "f8"),
+])
+
+
+def is_supported(interval: str) -> bool:
+    return interval in KLINE_INTERVAL_MS or interval == "1M"
+
+
+def bucket_bounds(timestamps: np.ndarray, interval: str):
+    """Open and close time (epoch ms) of the candle each timestamp falls in."""
+    if interval == "1M":
+        months = timestamps.astype("datetime64[ms]").astype("datetime64[M]")
+        starts = months.astype("datetime64[ms]").astype(np.int64)
+        ends = (months + 1).astype("datetime64[ms]").astype(np.int64)
+        return starts, ends - 1
+    period = KLINE_INTERVAL_MS[interval]
+    offset = WEEK_OFFSET_MS if interval == "1w" else 0
+    starts = (timestamps - offset) // period * period + offset
+    return starts, starts + period - 1
+
+
+def resample(prices, volumes, interval: str) -> np.ndarray:
+    """Candles of `interval` from `[[ms, price], ...]` and `[[ms, rolling 24h quote volume], ...]`.
+
+    A candle's open and close are its first and last sample, high and low
+    the extremes in between; intervals without samples have no candle.
+    Volume is what the mean rolling 24h volume over the candle implies for its
+    length, in quote units, and in base units at the candle's mean price.
+    """
+    points = np.asarray(prices, dtype=np.float64).reshape(-1, 2)
+    if not len(points):
+        return np.empty(0, dtype=KLINE_DTYPE)
+    order = np.argsort(points[:, 0], kind="stable")
+    timestamps = points[order, 0].astype(np.int64)
+    price = points[order, 1]
+    volume_points = np.asarray(volumes, dtype=np.float64).reshape(-1, 2)
+    if len(volume_points):
+        volume_order = np.argsort(volume_points[:, 0], kind="stable")
+        volume_24h = np.interp(timestamps, volume_points[volume_order, 0], volume_points[volume_order, 1])
+    else:
+        volume_24h = np.zeros_like(price)
+
+    starts, ends = bucket_bounds(timestamps, interval)
+    first = np.flatnonzero(np.r_[True, starts[1:] != starts[:-1]])
+    last = np.r_[first[1:] - 1, len(timestamps) - 1]
+    counts = last - first + 1
+
+    candles = np.empty(len(first), dtype=KLINE_DTYPE)
+    candles["open_time"] = starts[first]
+    candles["close_time"] = ends[first]
+    candles["open"] = price[first]
+    candles["close"] = price[last]
+    candles["high"] = np.maximum.reduceat(price, first)
+    candles["low"] = np.minimum.reduceat(price, first)
+    span = (candles["close_time"] - candles["open_time"] + 1) / DAY_MS
+    candles["quote_volume"] = np.add.reduceat(volume_24h, first) / counts * span
+    mean_price = np.add.reduceat(price, first) / counts
+    candles["volume"] = np.divide(
+        candles["quote_volume"], mean_price, out=np.zeros(len(first)), where=mean_price > 0
+    )
+    return candles
+
+
+def to_klines(candles: np.ndarray) -> list:
+    """Rows in the Binance kline layout, prices at 8 places."""
+    return [
+        [
+            open_time,
+            f"{open_:.8f}",
+            f"{high:.8f}",
+            f"{low:.8f}",
+            f"{close:.8f}",
+            f"{volume:.8f}",
+            close_time,
+            f"{quote_volume:.8f}",
+            0,
+            "0.00000000",
+            "0.00000000",
+            "0",
+        ]
+        for open_time, open_, high, low, close, volume, close_time, quote_volume in candles.tolist()
+    ]
@@ -1,13 +1,21 @@
+import gzip
+import hashlib
+import json
 import logging
+import time
 import requests
-from django.core.cache import cache
-from django.conf import settings
+from dataclasses import dataclass
 from datetime import datetime
+from decimal import Decimal
 
-logger = logging.getLogger(__name__)
+import numpy as np
+
+from .coalesce import single_flight, store_many
+from .kline_store import KLINE_INTERVAL_MS, KLINES_MAX_LIMIT, fetch_tail, stored_klines
+from .resample import DAY_MS, is_supported, resample, to_klines
+from .upstream import binance_url, coingecko_url, get_client
 
-BINANCE_BASE = getattr(settings, "BINANCE_API_BASE", "https://api.binance.com")
-COINGECKO_BASE = "https://api.coingecko.com/api/v3"
+logger = logging.getLogger(__name__)
 
 # Coin mapping for CoinGecko
 COIN_MAP = {
@@ -21,149 +29,333 @@ COIN_MAP = {
 
 # Cache keys
 CACHE_KEY_EXCHANGE_INFO = "binance:exchange_info"
+CACHE_KEY_EXCHANGE_INFO_INDEX = "binance:exchange_info_index:{digest}"
 CACHE_KEY_TICKER_24H = "binance:ticker_24h:{symbol}"
+CACHE_KEY_TICKERS_24H = "binance:tickers_24h:{digest}"
 CACHE_KEY_KLINES = "binance:klines:{symbol}:{interval}"
+CACHE_KEY_KLINES_TAIL = "binance:klines_tail:{symbol}:{interval}"
 CACHE_KEY_COINGECKO = "coingecko:chart:{symbol}:{days}"
+CACHE_KEY_COINGECKO_CANDLES = "coingecko:candles:{symbol}:{days}:{interval}"
 
-# Cache timeouts (seconds)
+# Cache timeouts (seconds): served as-is until TIMEOUT_*, then served while
+# a background refresh runs, until STALE_* at the latest.
 TIMEOUT_EXCHANGE_INFO = 3600 * 6  # 6 hours
 TIMEOUT_TICKER_24H = 10           # 10 seconds
 TIMEOUT_KLINES = 30               # 30 seconds
 TIMEOUT_COINGECKO = 300           # 5 minutes
 
+STALE_EXCHANGE_INFO = 3600 * 24   # 1 day
+STALE_TICKER_24H = 60             # 1 minute
+STALE_KLINES = 300                # 5 minutes
+STALE_COINGECKO = 1800            # 30 minutes
+
+# CoinGecko ranges (days) the fallback fetches, so few charts get cached.
+COINGECKO_RANGES = (1, 7, 30, 90, 365)
+
 
 def get_exchange_info():
     """Returns Binance Exchange Info (symbols, filters). Cached."""
-    data = cache.get(CACHE_KEY_EXCHANGE_INFO)
-    if data:
-        return data
+    return single_flight(CACHE_KEY_EXCHANGE_INFO, TIMEOUT_EXCHANGE_INFO, STALE_EXCHANGE_INFO, _fetch_exchange_info)
+
 
+def _fetch_exchange_info():
     try:
-        url = f"{BINANCE_BASE}/api/v3/exchangeInfo"
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        cache.set(CACHE_KEY_EXCHANGE_INFO, data, TIMEOUT_EXCHANGE_INFO)
-        return data
+        return get_client().get_json(binance_url("/api/v3/exchangeInfo"))
     except Exception as e:
         logger.error(f"Error fetching exchange info: {e}")
         return None
 
 
+@dataclass(frozen=True)
+class SymbolFilters:
+    status: str
+    tick_size: Decimal
+    step_size: Decimal
+    min_price: Decimal
+    max_price: Decimal
+    min_qty: Decimal
+    max_qty: Decimal
+    min_notional: Decimal
+
+
+def _symbols_digest(symbols) -> str:
+    return hashlib.sha1(",".join(symbols).encode()).hexdigest()[:16]
+
+
+def _payload(data) -> dict:
+    """Serialize once per fetch: the JSON body, its gzip form and their ETag."""
+    body = json.dumps(data, separators=(",", ":")).encode()
+    return {
+        "body": body,
+        "gzip_body": gzip.compress(body, mtime=0),
+        "etag": f'"{hashlib.sha1(body).hexdigest()}"',
+    }
+
+
+def get_exchange_info_index(symbols):
+    """Trading rules of `symbols` only, ready to serve.
+
+    Returns `{"index", "body", "gzip_body", "etag"}` or None. `index` maps each
+    symbol the upstream lists to its status, tick and step size, and filters
+    keyed by filter type.
+    """
+    symbols = sorted(s.upper() for s in symbols)
+    key = CACHE_KEY_EXCHANGE_INFO_INDEX.format(digest=_symbols_digest(symbols))
+    return single_flight(key, TIMEOUT_EXCHANGE_INFO, STALE_EXCHANGE_INFO, lambda: _fetch_exchange_info_index(symbols))
+
+
+def _fetch_exchange_info_index(symbols):
+    if not symbols:
+        return {"index": {}, **_payload({"symbols": {}})}
+    try:
+        info = get_client().get_json(
+            binance_url("/api/v3/exchangeInfo"),
+            params={"symbols": json.dumps(symbols, separators=(",", ":"))},
+        )
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 400:
+            logger.error(f"Error fetching exchange info for {len(symbols)} symbols: {e}")
+            return None
+        # One symbol the upstream doesn't know fails the whole filtered call.
+        info = _fetch_exchange_info()
+    except Exception as e:
+        logger.error(f"Error fetching exchange info for {len(symbols)} symbols: {e}")
+        return None
+    if not info:
+        return None
+    wanted = set(symbols)
+    index = {}
+    for entry in info.get("symbols", []):
+        if entry["symbol"] not in wanted:
+            continue
+        filters = {f["filterType"]: f for f in entry.get("filters", [])}
+        index[entry["symbol"]] = {
+            "status": entry.get("status"),
+            "baseAsset": entry.get("baseAsset"),
+            "quoteAsset": entry.get("quoteAsset"),
+            "tickSize": filters.get("PRICE_FILTER", {}).get("tickSize"),
+            "stepSize": filters.get("LOT_SIZE", {}).get("stepSize"),
+            "filters": filters,
+        }
+    return {"index": index, **_payload({"symbols": index})}
+
+
+_filters = (None, {})
+
+
+def get_symbol_filters(symbol):
+    """Parsed tick/step and min/max rules of an active market, or None.
+
+    Parsed once per index fetch, so validating an order is a dict lookup.
+    """
+    from .registry import active_markets
+
+    global _filters
+    data = get_exchange_info_index([m.symbol for m in active_markets()])
+    if not data:
+        return None
+    etag, parsed = _filters
+    if etag != data["etag"]:
+        parsed = {s: _parse_filters(entry) for s, entry in data["index"].items()}
+        _filters = (data["etag"], parsed)
+    return parsed.get(symbol.upper())
+
+
+def _parse_filters(entry) -> SymbolFilters:
+    filters = entry["filters"]
+    price = filters.get("PRICE_FILTER", {})
+    lot = filters.get("LOT_SIZE", {})
+    notional = filters.get("NOTIONAL") or filters.get("MIN_NOTIONAL") or {}
+    return SymbolFilters(
+        status=entry["status"],
+        tick_size=Decimal(price.get("tickSize", "0")),
+        step_size=Decimal(lot.get("stepSize", "0")),
+        min_price=Decimal(price.get("minPrice", "0")),
+        max_price=Decimal(price.get("maxPrice", "0")),
+        min_qty=Decimal(lot.get("minQty", "0")),
+        max_qty=Decimal(lot.get("maxQty", "0")),
+        min_notional=Decimal(notional.get("minNotional", "0")),
+    )
+
+
 def get_ticker_24h(symbol):
     """Returns 24h ticker stats (volume, high, low, lastPrice)."""
     key = CACHE_KEY_TICKER_24H.format(symbol=symbol)
-    data = cache.get(key)
-    if data:
-        return data
+    return single_flight(key, TIMEOUT_TICKER_24H, STALE_TICKER_24H, lambda: _fetch_ticker_24h(symbol))
 
+
+def _fetch_ticker_24h(symbol):
     try:
-        url = f"{BINANCE_BASE}/api/v3/ticker/24hr"
-        response = requests.get(url, params={"symbol": symbol.upper()}, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        cache.set(key, data, TIMEOUT_TICKER_24H)
-        return data
+        return get_client().get_json(binance_url("/api/v3/ticker/24hr"), params={"symbol": symbol.upper()})
     except Exception as e:
         logger.error(f"Error fetching ticker 24h for {symbol}: {e}")
         return None
 
 
-def convert_coingecko_to_binance_format(coingecko_data):
-    """Convert CoinGecko market_chart data to Binance klines format"""
-    if not coingecko_data or 'prices' not in coingecko_data:
-        return []
-    
-    prices = coingecko_data['prices']
-    volumes = coingecko_data.get('total_volumes', [])
-    
-    # Group by hour and create OHLC candles
-    candles = []
-    for i in range(0, len(prices) - 1):
-        timestamp = int(prices[i][0])
-        price = prices[i][1]
-        next_price = prices[i + 1][1] if i + 1 < len(prices) else price
-        volume = volumes[i][1] if i < len(volumes) else 0
-        
-        # Binance kline format: [timestamp, open, high, low, close, volume, closeTime, ...]
-        candle = [
-            timestamp,
-            str(price),  # open
-            str(max(price, next_price)),  # high
-            str(min(price, next_price)),  # low
-            str(next_price),  # close
-            str(volume),
-            timestamp + 3600000,  # closeTime (1 hour later)
-            "0", "0", "0", "0", "0"  # unused fields
-        ]
-        candles.append(candle)
-    
-    return candles
-
-
-def get_klines_coingecko(symbol, days=7):
-    """Fetch chart data from CoinGecko (no region restrictions)"""
+def get_tickers_24h(symbols):
+    """24h tickers of `symbols` from one upstream call, ready to serve.
+
+    Returns `{"tickers", "body", "etag"}` with the JSON body rendered once per
+    fetch, or None. Symbols the upstream doesn't list are left out. Each ticker
+    also fills its per-symbol entry, so `get_ticker_24h` needn't fetch it again.
+    """
+    symbols = sorted(s.upper() for s in symbols)
+    if not symbols:
+        return {"tickers": [], "body": b"[]", "etag": '"empty"'}
+    key = CACHE_KEY_TICKERS_24H.format(digest=_symbols_digest(symbols))
+    return single_flight(key, TIMEOUT_TICKER_24H, STALE_TICKER_24H, lambda: _fetch_tickers_24h(symbols))
+
+
+def _fetch_tickers_24h(symbols):
+    url = binance_url("/api/v3/ticker/24hr")
+    try:
+        try:
+            tickers = get_client().get_json(url, params={"symbols": json.dumps(symbols, separators=(",", ":"))})
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 400:
+                raise
+            # One symbol the upstream doesn't know fails the whole filtered call.
+            wanted = set(symbols)
+            tickers = [t for t in get_client().get_json(url) if t["symbol"] in wanted]
+    except Exception as e:
+        logger.error(f"Error fetching 24h tickers for {len(symbols)} symbols: {e}")
+        return None
+    store_many(
+        {CACHE_KEY_TICKER_24H.format(symbol=t["symbol"]): t for t in tickers},
+        TIMEOUT_TICKER_24H,
+        STALE_TICKER_24H,
+    )
+    return {"tickers": tickers, **_payload(tickers)}
+
+
+def store_tickers(symbols, tickers, fresh_ttl=TIMEOUT_TICKER_24H):
+    """Cache tickers received some other way, e.g. from the upstream stream.
+
+    Fills the per-symbol entries and the `get_tickers_24h(symbols)` entry.
+    """
+    symbols = sorted(s.upper() for s in symbols)
+    wanted = set(symbols)
+    tickers = sorted((t for t in tickers if t["symbol"] in wanted), key=lambda t: t["symbol"])
+    values = {CACHE_KEY_TICKER_24H.format(symbol=t["symbol"]): t for t in tickers}
+    if symbols:
+        key = CACHE_KEY_TICKERS_24H.format(digest=_symbols_digest(symbols))
+        values[key] = {"tickers": tickers, **_payload(tickers)}
+    store_many(values, fresh_ttl, STALE_TICKER_24H)
+
+
+def get_coingecko_chart(symbol, days):
+    """CoinGecko price and rolling 24h volume samples as `(n, 2)` arrays of `[ms, value]`."""
     cache_key = CACHE_KEY_COINGECKO.format(symbol=symbol, days=days)
-    cached_data = cache.get(cache_key)
-    if cached_data:
-        return cached_data
-    
+    return single_flight(cache_key, TIMEOUT_COINGECKO, STALE_COINGECKO, lambda: _fetch_coingecko_chart(symbol, days))
+
+
+def _fetch_coingecko_chart(symbol, days):
     try:
         coin_id = COIN_MAP.get(symbol, 'bitcoin')
-        url = f"{COINGECKO_BASE}/coins/{coin_id}/market_chart"
-        params = {
-            "vs_currency": "usd",
-            "days": days,
-            "interval": "hourly"
+        url = coingecko_url(f"/coins/{coin_id}/market_chart")
+        # Spacing follows the range: 5-minute up to 1 day, hourly up to 90, then daily.
+        data = get_client().get_json(url, params={"vs_currency": "usd", "days": days})
+        chart = {
+            "prices": np.asarray(data.get("prices") or [], dtype=np.float64).reshape(-1, 2),
+            "volumes": np.asarray(data.get("total_volumes") or [], dtype=np.float64).reshape(-1, 2),
         }
-        
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        # Convert to Binance format
-        binance_format = convert_coingecko_to_binance_format(data)
-        cache.set(cache_key, binance_format, TIMEOUT_COINGECKO)
-        
-        logger.info(f"Successfully fetched {len(binance_format)} candles from CoinGecko for {symbol}")
-        return binance_format
-        
+        logger.info(f"Successfully fetched {len(chart['prices'])} prices from CoinGecko for {symbol}")
+        return chart if len(chart["prices"]) else None
     except Exception as e:
         logger.error(f"Error fetching CoinGecko data for {symbol}: {e}")
         return None
 
 
+def coingecko_days(interval, limit):
+    """The shortest of a few fixed CoinGecko ranges that covers `limit` candles."""
+    period = KLINE_INTERVAL_MS.get(interval, 30 * DAY_MS)
+    needed = limit * period / DAY_MS
+    return next((days for days in COINGECKO_RANGES if days >= needed), COINGECKO_RANGES[-1])
+
+
+def get_klines_coingecko(symbol, interval, days):
+    """CoinGecko data resampled to `interval` candles (see `resample`), as a structured array."""
+    cache_key = CACHE_KEY_COINGECKO_CANDLES.format(symbol=symbol, days=days, interval=interval)
+    candles = single_flight(
+        cache_key, TIMEOUT_COINGECKO, STALE_COINGECKO, lambda: _resample_coingecko(symbol, interval, days)
+    )
+    return candles["candles"] if candles else None
+
+
+def _resample_coingecko(symbol, interval, days):
+    chart = get_coingecko_chart(symbol, days)
+    if not chart:
+        return None
+    candles = resample(chart["prices"], chart["volumes"], interval)
+    # Wrapped so an empty array isn't tested for truth.
+    return {"candles": candles} if len(candles) else None
+
+
 def get_klines(symbol, interval, limit=500):
-    """Returns candlestick data. Falls back to CoinGecko if Binance fails."""
-    key = f"{CACHE_KEY_KLINES.format(symbol=symbol, interval=interval)}:{limit}"
-    data = cache.get(key)
-    if data:
-        return data
+    """Returns candlestick data. Falls back to CoinGecko if Binance fails.
+
+    Fixed-length intervals come from the stored series plus a cached tail, so
+    a warm request costs at most one small upstream call per interval and any
+    `limit` is a slice of the same data.
+    """
+    limit = max(1, min(limit, KLINES_MAX_LIMIT))
+    if interval not in KLINE_INTERVAL_MS:
+        key = f"{CACHE_KEY_KLINES.format(symbol=symbol, interval=interval)}:{limit}"
+        return single_flight(key, TIMEOUT_KLINES, STALE_KLINES, lambda: _fetch_klines(symbol, interval, limit))
+
+    symbol = symbol.upper()
+    key = CACHE_KEY_KLINES_TAIL.format(symbol=symbol, interval=interval)
+    tail = single_flight(key, _tail_fresh_ttl, STALE_KLINES, lambda: fetch_tail(symbol, interval))
+    if tail is not None:
+        return (stored_klines(symbol, interval, tail["last_closed"]) + tail["open"])[-limit:]
+    # Upstream down and nothing cached: what is stored beats the hourly fallback.
+    stored = stored_klines(symbol, interval)
+    if stored:
+        return stored[-limit:]
+    return _fetch_klines_fallback(symbol, interval, limit)
 
+
+def _tail_fresh_ttl(tail):
+    """Fresh until the tail's `refresh_at`: at most OPEN_KLINE_REFRESH_MS while a kline is open."""
+    return max(1, tail["refresh_at"] / 1000 - time.time())
+
+
+def store_kline_tails(tails, fresh_ttl):
+    """Cache `fetch_tail`-shaped tails keyed by (symbol, interval), e.g. built from the stream."""
+    store_many(
+        {
+            CACHE_KEY_KLINES_TAIL.format(symbol=symbol, interval=interval): tail
+            for (symbol, interval), tail in tails.items()
+        },
+        fresh_ttl,
+        STALE_KLINES,
+    )
+
+
+def _fetch_klines(symbol, interval, limit):
     # Try Binance first
     try:
-        url = f"{BINANCE_BASE}/api/v3/klines"
+        url = binance_url("/api/v3/klines")
         params = {
             "symbol": symbol.upper(),
             "interval": interval,
             "limit": limit
         }
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        cache.set(key, data, TIMEOUT_KLINES)
+        data = get_client().get_json(url, params=params)
         logger.info(f"Successfully fetched {len(data)} candles from Binance for {symbol}")
         return data
     except Exception as e:
         logger.warning(f"Binance API failed for {symbol}: {e}. Falling back to CoinGecko...")
-        
-        # Fallback to CoinGecko
-        coingecko_data = get_klines_coingecko(symbol, days=7)
-        if coingecko_data:
-            # Limit to requested amount
-            limited_data = coingecko_data[-limit:] if len(coingecko_data) > limit else coingecko_data
-            cache.set(key, limited_data, TIMEOUT_KLINES)
-            return limited_data
-        
-        logger.error(f"Both Binance and CoinGecko failed for {symbol}")
+        return _fetch_klines_fallback(symbol, interval, limit)
+
+
+def _fetch_klines_fallback(symbol, interval, limit):
+    if not is_supported(interval):
+        logger.error(f"Binance failed for {symbol} and CoinGecko can't provide {interval} candles")
         return None
+    candles = get_klines_coingecko(symbol, interval, coingecko_days(interval, limit))
+    if candles is not None:
+        return to_klines(candles[-limit:])
+
+    logger.error(f"Both Binance and CoinGecko failed for {symbol}")
+    return None
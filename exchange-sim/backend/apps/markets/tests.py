@@ -1 +1,915 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import threading
+import time
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed, InvalidStatus
+
+from apps.users.models import User
+
+from . import ingest, registry, services, views
+from .ingest import MarketIngestor, open_stream
+from .kline_store import OPEN_KLINE_REFRESH_MS, discard_stored_klines, from_kline, tail_refresh_at
+from .resample import resample, to_klines
+from .models import Asset, Market, UpstreamKline
+from .coalesce import CACHE_KEY_FLIGHT_LOCK, Envelope, get_metrics, single_flight
+from .upstream import reset_client
+
+KLINE = [
+    1700000000000, "1.00000000", "2.00000000", "0.50000000", "1.50000000", "10.00000000",
+    1700000059999, "15.00000000", 3, "0.00000000", "0.00000000", "0",
+]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.server.requests.append((url.path, self.client_address))
+        status, body, delay = self.server.routes.get(url.path, (404, {"msg": "not found"}, 0))
+        if delay:
+            time.sleep(delay)
+        if callable(body):
+            status, body = body(dict(parse_qsl(url.query)))
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubUpstream:
+    """A local HTTP server standing in for Binance and CoinGecko."""
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.routes = {}
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    @property
+    def requests(self) -> list:
+        return self.server.requests
+
+    def route(self, path: str, body, status: int = 200, delay: float = 0) -> None:
+        """Serve `body` at `path`; a callable body gets the query and returns `(status, body)`."""
+        self.server.routes[path] = (status, body, delay)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubUpstreamTestCase(SimpleTestCase):
+    """Points the upstream client at a fresh stub server with an empty cache."""
+
+    extra_settings = {}
+
+    def setUp(self):
+        self.stub = StubUpstream().__enter__()
+        self.addCleanup(self.stub.__exit__)
+        settings = override_settings(
+            BINANCE_API_BASE=self.stub.base,
+            COINGECKO_API_BASE=self.stub.base + "/cg",
+            **self.extra_settings,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        reset_client()
+        self.addCleanup(reset_client)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+
+class UpstreamClientTests(StubUpstreamTestCase, TransactionTestCase):
+    extra_settings = {"UPSTREAM_READ_TIMEOUT": 1.5}
+
+    def test_connections_are_reused_across_cache_misses(self):
+        self.stub.route("/api/v3/ticker/24hr", {"symbol": "BTCUSDT", "lastPrice": "1"})
+        self.stub.route("/api/v3/klines", [KLINE])
+        self.stub.route("/api/v3/exchangeInfo", {"symbols": []})
+
+        self.assertEqual(services.get_ticker_24h("btcusdt")["lastPrice"], "1")
+        self.assertEqual(services.get_klines("BTCUSDT", "1m", 10), [KLINE])
+        self.assertEqual(services.get_exchange_info(), {"symbols": []})
+
+        self.assertEqual(len(self.stub.requests), 3)
+        self.assertEqual(len({address for _, address in self.stub.requests}), 1)
+
+    def test_slow_upstream_times_out(self):
+        self.stub.route("/api/v3/ticker/24hr", {"lastPrice": "1"}, delay=3)
+        started = time.monotonic()
+        self.assertIsNone(services.get_ticker_24h("BTCUSDT"))
+        self.assertLess(time.monotonic() - started, 2.5)
+
+    def test_klines_fall_back_to_coingecko(self):
+        self.stub.route("/api/v3/klines", {"msg": "restricted"}, status=451)
+        self.stub.route("/cg/coins/bitcoin/market_chart", {
+            "prices": [[1700000000000, 10.0], [1700003600000, 12.0], [1700007200000, 11.0]],
+            "total_volumes": [[1700000000000, 5.0], [1700003600000, 6.0], [1700007200000, 7.0]],
+        })
+        data = services.get_klines("BTCUSDT", "1h", 2)
+        self.assertEqual([k[0] for k in data], [1699999200000 + HOUR_MS, 1699999200000 + 2 * HOUR_MS])
+        self.assertEqual(data[1][1:5], ["11.00000000"] * 4)
+        self.assertEqual(data[1][6], 1699999200000 + 3 * HOUR_MS - 1)
+        self.assertEqual([path for path, _ in self.stub.requests], ["/api/v3/klines", "/cg/coins/bitcoin/market_chart"])
+
+    def test_async_views_fetch_concurrently(self):
+        self.stub.route("/api/v3/ticker/24hr", {"lastPrice": "1"}, delay=1)
+        self.stub.route("/api/v3/klines", [KLINE], delay=1)
+
+        factory = AsyncRequestFactory()
+
+        async def fetch_both():
+            # Views are awaited directly: the test client runs one request at a time.
+            return await asyncio.gather(
+                views.Ticker24hView.as_view()(factory.get("/"), symbol="BTCUSDT"),
+                views.KlinesView.as_view()(factory.get("/", {"interval": "1m", "limit": "1"}), symbol="BTCUSDT"),
+            )
+
+        started = time.monotonic()
+        ticker, klines = async_to_sync(fetch_both)()
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(ticker.status_code, 200)
+        self.assertEqual(json.loads(ticker.content), {"lastPrice": "1"})
+        self.assertEqual(json.loads(klines.content), [KLINE])
+        self.assertLess(elapsed, 1.8)
+
+    def test_async_view_reports_upstream_failure(self):
+        self.stub.route("/api/v3/exchangeInfo", {"msg": "down"}, status=503)
+        Market.objects.create(
+            symbol="BTCUSDT",
+            base_asset=Asset.objects.create(code="BTC", name="Bitcoin"),
+            quote_asset=Asset.objects.create(code="USDT", name="Tether"),
+        )
+
+        response = async_to_sync(self.async_client.get)("/api/markets/exchange-info/")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), {"error": "Service unavailable"})
+
+
+class SingleFlightTests(StubUpstreamTestCase):
+    extra_settings = {"MARKET_DATA_LOCK_TIMEOUT": 2}
+
+    def call_concurrently(self, func, count: int) -> list:
+        results = [None] * count
+
+        def run(i):
+            results[i] = func()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_misses_fetch_once(self):
+        self.stub.route("/api/v3/ticker/24hr", {"lastPrice": "1"}, delay=0.3)
+        results = self.call_concurrently(lambda: services.get_ticker_24h("BTCUSDT"), 8)
+        self.assertEqual(results, [{"lastPrice": "1"}] * 8)
+        self.assertEqual(len(self.stub.requests), 1)
+        metrics = get_metrics()
+        self.assertEqual((metrics["upstream_fetches"], metrics["coalesced"]), (1, 7))
+
+    def test_failed_fetch_is_shared_and_not_cached(self):
+        self.stub.route("/api/v3/ticker/24hr", {"msg": "down"}, status=500, delay=0.3)
+        results = self.call_concurrently(lambda: services.get_ticker_24h("BTCUSDT"), 4)
+        self.assertEqual(results, [None] * 4)
+        self.assertEqual(len(self.stub.requests), 1)
+
+        self.stub.route("/api/v3/ticker/24hr", {"lastPrice": "2"})
+        self.assertEqual(services.get_ticker_24h("BTCUSDT"), {"lastPrice": "2"})
+
+    def test_follower_that_times_out_is_not_counted_as_coalesced(self):
+        self.stub.route("/api/v3/ticker/24hr", {"lastPrice": "1"}, delay=0.5)
+        with override_settings(MARKET_DATA_LOCK_TIMEOUT=0.1):
+            results = self.call_concurrently(lambda: services.get_ticker_24h("BTCUSDT"), 2)
+        self.assertEqual(sorted(results, key=bool), [None, {"lastPrice": "1"}])
+        metrics = get_metrics()
+        self.assertEqual((metrics["coalesced"], metrics["lock_wait_timeouts"]), (0, 1))
+
+    def test_leader_does_not_release_a_lock_taken_over_by_another(self):
+        key = services.CACHE_KEY_TICKER_24H.format(symbol="BTCUSDT")
+        lock_key = CACHE_KEY_FLIGHT_LOCK.format(key=key)
+
+        def slow_fetch():
+            # Our lock expired during the fetch and another leader took it.
+            cache.set(lock_key, "other", 10)
+            return {"lastPrice": "1"}
+
+        self.assertEqual(single_flight(key, 10, 60, slow_fetch), {"lastPrice": "1"})
+        self.assertEqual(cache.get(lock_key), "other")
+
+    def test_waits_for_fetch_in_another_process(self):
+        self.stub.route("/api/v3/ticker/24hr", {"lastPrice": "1"})
+        key = services.CACHE_KEY_TICKER_24H.format(symbol="BTCUSDT")
+        # Another process holds the lock and stores the value shortly after.
+        cache.add(CACHE_KEY_FLIGHT_LOCK.format(key=key), 1, 10)
+        value = Envelope({"lastPrice": "other"}, time.time() + 10, time.time() + 60)
+        threading.Timer(0.2, cache.set, args=(key, value, 60)).start()
+
+        self.assertEqual(services.get_ticker_24h("BTCUSDT"), {"lastPrice": "other"})
+        self.assertEqual(self.stub.requests, [])
+        self.assertEqual(get_metrics()["coalesced"], 1)
+
+    def test_stuck_lock_holder_is_not_waited_on_forever(self):
+        self.stub.route("/api/v3/ticker/24hr", {"lastPrice": "1"})
+        key = services.CACHE_KEY_TICKER_24H.format(symbol="BTCUSDT")
+        cache.add(CACHE_KEY_FLIGHT_LOCK.format(key=key), 1, 10)
+
+        self.assertEqual(services.get_ticker_24h("BTCUSDT"), {"lastPrice": "1"})
+        metrics = get_metrics()
+        self.assertEqual((metrics["upstream_fetches"], metrics["lock_wait_timeouts"]), (1, 1))
+
+
+class MarketDataMetricsViewTests(TestCase):
+    def test_metrics_are_for_staff_only(self):
+        client = APIClient()
+        self.assertEqual(client.get("/api/markets/metrics/").status_code, 401)
+        client.force_authenticate(User.objects.create_user("trader"))
+        self.assertEqual(client.get("/api/markets/metrics/").status_code, 403)
+        client.force_authenticate(User.objects.create_user("ops", is_staff=True))
+        response = client.get("/api/markets/metrics/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("upstream_fetches", response.json())
+
+
+class StaleWhileRevalidateTests(StubUpstreamTestCase):
+    key = services.CACHE_KEY_TICKER_24H.format(symbol="BTCUSDT")
+
+    def cache_ticker(self, data, age: float, stale_ttl: float = services.STALE_TICKER_24H) -> None:
+        """Store `data` as if fetched `age` seconds ago."""
+        fetched = time.time() - age
+        envelope = Envelope(data, fetched + services.TIMEOUT_TICKER_24H, fetched + stale_ttl)
+        cache.set(self.key, envelope, envelope.stale_until - time.time())
+
+    def wait_for_refresh(self) -> None:
+        deadline = time.monotonic() + 3
+        while time.monotonic() < deadline:
+            envelope = cache.get(self.key)
+            if envelope is not None and envelope.fresh_until > time.time() + services.TIMEOUT_TICKER_24H - 1:
+                return
+            time.sleep(0.02)
+        self.fail("background refresh did not complete")
+
+    def wait_for_failed_refresh(self) -> None:
+        deadline = time.monotonic() + 3
+        while get_metrics()["refresh_failures"] == 0:
+            if time.monotonic() > deadline:
+                self.fail("background refresh did not fail")
+            time.sleep(0.02)
+
+    def test_stale_value_is_served_while_refreshing(self):
+        self.stub.route("/api/v3/ticker/24hr", {"lastPrice": "new"}, delay=0.5)
+        self.cache_ticker({"lastPrice": "old"}, age=20)
+
+        started = time.monotonic()
+        self.assertEqual(services.get_ticker_24h("BTCUSDT"), {"lastPrice": "old"})
+        self.assertEqual(services.get_ticker_24h("BTCUSDT"), {"lastPrice": "old"})
+        self.assertLess(time.monotonic() - started, 0.25)
+
+        self.wait_for_refresh()
+        self.assertEqual(services.get_ticker_24h("BTCUSDT"), {"lastPrice": "new"})
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(get_metrics()["stale_served"], 2)
+
+    def test_fresh_value_is_not_refreshed(self):
+        self.cache_ticker({"lastPrice": "old"}, age=1)
+        self.assertEqual(services.get_ticker_24h("BTCUSDT"), {"lastPrice": "old"})
+        time.sleep(0.1)
+        self.assertEqual(self.stub.requests, [])
+
+    def test_failed_refresh_keeps_serving_stale_value(self):
+        self.stub.route("/api/v3/ticker/24hr", {"msg": "down"}, status=500)
+        self.cache_ticker({"lastPrice": "old"}, age=20)
+
+        self.assertEqual(services.get_ticker_24h("BTCUSDT"), {"lastPrice": "old"})
+        self.wait_for_failed_refresh()
+        # Retried only after a delay, not on every request in between.
+        self.assertEqual(services.get_ticker_24h("BTCUSDT"), {"lastPrice": "old"})
+        time.sleep(0.1)
+        self.assertEqual(len(self.stub.requests), 1)
+
+        response = async_to_sync(views.Ticker24hView.as_view())(AsyncRequestFactory().get("/"), symbol="BTCUSDT")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {"lastPrice": "old"})
+
+    def test_value_past_stale_ttl_is_not_served(self):
+        self.stub.route("/api/v3/ticker/24hr", {"msg": "down"}, status=500)
+        self.cache_ticker({"lastPrice": "old"}, age=20, stale_ttl=20.2)
+        time.sleep(0.3)
+
+        self.assertIsNone(services.get_ticker_24h("BTCUSDT"))
+        self.assertEqual(len(self.stub.requests), 1)
+
+
+def ticker(symbol: str, price: str) -> dict:
+    return {"symbol": symbol, "lastPrice": price, "priceChangePercent": "1.5"}
+
+
+class BulkTickerTests(StubUpstreamTestCase, TestCase):
+    def setUp(self):
+        super().setUp()
+        usdt = Asset.objects.create(code="USDT", name="Tether")
+        for code in ("BTC", "ETH", "DOGE"):
+            Market.objects.create(
+                symbol=f"{code}USDT",
+                base_asset=Asset.objects.create(code=code, name=code),
+                quote_asset=usdt,
+                is_active=code != "DOGE",
+            )
+
+    def route_tickers(self, known=("BTCUSDT", "ETHUSDT", "XRPUSDT")):
+        def tickers(query):
+            if "symbols" not in query:
+                return 200, [ticker(symbol, "1") for symbol in known]
+            wanted = json.loads(query["symbols"])
+            if set(wanted) - set(known):
+                return 400, {"code": -1121, "msg": "Invalid symbol."}
+            return 200, [ticker(symbol, "1") for symbol in wanted]
+
+        self.stub.route("/api/v3/ticker/24hr", tickers)
+
+    def get_tickers(self, **headers):
+        request = AsyncRequestFactory().get("/", headers=headers)
+        return async_to_sync(views.TickersView.as_view())(request)
+
+    def test_one_upstream_call_fills_per_symbol_entries(self):
+        self.route_tickers()
+        data = services.get_tickers_24h(["ETHUSDT", "BTCUSDT"])
+        self.assertEqual([t["symbol"] for t in data["tickers"]], ["BTCUSDT", "ETHUSDT"])
+        self.assertEqual(services.get_ticker_24h("ETHUSDT"), ticker("ETHUSDT", "1"))
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_unknown_symbol_falls_back_to_all_tickers(self):
+        self.route_tickers(known=("BTCUSDT", "XRPUSDT"))
+        data = services.get_tickers_24h(["BTCUSDT", "ETHUSDT"])
+        self.assertEqual(data["tickers"], [ticker("BTCUSDT", "1")])
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_endpoint_serves_active_markets_with_etag(self):
+        self.route_tickers()
+        response = self.get_tickers()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([t["symbol"] for t in json.loads(response.content)], ["BTCUSDT", "ETHUSDT"])
+        etag = response["ETag"]
+
+        response = self.get_tickers(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_endpoint_reports_upstream_failure(self):
+        self.stub.route("/api/v3/ticker/24hr", {"msg": "down"}, status=500)
+        self.assertEqual(self.get_tickers().status_code, 503)
+
+
+def symbol_info(symbol: str) -> dict:
+    return {
+        "symbol": symbol,
+        "status": "TRADING",
+        "baseAsset": symbol[:-4],
+        "quoteAsset": "USDT",
+        "permissions": ["SPOT"],
+        "orderTypes": ["LIMIT", "MARKET"],
+        "filters": [
+            {"filterType": "PRICE_FILTER", "minPrice": "0.01000000", "maxPrice": "1000000.00000000", "tickSize": "0.01000000"},
+            {"filterType": "LOT_SIZE", "minQty": "0.00001000", "maxQty": "9000.00000000", "stepSize": "0.00001000"},
+            {"filterType": "NOTIONAL", "minNotional": "5.00000000"},
+        ],
+    }
+
+
+class ExchangeInfoIndexTests(StubUpstreamTestCase, TestCase):
+    def setUp(self):
+        super().setUp()
+        usdt = Asset.objects.create(code="USDT", name="Tether")
+        for code in ("BTC", "ETH"):
+            Market.objects.create(
+                symbol=f"{code}USDT", base_asset=Asset.objects.create(code=code, name=code), quote_asset=usdt
+            )
+        services._filters = (None, {})
+
+    def route_exchange_info(self, known=("BTCUSDT", "ETHUSDT", "XRPUSDT")):
+        def exchange_info(query):
+            wanted = json.loads(query["symbols"]) if "symbols" in query else known
+            if set(wanted) - set(known):
+                return 400, {"code": -1121, "msg": "Invalid symbol."}
+            return 200, {"timezone": "UTC", "rateLimits": [], "symbols": [symbol_info(s) for s in wanted]}
+
+        self.stub.route("/api/v3/exchangeInfo", exchange_info)
+
+    def get_exchange_info(self, **headers):
+        request = AsyncRequestFactory().get("/", headers=headers)
+        return async_to_sync(views.ExchangeInfoView.as_view())(request)
+
+    def test_index_keeps_only_requested_symbols_and_rules(self):
+        self.route_exchange_info()
+        index = services.get_exchange_info_index(["ETHUSDT", "BTCUSDT"])["index"]
+        self.assertEqual(sorted(index), ["BTCUSDT", "ETHUSDT"])
+        self.assertEqual(index["BTCUSDT"]["tickSize"], "0.01000000")
+        self.assertEqual(index["BTCUSDT"]["filters"]["NOTIONAL"]["minNotional"], "5.00000000")
+        self.assertNotIn("orderTypes", index["BTCUSDT"])
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_unknown_symbol_falls_back_to_full_list(self):
+        self.route_exchange_info(known=("BTCUSDT", "XRPUSDT"))
+        index = services.get_exchange_info_index(["BTCUSDT", "ETHUSDT"])["index"]
+        self.assertEqual(list(index), ["BTCUSDT"])
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_endpoint_serves_gzip_with_its_own_etag(self):
+        self.route_exchange_info()
+        plain = self.get_exchange_info()
+        self.assertEqual(plain.status_code, 200)
+        self.assertNotIn("Content-Encoding", plain)
+        self.assertEqual(sorted(json.loads(plain.content)["symbols"]), ["BTCUSDT", "ETHUSDT"])
+
+        zipped = self.get_exchange_info(accept_encoding="br, gzip")
+        self.assertEqual(zipped["Content-Encoding"], "gzip")
+        self.assertEqual(zipped["Vary"], "Accept-Encoding")
+        self.assertEqual(gzip.decompress(zipped.content), plain.content)
+        self.assertNotEqual(zipped["ETag"], plain["ETag"])
+
+        response = self.get_exchange_info(accept_encoding="gzip", if_none_match=zipped["ETag"])
+        self.assertEqual(response.status_code, 304)
+        # The identity ETag doesn't validate the compressed representation.
+        response = self.get_exchange_info(accept_encoding="gzip", if_none_match=plain["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_symbol_filters_are_parsed_once_per_fetch(self):
+        self.route_exchange_info()
+        filters = services.get_symbol_filters("btcusdt")
+        self.assertEqual(filters.tick_size, Decimal("0.01"))
+        self.assertEqual(filters.step_size, Decimal("0.00001"))
+        self.assertEqual(filters.min_notional, Decimal("5"))
+        self.assertIs(services.get_symbol_filters("BTCUSDT"), filters)
+        self.assertIsNone(services.get_symbol_filters("XRPUSDT"))
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_endpoint_reports_upstream_failure(self):
+        self.stub.route("/api/v3/exchangeInfo", {"msg": "down"}, status=500)
+        self.assertEqual(self.get_exchange_info().status_code, 503)
+
+
+HOUR_MS = 3_600_000
+
+
+class ResampleTests(SimpleTestCase):
+    def test_samples_are_bucketed_into_aligned_candles(self):
+        prices = [[HOUR_MS + 60_000 * i, price] for i, price in enumerate([5, 7, 4, 6, 8])]
+        prices += [[2 * HOUR_MS + 1, 9], [4 * HOUR_MS, 3]]
+        candles = resample(prices, [], "1h")
+        self.assertEqual(candles["open_time"].tolist(), [HOUR_MS, 2 * HOUR_MS, 4 * HOUR_MS])
+        self.assertEqual(candles["close_time"].tolist(), [2 * HOUR_MS - 1, 3 * HOUR_MS - 1, 5 * HOUR_MS - 1])
+        self.assertEqual(to_klines(candles[:1])[0][1:5], ["5.00000000", "8.00000000", "4.00000000", "8.00000000"])
+        self.assertEqual(candles[1][["open", "high", "low", "close"]].tolist(), (9, 9, 9, 9))
+
+    def test_unordered_samples_give_the_same_candles(self):
+        prices = [[i * 300_000, float(i % 7)] for i in range(100)]
+        candles = resample(prices, [], "15m")
+        np.testing.assert_array_equal(resample(prices[::-1], [], "15m"), candles)
+        self.assertEqual(len(candles), 34)
+
+    def test_volume_is_the_rolling_24h_volume_prorated(self):
+        prices = [[0, 2.0], [HOUR_MS // 2, 2.0]]
+        volumes = [[0, 2400.0], [HOUR_MS // 2, 2400.0]]
+        candle = resample(prices, volumes, "1h")[0]
+        self.assertAlmostEqual(candle["quote_volume"], 100.0)
+        self.assertAlmostEqual(candle["volume"], 50.0)
+
+    def test_weeks_start_on_monday_and_months_on_the_first(self):
+        # 2024-01-10 (a Wednesday) and 2024-02-29.
+        wednesday, leap_day = 1704844800000, 1709164800000
+        week = resample([[wednesday, 1.0]], [], "1w")[0]
+        self.assertEqual(week["open_time"], 1704672000000)
+        month = resample([[leap_day, 1.0]], [], "1M")[0]
+        self.assertEqual(month["open_time"], 1706745600000)
+        self.assertEqual(month["close_time"], 1709251200000 - 1)
+
+    def test_fallback_range_covers_the_limit(self):
+        self.assertEqual(services.coingecko_days("1h", 24), 1)
+        self.assertEqual(services.coingecko_days("1h", 500), 30)
+        self.assertEqual(services.coingecko_days("1d", 1000), 365)
+
+
+def hour_kline(open_time: int) -> list:
+    return [
+        open_time, "1.00000000", "2.00000000", "0.50000000", "1.50000000", "10.00000000",
+        open_time + HOUR_MS - 1, "15.00000000", 3, "5.00000000", "7.50000000", "0",
+    ]
+
+
+def hour_klines(query):
+    """Hourly klines up to the one in progress, like the upstream's."""
+    now = int(time.time() * 1000)
+    current = now - now % HOUR_MS
+    limit = int(query.get("limit", 500))
+    if "startTime" in query:
+        start = int(query["startTime"])
+        start += -start % HOUR_MS
+        times = list(range(start, current + 1, HOUR_MS))[:limit]
+    else:
+        times = list(range(current - (limit - 1) * HOUR_MS, current + 1, HOUR_MS))
+    return 200, [hour_kline(t) for t in times]
+
+
+class KlineStoreTests(StubUpstreamTestCase, TransactionTestCase):
+    tail_key = services.CACHE_KEY_KLINES_TAIL.format(symbol="BTCUSDT", interval="1h")
+
+    def setUp(self):
+        super().setUp()
+        discard_stored_klines()
+        self.addCleanup(discard_stored_klines)
+        self.queries = []
+        self.stub.route("/api/v3/klines", self.klines)
+
+    def klines(self, query):
+        self.queries.append(query)
+        return hour_klines(query)
+
+    def expire_tail(self) -> None:
+        cache.delete(self.tail_key)
+
+    def test_any_limit_is_served_from_one_fetch(self):
+        data = services.get_klines("BTCUSDT", "1h", 500)
+        self.assertEqual(len(data), 500)
+        self.assertGreater(data[-1][6], time.time() * 1000)
+        self.assertEqual(UpstreamKline.objects.count(), 999)
+
+        everything = services.get_klines("BTCUSDT", "1h", 1000)
+        self.assertEqual(everything[-500:], data)
+        self.assertEqual(len(everything), 1000)
+        self.assertEqual([k[0] for k in everything], list(range(everything[0][0], everything[-1][0] + 1, HOUR_MS)))
+        self.assertEqual(services.get_klines("BTCUSDT", "1h", 5000), everything)
+        self.assertEqual(len(self.queries), 1)
+
+    def test_refresh_fetches_only_newer_klines(self):
+        before = services.get_klines("BTCUSDT", "1h", 1000)
+        newest = UpstreamKline.objects.order_by("-open_time")[:3]
+        UpstreamKline.objects.filter(pk__in=[row.pk for row in newest]).delete()
+        self.expire_tail()
+
+        self.assertEqual(services.get_klines("BTCUSDT", "1h", 1000), before)
+        self.assertEqual(len(self.queries), 2)
+        self.assertEqual(int(self.queries[1]["startTime"]), before[-4][0])
+        self.assertEqual(UpstreamKline.objects.count(), 999)
+
+    def test_long_gap_starts_the_series_over(self):
+        now = int(time.time() * 1000)
+        from_kline("BTCUSDT", "1h", hour_kline(now - now % HOUR_MS - 5000 * HOUR_MS)).save()
+        data = services.get_klines("BTCUSDT", "1h", 1000)
+        self.assertEqual(len(data), 1000)
+        self.assertEqual(len(self.queries), 2)
+        self.assertNotIn("startTime", self.queries[1])
+        self.assertEqual(UpstreamKline.objects.count(), 999)
+
+    def test_open_kline_is_refreshed_before_it_closes(self):
+        services.get_klines("BTCUSDT", "1h", 10)
+        envelope = cache.get(self.tail_key)
+        self.assertLessEqual(envelope.fresh_until, time.time() + OPEN_KLINE_REFRESH_MS / 1000)
+
+        now = 1_700_000_000_000
+        week = [now - 86_400_000, "1", "1", "1", "1", "1", now + 5 * 86_400_000, "1", 1, "0", "0", "0"]
+        self.assertEqual(tail_refresh_at("1w", None, [week], now), now + OPEN_KLINE_REFRESH_MS)
+        week[6] = now + 4_999
+        self.assertEqual(tail_refresh_at("1w", None, [week], now), now + 5_000)
+
+    def test_stored_klines_are_served_while_upstream_is_down(self):
+        before = services.get_klines("BTCUSDT", "1h", 100)
+        self.stub.route("/api/v3/klines", {"msg": "down"}, status=500)
+        self.stub.route("/cg/coins/bitcoin/market_chart", {"msg": "down"}, status=500)
+        self.expire_tail()
+
+        self.assertEqual(services.get_klines("BTCUSDT", "1h", 99), before[:-1][-99:])
+
+
+class StubStream:
+    """A local WebSocket server standing in for the Binance combined streams."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.clients = []
+        self.connections = []
+        self.server = self.loop.run_until_complete(self._serve())
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def _serve(self):
+        return await serve(self.handle, "127.0.0.1", 0)
+
+    @property
+    def base(self) -> str:
+        return f"ws://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+
+    async def handle(self, connection):
+        query = dict(parse_qsl(urlsplit(connection.request.path).query))
+        client = (query["streams"].split("/"), connection)
+        self.connections.append(client[0])
+        self.clients.append(client)
+        try:
+            await connection.wait_closed()
+        finally:
+            self.clients.remove(client)
+
+    def push(self, stream: str, data: dict) -> None:
+        """Send an event to the connections subscribed to `stream`."""
+        message = json.dumps({"stream": stream, "data": data})
+
+        def send():
+            for streams, connection in self.clients:
+                if stream in streams:
+                    self.loop.create_task(connection.send(message))
+
+        self.loop.call_soon_threadsafe(send)
+
+    def drop(self) -> None:
+        """Cut every connection without a closing handshake."""
+        self.loop.call_soon_threadsafe(lambda: [connection.transport.abort() for _, connection in self.clients])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+    async def _close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def wait_until(predicate, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the condition")
+        time.sleep(0.02)
+
+
+def ticker_event(symbol: str, price: str) -> dict:
+    return {
+        "e": "24hrTicker", "E": 1, "s": symbol, "p": "0", "P": "0", "w": price, "x": price, "c": price,
+        "Q": "1", "b": price, "B": "1", "a": price, "A": "1", "o": price, "h": price, "l": price,
+        "v": "10", "q": "100", "O": 0, "C": 1, "F": 1, "L": 2, "n": 2,
+    }
+
+
+def kline_event(symbol: str, open_time: int, close: str, closed: bool) -> dict:
+    k = hour_kline(open_time)
+    return {
+        "e": "kline", "E": 1, "s": symbol,
+        "k": {
+            "t": k[0], "T": k[6], "s": symbol, "i": "1h", "f": 1, "L": 2, "o": k[1], "c": close, "h": k[2],
+            "l": k[3], "v": k[5], "n": k[8], "x": closed, "q": k[7], "V": k[9], "Q": k[10], "B": "0",
+        },
+    }
+
+
+class MarketIngestTests(StubUpstreamTestCase, TransactionTestCase):
+    extra_settings = {"CHANNEL_LAYERS": {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}}
+
+    def setUp(self):
+        super().setUp()
+        discard_stored_klines()
+        self.addCleanup(discard_stored_klines)
+        self.stream = StubStream().__enter__()
+        self.addCleanup(self.stream.__exit__)
+        settings = override_settings(BINANCE_STREAM_BASE=self.stream.base)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.stub.route("/api/v3/klines", hour_klines)
+        usdt = Asset.objects.create(code="USDT", name="Tether")
+        for code in ("BTC", "ETH"):
+            Market.objects.create(
+                symbol=f"{code}USDT", base_asset=Asset.objects.create(code=code, name=code), quote_asset=usdt
+            )
+        self.layer = get_channel_layer()
+        async_to_sync(self.layer.group_add)("market_BTCUSDT_ticker", "listener")
+
+    def start_ingestor(self) -> MarketIngestor:
+        ingestor = MarketIngestor(["1h"], flush_interval=0.05)
+        thread = threading.Thread(target=asyncio.run, args=(ingestor.run(),), daemon=True)
+        thread.start()
+
+        def stop():
+            ingestor.stop()
+            thread.join(5)
+
+        self.addCleanup(stop)
+        wait_until(lambda: len(self.stream.clients) == 2)
+        return ingestor
+
+    def test_streams_keep_the_cache_current_without_upstream_calls(self):
+        self.start_ingestor()
+        self.assertEqual(
+            sorted(self.stream.connections),
+            [["btcusdt@kline_1h", "ethusdt@kline_1h"], ["btcusdt@ticker", "ethusdt@ticker"]],
+        )
+        now = int(time.time() * 1000)
+        current = now - now % HOUR_MS
+        self.stream.push("btcusdt@ticker", ticker_event("BTCUSDT", "101.5"))
+        self.stream.push("ethusdt@ticker", ticker_event("ETHUSDT", "7.25"))
+        wait_until(lambda: cache.get(services.CACHE_KEY_KLINES_TAIL.format(symbol="BTCUSDT", interval="1h")))
+        self.stream.push("btcusdt@kline_1h", kline_event("BTCUSDT", current, "2.50000000", closed=False))
+        wait_until(lambda: services.get_klines("BTCUSDT", "1h", 1)[0][4] == "2.50000000")
+
+        tickers = services.get_tickers_24h(["ETHUSDT", "BTCUSDT"])["tickers"]
+        self.assertEqual([(t["symbol"], t["lastPrice"]) for t in tickers], [("BTCUSDT", "101.5"), ("ETHUSDT", "7.25")])
+        self.assertEqual(services.get_ticker_24h("BTCUSDT")["lastPrice"], "101.5")
+        message = async_to_sync(self.layer.receive)("listener")
+        self.assertEqual(message["event"], "ticker:update")
+        self.assertEqual(message["data"]["price"], "101.5")
+
+        history = services.get_klines("BTCUSDT", "1h", 1000)
+        self.assertEqual(len(history), 1000)
+        self.assertEqual(history[-2], hour_kline(current - HOUR_MS))
+        # One backfill per series; everything since came from the streams.
+        self.assertEqual([path for path, _ in self.stub.requests], ["/api/v3/klines", "/api/v3/klines"])
+
+        self.stream.push("btcusdt@kline_1h", kline_event("BTCUSDT", current, "2.75000000", closed=True))
+        wait_until(lambda: UpstreamKline.objects.filter(symbol="BTCUSDT", open_time=current).exists())
+        self.assertEqual(UpstreamKline.objects.get(symbol="BTCUSDT", open_time=current).close, Decimal("2.75"))
+
+    def test_dropped_stream_reconnects(self):
+        self.start_ingestor()
+        self.stream.drop()
+        wait_until(lambda: len(self.stream.connections) == 4 and len(self.stream.clients) == 2)
+        self.stream.push("ethusdt@ticker", ticker_event("ETHUSDT", "8"))
+        wait_until(lambda: cache.get(services.CACHE_KEY_TICKER_24H.format(symbol="ETHUSDT")))
+        self.assertEqual(services.get_ticker_24h("ETHUSDT")["lastPrice"], "8")
+        self.assertNotIn("/api/v3/ticker/24hr", [path for path, _ in self.stub.requests])
+
+
+class StreamConnectionTests(SimpleTestCase):
+    """`open_stream` against a local WebSocket server."""
+
+    def exchange(self, server, client):
+        """Serve connections with `server(connection)` and run `client(ws)` against it; returns both results."""
+        self.paths = []
+
+        async def main():
+            served = asyncio.get_running_loop().create_future()
+
+            async def handle(connection):
+                self.paths.append(connection.request.path)
+                try:
+                    served.set_result(await server(connection))
+                except Exception as e:
+                    served.set_exception(e)
+
+            async with serve(handle, "127.0.0.1", 0) as listener:
+                port = listener.sockets[0].getsockname()[1]
+                ws = await open_stream(f"ws://127.0.0.1:{port}/stream?streams=btcusdt@ticker")
+                try:
+                    received = await asyncio.wait_for(client(ws), 5)
+                finally:
+                    await ws.close()
+                return received, await asyncio.wait_for(served, 5)
+
+        return asyncio.run(main())
+
+    def test_text_and_binary_messages(self):
+        texts = ["x" * 5, "é" * 150, "y" * 70_000]
+
+        async def server(connection):
+            for text in texts:
+                await connection.send(text)
+            await connection.send(b"\x00\xff" * 40_000)
+            await connection.wait_closed()
+
+        async def client(ws):
+            return [await ws.recv() for _ in range(4)]
+
+        received, _ = self.exchange(server, client)
+        self.assertEqual(received, texts + [b"\x00\xff" * 40_000])
+        self.assertEqual(self.paths, ["/stream?streams=btcusdt@ticker"])
+
+    def test_oversized_message_closes_the_connection(self):
+        async def server(connection):
+            await connection.send("a" * 200)
+            await connection.wait_closed()
+            return connection.close_code
+
+        async def client(ws):
+            with self.assertRaises(ConnectionClosed):
+                await ws.recv()
+
+        with mock.patch.object(ingest, "MAX_MESSAGE_SIZE", 100):
+            _, code = self.exchange(server, client)
+        self.assertEqual(code, 1009)
+
+    def test_server_close_ends_recv(self):
+        async def server(connection):
+            await connection.close(1001, "going away")
+
+        async def client(ws):
+            with self.assertRaises(ConnectionClosed) as raised:
+                await ws.recv()
+            return raised.exception.rcvd.code, raised.exception.rcvd.reason
+
+        received, _ = self.exchange(server, client)
+        self.assertEqual(received, (1001, "going away"))
+
+    def test_client_close_ends_pending_recv(self):
+        async def server(connection):
+            await connection.wait_closed()
+            return connection.close_code
+
+        async def client(ws):
+            pending = asyncio.ensure_future(ws.recv())
+            await asyncio.sleep(0.05)
+            await ws.close()
+            with self.assertRaises(ConnectionClosed):
+                await pending
+
+        _, code = self.exchange(server, client)
+        self.assertEqual(code, 1000)
+
+    def test_refused_handshake_raises(self):
+        async def main():
+            async def handle(reader, writer):
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(b"HTTP/1.1 451 Unavailable For Legal Reasons\r\nContent-Length: 0\r\n\r\n")
+                await writer.drain()
+                writer.close()
+
+            async with await asyncio.start_server(handle, "127.0.0.1", 0) as listener:
+                port = listener.sockets[0].getsockname()[1]
+                await open_stream(f"ws://127.0.0.1:{port}/stream")
+
+        with self.assertRaises(InvalidStatus):
+            asyncio.run(main())
+
+
+@override_settings(MARKET_REGISTRY_CHECK_INTERVAL=60, MARKET_REGISTRY_MAX_AGE=60)
+class RegistryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        registry._snapshot = None
+        self.addCleanup(setattr, registry, "_snapshot", None)
+        self.market = Market.objects.create(
+            symbol="BTCUSDT",
+            base_asset=Asset.objects.create(code="BTC", name="Bitcoin"),
+            quote_asset=Asset.objects.create(code="USDT", name="Tether"),
+        )
+        self.assertTrue(registry.get_market("BTCUSDT").is_active)
+
+    def deactivate_without_signals(self) -> None:
+        Market.objects.filter(symbol="BTCUSDT").update(is_active=False)
+
+    def test_save_invalidates_immediately(self):
+        self.market.is_active = False
+        self.market.save()
+        self.assertFalse(registry.get_market("BTCUSDT").is_active)
+        self.assertEqual(registry.active_markets(), [])
+
+    def test_new_market_is_found_without_waiting(self):
+        eth = Asset.objects.create(code="ETH", name="Ethereum")
+        Market.objects.bulk_create([Market(symbol="ETHUSDT", base_asset=eth, quote_asset=self.market.quote_asset)])
+        self.assertEqual(registry.get_market("ETHUSDT").base_code, "ETH")
+
+    def test_version_bump_from_another_process_reloads_after_check_interval(self):
+        self.deactivate_without_signals()
+        cache.set(registry.CACHE_KEY_REGISTRY_VERSION, 1, None)
+        self.assertTrue(registry.get_market("BTCUSDT").is_active)
+        with override_settings(MARKET_REGISTRY_CHECK_INTERVAL=0):
+            self.assertFalse(registry.get_market("BTCUSDT").is_active)
+
+    def test_unsignalled_update_is_picked_up_after_max_age(self):
+        self.deactivate_without_signals()
+        self.assertTrue(registry.get_market("BTCUSDT").is_active)
+        with override_settings(MARKET_REGISTRY_MAX_AGE=0):
+            self.assertFalse(registry.get_market("BTCUSDT").is_active)
+
@@ -0,0 +1,75 @@
+"""Shared HTTP client for the upstream market data APIs (Binance, CoinGecko).
+
+One `requests.Session` per process keeps connections alive between cache
+misses instead of paying a TCP+TLS handshake each time. Its pool holds at most
+UPSTREAM_POOL_MAXSIZE connections per host and callers wait for a free one
+rather than opening more.
+"""
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+class UpstreamClient:
+    def __init__(self, pool_maxsize: int, connect_timeout: float, read_timeout: float):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        # The public endpoints are stateless; don't let one response's cookies
+        # ride along on every later request from the process.
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get_json(self, url: str, params: dict = None):
+        """GET `url` and decode the JSON body. Raises `requests.RequestException` on failure."""
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> UpstreamClient:
+    global _client
+    client = _client
+    if client is None:
+        with _client_lock:
+            if _client is None:
+                _client = UpstreamClient(
+                    pool_maxsize=getattr(settings, "UPSTREAM_POOL_MAXSIZE", 10),
+                    connect_timeout=getattr(settings, "UPSTREAM_CONNECT_TIMEOUT", 3.05),
+                    read_timeout=getattr(settings, "UPSTREAM_READ_TIMEOUT", 10),
+                )
+            client = _client
+    return client
+
+
+def reset_client() -> None:
+    """Close pooled connections; the next call builds a client from current settings."""
+    global _client
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
+
+
+def binance_url(path: str) -> str:
+    return getattr(settings, "BINANCE_API_BASE", "https://api.binance.com") + path
+
+
+def coingecko_url(path: str) -> str:
+    return getattr(settings, "COINGECKO_API_BASE", "https://api.coingecko.com/api/v3") + path
+
+
+def binance_stream_url(streams) -> str:
+    """Combined stream URL: each message arrives as `{"stream": name, "data": event}`."""
+    return getattr(settings, "BINANCE_STREAM_BASE", "wss://stream.binance.com:9443") + "/stream?streams=" + "/".join(streams)
@@ -3,6 +3,8 @@ from . import views
 
 urlpatterns = [
     path("exchange-info/", views.ExchangeInfoView.as_view(), name="exchange-info"),
+    path("tickers/", views.TickersView.as_view(), name="tickers"),
+    path("metrics/", views.MarketDataMetricsView.as_view(), name="market-data-metrics"),
     path("<str:symbol>/stats24h/", views.Ticker24hView.as_view(), name="stats-24h"),
     path("<str:symbol>/candles/", views.KlinesView.as_view(), name="candles"),
 ]
@@ -1,54 +1,133 @@
-from rest_framework.views import APIView
-from rest_framework.response import Response
+import re
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils.cache import parse_etags
+from django.views import View
 from rest_framework import status
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from common.constants import CANDLE_INTERVALS
+from apps.analytics.candles import get_internal_klines
 from . import services
+from .registry import active_markets
+from .coalesce import get_metrics
 
-class ExchangeInfoView(APIView):
-    permission_classes = [AllowAny]
 
-    def get(self, request):
-        data = services.get_exchange_info()
+def upstream(func):
+    """Run a blocking upstream fetch off the event loop.
+
+    Each call gets its own executor thread instead of queueing behind the
+    single thread-sensitive one, so slow upstream calls don't serialize.
+    Database connections the fetch opened on that thread are handled as at
+    the end of a request.
+    """
+    def call(*args):
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(call, thread_sensitive=False)
+
+
+GZIP_ACCEPTED = re.compile(r"\bgzip\b")
+
+
+def precomputed_response(request, data):
+    """Serve a body serialized once per fetch, revalidated by ETag.
+
+    Clients that accept gzip get the stored compressed body under its own ETag.
+    """
+    gzipped = data.get("gzip_body") is not None and bool(
+        GZIP_ACCEPTED.search(request.headers.get("Accept-Encoding", ""))
+    )
+    etag = f'{data["etag"][:-1]}-gz"' if gzipped else data["etag"]
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(data["gzip_body"] if gzipped else data["body"], content_type="application/json")
+        if gzipped:
+            response["Content-Encoding"] = "gzip"
+    response["ETag"] = etag
+    response["Cache-Control"] = "no-cache"
+    response["Vary"] = "Accept-Encoding"
+    return response
+
+
+class ExchangeInfoView(View):
+    """Trading rules of the active markets, indexed by symbol."""
+
+    async def get(self, request):
+        symbols = [m.symbol for m in await sync_to_async(active_markets)()]
+        data = await upstream(services.get_exchange_info_index)(symbols)
         if not data:
-            return Response(
-                {"error": "Service unavailable"}, 
+            return JsonResponse(
+                {"error": "Service unavailable"},
                 status=status.HTTP_503_SERVICE_UNAVAILABLE
             )
-        
-        # Filter symbols if needed, or return full list
-        # detailed filtering can be added later
-        return Response(data)
+        return precomputed_response(request, data)
 
 
-class Ticker24hView(APIView):
-    permission_classes = [AllowAny]
-
-    def get(self, request, symbol):
-        data = services.get_ticker_24h(symbol)
+class Ticker24hView(View):
+    async def get(self, request, symbol):
+        data = await upstream(services.get_ticker_24h)(symbol)
         if not data:
-            return Response(
-                {"error": "Symbol not found or service unavailable"}, 
+            return JsonResponse(
+                {"error": "Symbol not found or service unavailable"},
                 status=status.HTTP_404_NOT_FOUND
             )
-        return Response(data)
+        return JsonResponse(data)
+
 
+class TickersView(View):
+    """24h tickers of every active market in one response, revalidated by ETag."""
+
+    async def get(self, request):
+        symbols = [m.symbol for m in await sync_to_async(active_markets)()]
+        data = await upstream(services.get_tickers_24h)(symbols)
+        if not data:
+            return JsonResponse(
+                {"error": "Service unavailable"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        return precomputed_response(request, data)
 
-class KlinesView(APIView):
-    permission_classes = [AllowAny]
 
-    def get(self, request, symbol):
-        interval = request.query_params.get("interval", "1h")
-        limit = request.query_params.get("limit", "500")
-        
+class KlinesView(View):
+    async def get(self, request, symbol):
+        interval = request.GET.get("interval", "1h")
+        limit = request.GET.get("limit", "500")
+
         try:
             limit = int(limit)
         except ValueError:
             limit = 500
 
-        data = services.get_klines(symbol, interval, limit)
+        if request.GET.get("source") == "internal":
+            if interval not in CANDLE_INTERVALS:
+                return JsonResponse(
+                    {"error": f"interval must be one of {', '.join(CANDLE_INTERVALS)}"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            data = await sync_to_async(get_internal_klines)(symbol.upper(), interval, limit)
+            return JsonResponse(data, safe=False)
+
+        data = await upstream(services.get_klines)(symbol, interval, limit)
         if not data:
-            return Response(
-                {"error": "Could not fetch candles"}, 
+            return JsonResponse(
+                {"error": "Could not fetch candles"},
                 status=status.HTTP_503_SERVICE_UNAVAILABLE
             )
-        return Response(data)
+        return JsonResponse(data, safe=False)
+
+
+class MarketDataMetricsView(APIView):
+    """Upstream fetches versus cache misses served by another caller's fetch; staff only."""
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(get_metrics())
@@ -1,6 +1,8 @@
+import asyncio
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 
 
@@ -19,15 +21,36 @@ class MarketTickerConsumer(AsyncWebsocketConsumer):
 
 
 class MarketOrderbookConsumer(AsyncWebsocketConsumer):
+    """Sends a snapshot on connect, then `orderbook:delta` messages.
+
+    Every message carries `seq`. Clients drop deltas with `seq` at or below the
+    snapshot's and resync when a delta's `seq` is not exactly one more than the
+    last applied, by sending `{"action": "snapshot"}`.
+    """
+
     async def connect(self):
         self.symbol = self.scope["url_route"]["kwargs"]["symbol"]
         self.group = f"market_{self.symbol}_orderbook"
         await self.channel_layer.group_add(self.group, self.channel_name)
         await self.accept()
+        await self.send_snapshot()
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(self.group, self.channel_name)
 
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            action = json.loads(text_data or "{}").get("action")
+        except (ValueError, AttributeError):
+            return
+        if action == "snapshot":
+            await self.send_snapshot()
+
+    async def send_snapshot(self):
+        from apps.trading.selectors import get_orderbook_snapshot
+        data = await database_sync_to_async(get_orderbook_snapshot)(self.symbol)
+        await self.send(text_data=json.dumps({"event": "orderbook:snapshot", "data": data}))
+
     async def broadcast(self, event):
         await self.send(text_data=json.dumps({"event": event["event"], "data": event["data"]}))
 
@@ -46,6 +69,73 @@ class MarketTradesConsumer(AsyncWebsocketConsumer):
         await self.send(text_data=json.dumps({"event": event["event"], "data": event["data"]}))
 
 
+class MarketKlineConsumer(AsyncWebsocketConsumer):
+    """Sends the in-progress candle on connect, then conflated `kline:update` messages.
+
+    In-progress updates go out at most once per KLINE_STREAM_CONFLATE_SECONDS;
+    in between only the latest is kept and sent when the period is up. A
+    message with `closed: true` is the final state of its candle and is sent
+    at once, dropping a pending update of the same candle.
+    """
+
+    async def connect(self):
+        from common.constants import CANDLE_INTERVALS
+        self.symbol = self.scope["url_route"]["kwargs"]["symbol"]
+        self.interval = self.scope["url_route"]["kwargs"]["interval"]
+        if self.interval not in CANDLE_INTERVALS:
+            await self.close()
+            return
+        self.last_sent = float("-inf")
+        self.pending = None
+        self.flush_handle = None
+        self.group = f"market_{self.symbol}_kline_{self.interval}"
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.accept()
+        from apps.analytics.candles import get_live_kline
+        kline = await database_sync_to_async(get_live_kline)(self.symbol, self.interval)
+        if kline is not None:
+            data = {"symbol": self.symbol, "interval": self.interval, "kline": kline, "closed": False}
+            await self.send_update(data)
+
+    async def disconnect(self, close_code):
+        if getattr(self, "flush_handle", None) is not None:
+            self.flush_handle.cancel()
+        if hasattr(self, "group"):
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+
+    async def broadcast(self, event):
+        data = event["data"]
+        if data["closed"]:
+            if self.pending is not None and self.pending["kline"][0] == data["kline"][0]:
+                self.pending = None
+            await self.send_update(data)
+            return
+        loop = asyncio.get_running_loop()
+        wait = self.last_sent + self.period() - loop.time()
+        if wait <= 0 and self.pending is None:
+            await self.send_update(data)
+            return
+        self.pending = data
+        if self.flush_handle is None:
+            self.flush_handle = loop.call_later(max(wait, 0), self.schedule_flush)
+
+    def period(self) -> float:
+        return getattr(settings, "KLINE_STREAM_CONFLATE_SECONDS", 1.0)
+
+    def schedule_flush(self):
+        self.flush_handle = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        if self.pending is not None:
+            data, self.pending = self.pending, None
+            await self.send_update(data)
+
+    async def send_update(self, data):
+        self.last_sent = asyncio.get_running_loop().time()
+        await self.send(text_data=json.dumps({"event": "kline:update", "data": data}))
+
+
 class UserConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope.get("user")
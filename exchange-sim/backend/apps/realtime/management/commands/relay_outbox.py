@@ -0,0 +1,94 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from apps.realtime.models import OutboxCursor, OutboxEvent
+from apps.realtime.services import publish_messages
+
+
+def in_flight_snapshot():
+    """`(xmin, xmax)` of the current transaction snapshot, or None where unsupported.
+
+    Transactions with an id below `xmin` have all finished; those running now
+    have ids below `xmax`.
+    """
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT txid_snapshot_xmin(s), txid_snapshot_xmax(s) "
+            "FROM (SELECT txid_current_snapshot() AS s) AS snapshot"
+        )
+        return cursor.fetchone()
+
+
+class Command(BaseCommand):
+    help = "Publish realtime outbox rows to channel groups, tracking a high-water mark"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--poll-interval", type=float, default=0.1, help="Seconds to sleep when idle")
+        parser.add_argument(
+            "--gap-timeout",
+            type=float,
+            default=2.0,
+            help="Seconds to wait for a missing id to commit before skipping it, "
+            "where in-flight transactions cannot be checked",
+        )
+        parser.add_argument("--retention", type=int, default=3600, help="Seconds to keep published rows")
+        parser.add_argument("--once", action="store_true", help="Relay what is pending and exit")
+
+    def handle(self, *args, **options):
+        cursor, _ = OutboxCursor.objects.get_or_create(name="default")
+        gap_since = gap_horizon = None
+        last_prune = 0.0
+        while True:
+            close_old_connections()
+            rows = list(
+                OutboxEvent.objects.filter(id__gt=cursor.last_id)
+                .order_by("id")
+                .values_list("id", "group", "event", "data")[: options["batch_size"]]
+            )
+            # Ids are handed out before commit, so a lower id may still become
+            # visible after a higher one. Stop at a hole until it fills, or until
+            # every transaction running when it was seen has finished: a rolled
+            # back insert leaves a hole that never fills. Event batches write
+            # their rows after the transaction's other writes, so the writer
+            # already has a transaction id when it takes an outbox id; a lone
+            # insert gets one within the same statement. Without snapshots
+            # (SQLite) the hole is skipped after a timeout instead.
+            snapshot = in_flight_snapshot() if rows else None
+            ready = []
+            expected = cursor.last_id + 1
+            for row in rows:
+                if row[0] != expected:
+                    gap_since = gap_since or time.monotonic()
+                    if snapshot is not None and gap_horizon is None:
+                        gap_horizon = snapshot[1]
+                    settled = snapshot is not None and snapshot[0] >= gap_horizon
+                    if not settled and time.monotonic() - gap_since < options["gap_timeout"]:
+                        break
+                gap_since = gap_horizon = None
+                ready.append(row)
+                expected = row[0] + 1
+
+            if ready:
+                publish_messages([
+                    (group, {"type": "broadcast", "event": event, "data": data})
+                    for _, group, event, data in ready
+                ])
+                cursor.last_id = ready[-1][0]
+                cursor.save(update_fields=["last_id", "updated_at"])
+
+            if time.monotonic() - last_prune > 60:
+                cutoff = timezone.now() - timezone.timedelta(seconds=options["retention"])
+                OutboxEvent.objects.filter(id__lte=cursor.last_id, created_at__lt=cutoff).delete()
+                last_prune = time.monotonic()
+
+            if options["once"] and len(ready) < options["batch_size"]:
+                self.stdout.write(self.style.SUCCESS(f"Relayed up to id {cursor.last_id}"))
+                return
+            if len(ready) < options["batch_size"]:
+                time.sleep(options["poll_interval"])
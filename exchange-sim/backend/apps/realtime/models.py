@@ -0,0 +1,17 @@
+from django.db import models
+
+
+class OutboxEvent(models.Model):
+    group = models.CharField(max_length=100)
+    event = models.CharField(max_length=50)
+    data = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["created_at"])]
+
+
+class OutboxCursor(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -1,34 +1,150 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 import json
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 
-from apps.trading.selectors import get_orderbook_bids, get_orderbook_asks
+_local = threading.local()
+
+
+class EventBatch:
+    """Events raised inside one transaction, emitted together.
+
+    Events that share a `key` are merged: only the latest one is sent, in the
+    position of the last occurrence.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.counter = 0
+
+    def add(self, group: str, event: str, data: dict, key=None) -> None:
+        if key is None:
+            self.counter += 1
+            key = self.counter
+        else:
+            self.events.pop(key, None)
+        self.events[key] = (group, {"type": "broadcast", "event": event, "data": data})
+
+    def messages(self) -> list:
+        return list(self.events.values())
+
+    def publish(self) -> None:
+        publish_messages(self.messages())
+
 
+def outbox_enabled() -> bool:
+    return getattr(settings, "REALTIME_OUTBOX_ENABLED", False)
 
-def _send(channel_name: str, event: str, data: dict):
+
+def write_outbox(messages) -> None:
+    """Queue messages for the relay in the current transaction, if any."""
+    from .models import OutboxEvent
+    OutboxEvent.objects.bulk_create([
+        OutboxEvent(group=group, event=message["event"], data=message["data"])
+        for group, message in messages
+    ])
+
+
+def publish_messages(messages) -> None:
     layer = get_channel_layer()
-    if not layer:
+    if not layer or not messages:
         return
-    async_to_sync(layer.group_send)(
-        channel_name,
-        {"type": "broadcast", "event": event, "data": data},
-    )
+
+    by_group = {}
+    for group, message in messages:
+        by_group.setdefault(group, []).append(message)
+
+    # Groups go out concurrently; within a group messages keep their order.
+    async def send_group(group, group_messages):
+        for message in group_messages:
+            await layer.group_send(group, message)
+
+    async def send_all():
+        await asyncio.gather(*(send_group(g, m) for g, m in by_group.items()))
+
+    async_to_sync(send_all)()
+
+
+@contextmanager
+def collect_events():
+    """Hold realtime events raised in the block and emit them with the transaction.
+
+    Use inside `transaction.atomic()`. With the outbox enabled the events are
+    written as outbox rows in that transaction for `relay_outbox` to publish;
+    otherwise they are published once the outermost transaction commits.
+    Nothing is emitted if the block or the transaction fails.
+    """
+    if getattr(_local, "batch", None) is not None:
+        yield _local.batch
+        return
+    batch = _local.batch = EventBatch()
+    try:
+        yield batch
+    finally:
+        _local.batch = None
+    if outbox_enabled():
+        write_outbox(batch.messages())
+    else:
+        transaction.on_commit(batch.publish, robust=True)
+
+
+def _send(channel_name: str, event: str, data: dict, key=None):
+    batch = getattr(_local, "batch", None)
+    if batch is not None:
+        batch.add(channel_name, event, data, key)
+        return
+    messages = [(channel_name, {"type": "broadcast", "event": event, "data": data})]
+    if outbox_enabled():
+        write_outbox(messages)
+    else:
+        publish_messages(messages)
 
 
 def broadcast_ticker(symbol: str, price):
     ts = int(timezone.now().timestamp() * 1000)
-    _send(f"market_{symbol}_ticker", "ticker:update", {"symbol": symbol, "price": str(price), "ts": ts})
+    _send(
+        f"market_{symbol}_ticker",
+        "ticker:update",
+        {"symbol": symbol, "price": str(price), "ts": ts},
+        key=("ticker", symbol),
+    )
+
 
+def publish_tickers(prices: dict):
+    """Publish `{symbol: price}` to the ticker groups right away.
 
-def broadcast_orderbook_update(symbol: str):
-    bids = get_orderbook_bids(symbol)
-    asks = get_orderbook_asks(symbol)
+    For prices from outside the exchange, such as the upstream stream: they
+    belong to no transaction, so they skip event batches and the outbox.
+    """
+    ts = int(timezone.now().timestamp() * 1000)
+    publish_messages([
+        (
+            f"market_{symbol}_ticker",
+            {"type": "broadcast", "event": "ticker:update", "data": {"symbol": symbol, "price": str(price), "ts": ts}},
+        )
+        for symbol, price in prices.items()
+    ])
+
+
+def broadcast_orderbook_delta(symbol: str, seq: int, bids, asks):
+    """Push only the changed `[price, qty]` levels; a zero quantity removes the level."""
     ts = int(timezone.now().timestamp() * 1000)
     _send(
         f"market_{symbol}_orderbook",
-        "orderbook:update",
-        {"symbol": symbol, "bids": bids, "asks": asks, "ts": ts},
+        "orderbook:delta",
+        {
+            "symbol": symbol,
+            "seq": seq,
+            "bids": bids,
+            "asks": asks,
+            "ts": ts,
+        },
     )
 
 
@@ -41,6 +157,20 @@ def broadcast_trade(symbol: str, price, amount, taker_side: str):
     )
 
 
+def broadcast_kline(symbol: str, interval: str, kline: list, closed: bool):
+    """Push a candle's state; `closed` marks its final one.
+
+    Consumers conflate in-progress updates per connection, so every state is
+    sent here.
+    """
+    _send(
+        f"market_{symbol}_kline_{interval}",
+        "kline:update",
+        {"symbol": symbol, "interval": interval, "kline": kline, "closed": closed},
+        key=None if closed else ("kline", symbol, interval),
+    )
+
+
 def send_order_update(user_id: int, order_id: int, status: str, filled_amount: str):
     _send(
         f"user_{user_id}",
@@ -54,4 +184,5 @@ def send_balance_update(user_id: int, asset: str, available: str, locked: str):
         f"user_{user_id}",
         "balance:update",
         {"asset": asset, "available": available, "locked": locked},
+        key=("balance", user_id, asset),
     )
@@ -1 +1,199 @@
-from django.test import TestCase
+from io import StringIO
+from unittest import mock
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from . import services
+from .management.commands import relay_outbox
+from .models import OutboxCursor, OutboxEvent
+from .routing import websocket_urlpatterns
+from .services import broadcast_ticker, broadcast_trade, collect_events
+
+
+class CollectEventsTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(services, "publish_messages")
+        self.publish = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_events_are_published_once_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic(), collect_events():
+                broadcast_trade("BTCUSDT", "100", "1", "BUY")
+                broadcast_ticker("BTCUSDT", "100")
+                broadcast_trade("BTCUSDT", "101", "2", "BUY")
+                broadcast_ticker("BTCUSDT", "101")
+            self.publish.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+        self.publish.assert_not_called()
+
+        callbacks[0]()
+        self.publish.assert_called_once()
+        messages = self.publish.call_args.args[0]
+        # The two tickers collapse into the latest, after both trades.
+        self.assertEqual(
+            [(group, message["event"], message["data"]["price"]) for group, message in messages],
+            [
+                ("market_BTCUSDT_trades", "trade:new", "100"),
+                ("market_BTCUSDT_trades", "trade:new", "101"),
+                ("market_BTCUSDT_ticker", "ticker:update", "101"),
+            ],
+        )
+
+    def test_nothing_is_published_after_rollback(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic(), collect_events():
+                broadcast_trade("BTCUSDT", "100", "1", "BUY")
+                raise RuntimeError("rejected")
+        self.assertEqual(callbacks, [])
+        self.publish.assert_not_called()
+
+    def test_events_wait_for_the_outermost_transaction(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                with transaction.atomic(), collect_events():
+                    broadcast_trade("BTCUSDT", "100", "1", "BUY")
+                self.publish.assert_not_called()
+                transaction.set_rollback(True)
+        self.assertEqual(callbacks, [])
+        self.publish.assert_not_called()
+
+
+class RelayOutboxTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(relay_outbox, "publish_messages")
+        self.publish = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue(self, *ids) -> None:
+        for id in ids:
+            OutboxEvent.objects.create(id=id, group="market_BTCUSDT_trades", event="trade:new", data={"n": id})
+
+    def relay(self, gap_timeout: float = 60) -> list:
+        """Run one pass; returns the ids published, in order."""
+        self.publish.reset_mock()
+        call_command("relay_outbox", once=True, gap_timeout=gap_timeout, stdout=StringIO())
+        return [message["data"]["n"] for call in self.publish.call_args_list for _, message in call.args[0]]
+
+    def cursor(self) -> int:
+        return OutboxCursor.objects.get(name="default").last_id
+
+    def test_contiguous_rows_are_published_in_order(self):
+        self.queue(1, 2, 3)
+        self.assertEqual(self.relay(), [1, 2, 3])
+        self.assertEqual(self.cursor(), 3)
+        self.assertEqual(self.relay(), [])
+
+    def test_relay_waits_for_a_gap_that_fills(self):
+        # Id 3 was handed out but its transaction has not committed yet.
+        self.queue(1, 2, 4)
+        self.assertEqual(self.relay(), [1, 2])
+        self.assertEqual(self.cursor(), 2)
+        self.assertEqual(self.relay(), [])
+        self.queue(3)
+        self.assertEqual(self.relay(), [3, 4])
+        self.assertEqual(self.cursor(), 4)
+
+    def test_relay_skips_a_gap_that_times_out(self):
+        self.queue(1, 2, 4, 5)
+        self.assertEqual(self.relay(gap_timeout=0), [1, 2, 4, 5])
+        self.assertEqual(self.cursor(), 5)
+        # A row that commits after its gap was skipped is not sent late.
+        self.queue(3)
+        self.assertEqual(self.relay(gap_timeout=0), [])
+
+    def test_relay_holds_a_gap_while_a_transaction_may_fill_it(self):
+        self.queue(1, 2, 4)
+        # Transaction 10 was running when the hole was seen and may commit id 3.
+        with mock.patch.object(relay_outbox, "in_flight_snapshot", return_value=(10, 11)):
+            self.assertEqual(self.relay(), [1, 2])
+
+    def test_relay_skips_a_gap_once_transactions_in_flight_have_finished(self):
+        self.queue(1, 2, 4)
+        # Passes two and three: transaction 10 is still running, then it has
+        # finished without committing id 3, so the hole can never fill.
+        snapshots = [(10, 11), (10, 12), (11, 12)]
+        with mock.patch.object(relay_outbox, "in_flight_snapshot", side_effect=snapshots), \
+                mock.patch.object(relay_outbox.time, "sleep", side_effect=[None, None, StopIteration]):
+            with self.assertRaises(StopIteration):
+                call_command("relay_outbox", gap_timeout=60, stdout=StringIO())
+        published = [message["data"]["n"] for call in self.publish.call_args_list for _, message in call.args[0]]
+        self.assertEqual(published, [1, 2, 4])
+        self.assertEqual(self.cursor(), 4)
+
+    def test_relay_does_not_check_snapshots_when_idle(self):
+        with mock.patch.object(relay_outbox, "in_flight_snapshot") as snapshot:
+            self.assertEqual(self.relay(), [])
+        snapshot.assert_not_called()
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    KLINE_STREAM_CONFLATE_SECONDS=0.2,
+)
+class MarketKlineConsumerTests(SimpleTestCase):
+    group = "market_BTCUSDT_kline_1m"
+
+    def setUp(self):
+        patcher = mock.patch("apps.analytics.candles.get_live_kline", return_value=[0, "100"])
+        self.live = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self, path="/ws/market/BTCUSDT/kline/1m/"):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def offer(self, open_time: int, close: str, closed: bool = False) -> None:
+        data = {"symbol": "BTCUSDT", "interval": "1m", "kline": [open_time, close], "closed": closed}
+        await get_channel_layer().group_send(
+            self.group, {"type": "broadcast", "event": "kline:update", "data": data},
+        )
+
+    async def received(self, timeout=1) -> tuple:
+        message = await self.communicator.receive_json_from(timeout)
+        return tuple(message["data"]["kline"]) + ((True,) if message["data"]["closed"] else ())
+
+    async def test_sends_the_live_candle_on_connect(self):
+        self.communicator, connected = await self.connect()
+        self.assertTrue(connected)
+        self.assertEqual(await self.received(), (0, "100"))
+        self.live.assert_called_once_with("BTCUSDT", "1m")
+        await self.communicator.disconnect()
+
+    async def test_updates_within_a_period_collapse_into_the_latest(self):
+        self.communicator, _ = await self.connect()
+        await self.received()
+        await self.offer(0, "101")
+        await self.offer(0, "102")
+        await self.offer(0, "103")
+        self.assertEqual(await self.received(), (0, "103"))
+        self.assertTrue(await self.communicator.receive_nothing(0.3))
+        await self.communicator.disconnect()
+
+    async def test_closed_candle_goes_out_at_once_and_drops_what_it_supersedes(self):
+        self.communicator, _ = await self.connect()
+        await self.received()
+        await self.offer(0, "101")
+        await self.offer(0, "102", closed=True)
+        self.assertEqual(await self.received(0.1), (0, "102", True))
+        self.assertTrue(await self.communicator.receive_nothing(0.3))
+        await self.communicator.disconnect()
+
+    async def test_closed_candle_keeps_a_pending_update_of_a_later_candle(self):
+        self.communicator, _ = await self.connect()
+        await self.received()
+        await self.offer(60, "101")
+        await self.offer(0, "99", closed=True)
+        self.assertEqual(await self.received(0.1), (0, "99", True))
+        self.assertEqual(await self.received(), (60, "101"))
+        await self.communicator.disconnect()
+
+    async def test_unknown_interval_is_refused(self):
+        communicator, connected = await self.connect("/ws/market/BTCUSDT/kline/7m/")
+        self.assertFalse(connected)
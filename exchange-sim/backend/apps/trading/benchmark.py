@@ -0,0 +1,290 @@
+"""Synthetic order flow benchmark for `create_limit_order` / `match_order`.
+
+The flow is generated up front from a seed, so two runs with the same options
+submit exactly the same commands. Orders are placed by throwaway `bench-*`
+users on throwaway `BENCH*` twins of the chosen markets, so real markets and
+their stats never see them. Users, markets and everything derived from their
+trades are removed once the run finishes.
+"""
+import random
+import time
+from decimal import Decimal
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+
+from common.constants import ORDER_SIDE_BUY, ORDER_SIDE_SELL
+from common.errors import InsufficientFunds, OrderNotCancelable
+from apps.analytics.candles import discard_series
+from apps.analytics.models import Candle, MarketStats
+from apps.analytics.rolling_stats import discard_rolling_stats
+from apps.markets.models import Asset, Market
+from apps.markets.registry import active_markets, get_market
+from apps.realtime.models import OutboxEvent
+from apps.wallet.models import Balance, LedgerEntry
+from .models import Order, Trade
+from .services import cancel_order, create_limit_order
+from .services.book_journal import discard_journal
+from .services.depth_cache import discard_market_depth
+from .services.order_book import discard_order_book
+
+User = get_user_model()
+
+BENCH_USER_PREFIX = "bench-"
+BENCH_MARKET_PREFIX = "BENCH"
+BENCH_MID_PRICE = Decimal("100")
+BENCH_TICK = Decimal("0.01")
+BENCH_QUOTE_BALANCE = Decimal("1000000000")
+BENCH_BASE_BALANCE = Decimal("10000000")
+
+OP_PASSIVE = "passive"
+OP_CROSSING = "crossing"
+OP_SWEEP = "sweep"
+OP_CANCEL = "cancel"
+
+DEFAULT_MIX = {OP_PASSIVE: 0.6, OP_CROSSING: 0.2, OP_SWEEP: 0.05, OP_CANCEL: 0.15}
+
+
+def generate_flow(seed: int, count: int, symbols: list, users: int, mix: dict = None) -> list:
+    """Build `count` commands as plain tuples.
+
+    Orders are `(kind, user_index, symbol, side, price, amount)`; cancels are
+    `(OP_CANCEL, op_index)` pointing at an earlier order in the flow, since the
+    database ids are only known at run time.
+    """
+    rnd = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    flow = []
+    order_ops = []
+    for _ in range(count):
+        kind = rnd.choices(kinds, weights)[0]
+        if kind == OP_CANCEL:
+            if order_ops:
+                flow.append((OP_CANCEL, rnd.choice(order_ops)))
+                continue
+            kind = OP_PASSIVE
+        side = rnd.choice((ORDER_SIDE_BUY, ORDER_SIDE_SELL))
+        sign = -1 if side == ORDER_SIDE_BUY else 1
+        if kind == OP_PASSIVE:
+            # Rest one to fifty ticks behind the mid, on our own side.
+            ticks = sign * rnd.randint(1, 50)
+            amount = Decimal(rnd.randint(1, 500)) / 100
+        elif kind == OP_CROSSING:
+            # Reach a few ticks into the other side.
+            ticks = -sign * rnd.randint(1, 5)
+            amount = Decimal(rnd.randint(1, 500)) / 100
+        else:
+            # Sweep through most of the resting levels.
+            ticks = -sign * 60
+            amount = Decimal(rnd.randint(5000, 20000)) / 100
+        price = BENCH_MID_PRICE + ticks * BENCH_TICK
+        order_ops.append(len(flow))
+        flow.append((kind, rnd.randrange(users), rnd.choice(symbols), side, price, amount))
+    return flow
+
+
+def seed_book(seed: int, symbols: list, levels: int, per_level: int) -> list:
+    """Resting orders placed before timing starts so the run begins on a deep book."""
+    rnd = random.Random(seed ^ 0x5EED)
+    flow = []
+    for symbol in symbols:
+        for level in range(1, levels + 1):
+            for _ in range(per_level):
+                for side, sign in ((ORDER_SIDE_BUY, -1), (ORDER_SIDE_SELL, 1)):
+                    price = BENCH_MID_PRICE + sign * level * BENCH_TICK
+                    amount = Decimal(rnd.randint(1, 500)) / 100
+                    flow.append((OP_PASSIVE, 0, symbol, side, price, amount))
+    return flow
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(latencies: list, queries: list, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "ops_per_sec": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "p999_ms": round(percentile(ordered, 99.9) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        "queries_per_op": round(sum(queries) / len(queries), 2) if queries else 0.0,
+    }
+
+
+def _bench_users():
+    return User.objects.filter(username__startswith=BENCH_USER_PREFIX)
+
+
+def _bench_markets():
+    return Market.objects.filter(symbol__startswith=BENCH_MARKET_PREFIX)
+
+
+def create_bench_markets(markets: list) -> list:
+    """A `BENCH*` twin of each market: same quote asset, a base asset of the same precision."""
+    quotes = {a.code: a for a in Asset.objects.filter(code__in={m.quote_code for m in markets})}
+    for market in markets:
+        base = Asset.objects.create(
+            code=f"{BENCH_MARKET_PREFIX}{market.base_code}",
+            name=f"Bench {market.base_asset.name}",
+            precision=market.base_asset.precision,
+        )
+        Market.objects.create(
+            symbol=f"{BENCH_MARKET_PREFIX}{market.symbol}", base_asset=base, quote_asset=quotes[market.quote_code]
+        )
+    return [get_market(f"{BENCH_MARKET_PREFIX}{market.symbol}") for market in markets]
+
+
+def create_bench_users(count: int, markets: list) -> list:
+    assets = {m.base_code for m in markets} | {m.quote_code for m in markets}
+    quotes = {m.quote_code for m in markets}
+    users = []
+    for i in range(count):
+        user = User(username=f"{BENCH_USER_PREFIX}{i}", email=f"{BENCH_USER_PREFIX}{i}@bench.local")
+        user.set_unusable_password()
+        user.save()
+        users.append(user)
+    Balance.objects.bulk_create([
+        Balance(
+            user=user,
+            asset_code=code,
+            available=BENCH_QUOTE_BALANCE if code in quotes else BENCH_BASE_BALANCE,
+        )
+        for user in users
+        for code in sorted(assets)
+    ])
+    return users
+
+
+def cleanup() -> None:
+    """Remove bench users and markets with everything their trades left behind."""
+    users = _bench_users()
+    markets = _bench_markets()
+    symbols = list(markets.values_list("symbol", flat=True))
+    groups = Q(group__in=[f"user_{user_id}" for user_id in users.values_list("id", flat=True)])
+    for symbol in symbols:
+        groups |= Q(group__startswith=f"market_{symbol}_")
+    OutboxEvent.objects.filter(groups).delete()
+    Trade.objects.filter(market_symbol__in=symbols).delete()
+    Order.objects.filter(user__in=users).delete()
+    LedgerEntry.objects.filter(user__in=users).delete()
+    Candle.objects.filter(market_symbol__in=symbols).delete()
+    MarketStats.objects.filter(market_symbol__in=symbols).delete()
+    users.delete()
+    base_codes = list(markets.values_list("base_asset__code", flat=True))
+    markets.delete()
+    Asset.objects.filter(code__in=base_codes).delete()
+    for symbol in symbols:
+        discard_order_book(symbol)
+        discard_market_depth(symbol)
+        discard_journal(symbol)
+        discard_rolling_stats(symbol)
+        discard_series(symbol)
+
+
+def _execute(op, users, placed):
+    """Run one command. Returns the created order, or None.
+
+    `placed` maps flow indexes to the orders they created, for cancels.
+    """
+    if op[0] == OP_CANCEL:
+        order = placed.get(op[1])
+        if order is not None:
+            try:
+                cancel_order(order.user, order.id)
+            except OrderNotCancelable:
+                pass
+        return None
+    _, user_index, symbol, side, price, amount = op
+    try:
+        return create_limit_order(users[user_index], symbol, side, price, amount)
+    except InsufficientFunds:
+        return None
+
+
+def run_benchmark(
+    seed: int = 1,
+    orders: int = 2000,
+    users: int = 10,
+    depth_levels: int = 0,
+    per_level: int = 1,
+    symbols: list = None,
+    keep: bool = False,
+) -> dict:
+    cleanup()
+    markets = [
+        m for m in active_markets()
+        if (symbols is None or m.symbol in symbols) and not m.symbol.startswith(BENCH_MARKET_PREFIX)
+    ]
+    if not markets:
+        raise RuntimeError("No active markets; run `manage.py seed_markets` first")
+    symbols = [m.symbol for m in markets]
+
+    bench_markets = create_bench_markets(markets)
+    bench_symbols = [m.symbol for m in bench_markets]
+    bench_users = create_bench_users(users, bench_markets)
+    flow = generate_flow(seed, orders, bench_symbols, users)
+
+    try:
+        for op in seed_book(seed, bench_symbols, depth_levels, per_level):
+            _execute(op, bench_users, {})
+        trades_before = Trade.objects.filter(market_symbol__in=bench_symbols).count()
+
+        placed = {}
+        latencies = {}
+        queries = {}
+        started = time.perf_counter()
+        for index, op in enumerate(flow):
+            with CaptureQueriesContext(connection) as ctx:
+                t0 = time.perf_counter()
+                order = _execute(op, bench_users, placed)
+                latency = time.perf_counter() - t0
+            if order is not None:
+                placed[index] = order
+            latencies.setdefault(op[0], []).append(latency)
+            queries.setdefault(op[0], []).append(len(ctx.captured_queries))
+        elapsed = time.perf_counter() - started
+        fills = Trade.objects.filter(market_symbol__in=bench_symbols).count() - trades_before
+    finally:
+        if not keep:
+            cleanup()
+
+    all_latencies = [v for values in latencies.values() for v in values]
+    all_queries = [v for values in queries.values() for v in values]
+    order_queries = [v for kind, values in queries.items() if kind != OP_CANCEL for v in values]
+    return {
+        "config": {
+            "seed": seed,
+            "orders": orders,
+            "users": users,
+            "depth_levels": depth_levels,
+            "per_level": per_level,
+            "markets": symbols,
+            "mix": DEFAULT_MIX,
+        },
+        "environment": {
+            "database": connection.vendor,
+            "matching_engine": getattr(settings, "MATCHING_ENGINE", "sql"),
+            "outbox": getattr(settings, "REALTIME_OUTBOX_ENABLED", False),
+            "django": django.get_version(),
+        },
+        "elapsed_sec": round(elapsed, 3),
+        "orders_per_sec": round(len(all_latencies) / elapsed, 1) if elapsed else 0.0,
+        "fills": fills,
+        "fills_per_sec": round(fills / elapsed, 1) if elapsed else 0.0,
+        "queries_per_order": round(sum(order_queries) / len(order_queries), 2) if order_queries else 0.0,
+        "overall": summarize(all_latencies, all_queries, elapsed),
+        "by_kind": {kind: summarize(latencies[kind], queries[kind], elapsed) for kind in latencies},
+    }
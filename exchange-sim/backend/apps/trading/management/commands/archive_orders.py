@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from apps.trading.services.archive_service import archive_closed_orders
+
+
+class Command(BaseCommand):
+    help = "Move filled and canceled orders out of the live Order table in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--min-age", type=int, default=3600, help="Seconds an order must be old to be archived")
+        parser.add_argument("--poll-interval", type=float, default=60.0, help="Seconds to sleep when caught up")
+        parser.add_argument("--once", action="store_true", help="Archive what is eligible and exit")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            close_old_connections()
+            older_than = timezone.now() - timezone.timedelta(seconds=options["min_age"])
+            moved = archive_closed_orders(options["batch_size"], older_than)
+            total += moved
+            if moved < options["batch_size"]:
+                if options["once"]:
+                    self.stdout.write(self.style.SUCCESS(f"Archived {total} orders"))
+                    return
+                time.sleep(options["poll_interval"])
@@ -0,0 +1,51 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.trading.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = "Replay seeded synthetic order flow through the matching engine and report throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--orders", type=int, default=2000, help="Commands in the timed flow")
+        parser.add_argument("--users", type=int, default=10)
+        parser.add_argument("--depth", type=int, default=0, help="Price levels per side resting before the run")
+        parser.add_argument("--per-level", type=int, default=1, help="Resting orders per seeded level")
+        parser.add_argument("--market", action="append", dest="markets", help="Limit to a market (repeatable)")
+        parser.add_argument("--output", help="Write the JSON report to this path")
+        parser.add_argument("--keep", action="store_true", help="Leave bench users, markets and orders in place")
+
+    def handle(self, *args, **options):
+        try:
+            report = run_benchmark(
+                seed=options["seed"],
+                orders=options["orders"],
+                users=options["users"],
+                depth_levels=options["depth"],
+                per_level=options["per_level"],
+                symbols=options["markets"],
+                keep=options["keep"],
+            )
+        except RuntimeError as exc:
+            raise CommandError(str(exc))
+
+        if options["output"]:
+            with open(options["output"], "w") as fh:
+                json.dump(report, fh, indent=2)
+
+        env = report["environment"]
+        self.stdout.write(f"{env['database']} / {env['matching_engine']} engine, {report['elapsed_sec']}s")
+        self.stdout.write(
+            f"{report['orders_per_sec']} orders/s, {report['fills_per_sec']} fills/s, "
+            f"{report['queries_per_order']} queries/order"
+        )
+        for kind, stats in [("overall", report["overall"])] + sorted(report["by_kind"].items()):
+            self.stdout.write(
+                f"  {kind:<9} n={stats['count']:<6} p50={stats['p50_ms']}ms "
+                f"p99={stats['p99_ms']}ms p999={stats['p999_ms']}ms q/op={stats['queries_per_op']}"
+            )
+        if options["output"]:
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
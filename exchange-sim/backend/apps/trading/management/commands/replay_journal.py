@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common.money import from_units
+from apps.trading.services.book_journal import ENTRY_CANCEL, book_matches_database, replay, segment_paths
+from apps.trading.services.order_book import BOOK_SCALE
+
+
+def _fmt(units) -> str:
+    return f"{from_units(units, BOOK_SCALE):.8f}"
+
+
+class Command(BaseCommand):
+    help = "Rebuild a market's in-memory book from its snapshot and command journal"
+
+    def add_arguments(self, parser):
+        parser.add_argument("market")
+        parser.add_argument("--dir", default=None, help="Journal directory (default ORDER_BOOK_JOURNAL_DIR)")
+        parser.add_argument(
+            "--from-start",
+            action="store_true",
+            help="Ignore the snapshot and replay every retained segment from an empty book",
+        )
+        parser.add_argument("--until", type=int, default=None, help="Stop after this journal sequence number")
+        parser.add_argument("--verbose", action="store_true", help="Print every command and the fills it produced")
+        parser.add_argument("--check", action="store_true", help="Compare the result with open orders in the database")
+
+    def handle(self, *args, **options):
+        directory = options["dir"] or getattr(settings, "ORDER_BOOK_JOURNAL_DIR", "")
+        if not directory:
+            raise CommandError("No journal directory; pass --dir or set ORDER_BOOK_JOURNAL_DIR")
+        symbol = options["market"]
+        segments = segment_paths(directory, symbol)
+        if options["from_start"] and segments and segments[0][0] != 1:
+            self.stderr.write(f"Oldest retained segment starts at seq {segments[0][0]}; earlier commands are gone")
+
+        def show(entry, fills):
+            if entry.kind == ENTRY_CANCEL:
+                self.stdout.write(f"{entry.seq:>10} CANCEL #{entry.order_id}")
+                return
+            self.stdout.write(
+                f"{entry.seq:>10} {entry.side:<4} #{entry.order_id} user={entry.user_id} "
+                f"{_fmt(entry.amount - entry.filled)} @ {_fmt(entry.price)}"
+            )
+            for maker, trade_units, price in fills:
+                self.stdout.write(f"{'':>10}   fill #{maker.id} user={maker.user_id} {_fmt(trade_units)} @ {_fmt(price)}")
+
+        book, seq = replay(
+            directory,
+            symbol,
+            from_snapshot=not options["from_start"],
+            until_seq=options["until"],
+            on_entry=show if options["verbose"] else None,
+        )
+        self.stdout.write(f"{symbol} at seq {seq}: {len(book.orders)} resting orders")
+        for side in ("BUY", "SELL"):
+            levels = book.depth(side)[:5]
+            self.stdout.write(f"  {side}: " + ", ".join(f"{_fmt(qty)} @ {_fmt(p)}" for p, qty in levels))
+
+        if options["check"]:
+            if book_matches_database(book):
+                self.stdout.write(self.style.SUCCESS("Matches open orders in the database"))
+            else:
+                raise CommandError("Replayed book differs from open orders in the database")
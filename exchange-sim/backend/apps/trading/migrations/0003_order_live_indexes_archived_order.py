@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:51
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0002_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('market_symbol', models.CharField(max_length=20)),
+                ('side', models.CharField(max_length=4)),
+                ('type', models.CharField(default='LIMIT', max_length=10)),
+                ('price', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('amount', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('filled_amount', models.DecimalField(decimal_places=8, default=Decimal('0'), max_digits=28)),
+                ('status', models.CharField(max_length=20)),
+                ('created_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='order',
+            name='trading_ord_market__61cb23_idx',
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status__in', ('OPEN', 'PARTIALLY_FILLED'))), fields=['market_symbol', 'side', 'price', 'created_at'], name='trading_order_book_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status__in', ('OPEN', 'PARTIALLY_FILLED'))), fields=['user', 'created_at'], name='trading_order_user_live_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedorder',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_orders', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='archivedorder',
+            index=models.Index(fields=['user', 'created_at'], name='trading_arc_user_id_c6999e_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0004_trade_created_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trade',
+            name='buy_order',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='trades_as_buyer', to='trading.order'),
+        ),
+        migrations.AlterField(
+            model_name='trade',
+            name='sell_order',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='trades_as_seller', to='trading.order'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Trade order references become plain id columns.
+
+    The columns, their types and their indexes stay as they are; only the
+    constraint-free foreign keys in the model state are replaced.
+    """
+
+    dependencies = [
+        ('trading', '0005_trade_order_soft_references'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveField(model_name='trade', name='buy_order'),
+                migrations.RemoveField(model_name='trade', name='sell_order'),
+                migrations.AddField(
+                    model_name='trade',
+                    name='buy_order_id',
+                    field=models.BigIntegerField(db_index=True),
+                ),
+                migrations.AddField(
+                    model_name='trade',
+                    name='sell_order_id',
+                    field=models.BigIntegerField(db_index=True),
+                ),
+            ],
+        ),
+    ]
@@ -2,6 +2,12 @@ from decimal import Decimal
 from django.db import models
 from django.conf import settings
 
+from common.constants import ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED
+
+# Orders the book, matching and open-order queries care about. Indexes built
+# only over these rows stay the same size however much history piles up.
+LIVE_ORDER = models.Q(status__in=(ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED))
+
 
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="orders")
@@ -16,20 +22,81 @@ class Order(models.Model):
 
     class Meta:
         indexes = [
-            models.Index(fields=["market_symbol", "side", "status", "price", "created_at"]),
+            models.Index(
+                fields=["market_symbol", "side", "price", "created_at"],
+                condition=LIVE_ORDER,
+                name="trading_order_book_live_idx",
+            ),
+            models.Index(fields=["user", "created_at"], condition=LIVE_ORDER, name="trading_order_user_live_idx"),
         ]
         ordering = ["-created_at"]
 
 
+class ArchivedOrder(models.Model):
+    """A closed order moved out of `Order`, keeping its original id."""
+
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="archived_orders")
+    market_symbol = models.CharField(max_length=20)
+    side = models.CharField(max_length=4)
+    type = models.CharField(max_length=10, default="LIMIT")
+    price = models.DecimalField(max_digits=28, decimal_places=8)
+    amount = models.DecimalField(max_digits=28, decimal_places=8)
+    filled_amount = models.DecimalField(max_digits=28, decimal_places=8, default=Decimal("0"))
+    status = models.CharField(max_length=20)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "created_at"])]
+        ordering = ["-created_at"]
+
+
 class Trade(models.Model):
     market_symbol = models.CharField(max_length=20)
     price = models.DecimalField(max_digits=28, decimal_places=8)
     amount = models.DecimalField(max_digits=28, decimal_places=8)
-    buy_order = models.ForeignKey(Order, on_delete=models.PROTECT, related_name="trades_as_buyer")
-    sell_order = models.ForeignKey(Order, on_delete=models.PROTECT, related_name="trades_as_seller")
+    # Plain ids rather than foreign keys: closed orders move to ArchivedOrder
+    # under the same id. `buy_order` and `sell_order` resolve them in either.
+    buy_order_id = models.BigIntegerField(db_index=True)
+    sell_order_id = models.BigIntegerField(db_index=True)
     taker_side = models.CharField(max_length=4)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        indexes = [models.Index(fields=["market_symbol", "created_at"])]
+        indexes = [
+            models.Index(fields=["market_symbol", "created_at"]),
+            models.Index(fields=["created_at"], name="trading_trade_created_idx"),
+        ]
         ordering = ["-created_at"]
+
+    @property
+    def buy_order(self):
+        return self._order(self.buy_order_id)
+
+    @buy_order.setter
+    def buy_order(self, order) -> None:
+        self.buy_order_id = self._remember(order)
+
+    @property
+    def sell_order(self):
+        return self._order(self.sell_order_id)
+
+    @sell_order.setter
+    def sell_order(self, order) -> None:
+        self.sell_order_id = self._remember(order)
+
+    def _order(self, order_id):
+        orders = self.__dict__.setdefault("_orders", {})
+        if order_id not in orders:
+            orders[order_id] = resolve_order(order_id)
+        return orders[order_id]
+
+    def _remember(self, order) -> int:
+        self.__dict__.setdefault("_orders", {})[order.id] = order
+        return order.id
+
+
+def resolve_order(order_id):
+    """The live `Order` or the `ArchivedOrder` with `order_id`; None if its user was deleted."""
+    return Order.objects.filter(id=order_id).first() or ArchivedOrder.objects.filter(id=order_id).first()
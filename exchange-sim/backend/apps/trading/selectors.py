@@ -1,36 +1,36 @@
-from django.db.models import Sum
-from .models import Order
+from itertools import chain
+
+from .models import ArchivedOrder, Order
+from .services.depth_cache import format_levels, get_market_depth
 
 ORDER_BOOK_LIMIT = 50
 
 
 def get_orderbook_bids(market_symbol: str, limit: int = ORDER_BOOK_LIMIT):
-    from common.constants import ORDER_SIDE_BUY, ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED
-    from django.db.models import F
-    qs = (
-        Order.objects.filter(
-            market_symbol=market_symbol,
-            side=ORDER_SIDE_BUY,
-            status__in=(ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED),
-        )
-        .values("price")
-        .annotate(total_qty=Sum(F("amount") - F("filled_amount")))
-        .order_by("-price")[:limit]
-    )
-    return [[str(item["price"]), str(item["total_qty"])] for item in qs]
+    from common.constants import ORDER_SIDE_BUY
+    levels = get_market_depth(market_symbol).top(ORDER_SIDE_BUY, limit)
+    return format_levels(levels)
 
 
 def get_orderbook_asks(market_symbol: str, limit: int = ORDER_BOOK_LIMIT):
-    from common.constants import ORDER_SIDE_SELL, ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED
-    from django.db.models import F
-    qs = (
-        Order.objects.filter(
-            market_symbol=market_symbol,
-            side=ORDER_SIDE_SELL,
-            status__in=(ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED),
-        )
-        .values("price")
-        .annotate(total_qty=Sum(F("amount") - F("filled_amount")))
-        .order_by("price")[:limit]
-    )
-    return [[str(item["price"]), str(item["total_qty"])] for item in qs]
+    from common.constants import ORDER_SIDE_SELL
+    levels = get_market_depth(market_symbol).top(ORDER_SIDE_SELL, limit)
+    return format_levels(levels)
+
+
+def get_orderbook_snapshot(market_symbol: str, limit: int = ORDER_BOOK_LIMIT) -> dict:
+    """Top levels of both sides with the delta sequence number they correspond to."""
+    seq, bids, asks = get_market_depth(market_symbol).snapshot(limit)
+    return {
+        "symbol": market_symbol,
+        "seq": seq,
+        "bids": format_levels(bids),
+        "asks": format_levels(asks),
+    }
+
+
+def get_order_history(user, limit: int = 100) -> list:
+    """A user's most recent orders across the live and archived tables."""
+    live = Order.objects.filter(user=user).order_by("-created_at")[:limit]
+    archived = ArchivedOrder.objects.filter(user=user).order_by("-created_at")[:limit]
+    return sorted(chain(live, archived), key=lambda o: o.created_at, reverse=True)[:limit]
@@ -19,6 +19,9 @@ class OrderSerializer(serializers.ModelSerializer):
 
 
 class TradeSerializer(serializers.ModelSerializer):
+    buy_order = serializers.IntegerField(source="buy_order_id", read_only=True)
+    sell_order = serializers.IntegerField(source="sell_order_id", read_only=True)
+
     class Meta:
         model = Trade
         fields = (
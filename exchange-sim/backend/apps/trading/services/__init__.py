@@ -2,3 +2,4 @@ from .order_service import create_limit_order, cancel_order
 from .matching_engine import match_order
 from .settlement_service import settle_trade
 from .fee_service import compute_order_fee
+from .sequencer import submit_limit_order, submit_cancel_order
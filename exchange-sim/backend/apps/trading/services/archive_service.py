@@ -0,0 +1,42 @@
+from django.db import transaction
+from django.utils import timezone
+
+from common.constants import ORDER_STATUS_CANCELED, ORDER_STATUS_FILLED
+from ..models import ArchivedOrder, Order
+
+ARCHIVED_FIELDS = (
+    "id",
+    "user_id",
+    "market_symbol",
+    "side",
+    "type",
+    "price",
+    "amount",
+    "filled_amount",
+    "status",
+    "created_at",
+)
+
+
+def archivable_orders(older_than):
+    """Closed orders created before `older_than`.
+
+    Trades hold plain order ids, so filled orders move too; `Trade.buy_order`
+    and `sell_order` then resolve the same ids in `ArchivedOrder`.
+    """
+    return (
+        Order.objects.filter(status__in=(ORDER_STATUS_FILLED, ORDER_STATUS_CANCELED), created_at__lt=older_than)
+        .order_by("id")
+    )
+
+
+def archive_closed_orders(batch_size: int = 1000, older_than=None) -> int:
+    """Move one batch of closed orders to `ArchivedOrder`. Returns how many moved."""
+    older_than = older_than or timezone.now()
+    with transaction.atomic():
+        rows = list(archivable_orders(older_than).values_list(*ARCHIVED_FIELDS)[:batch_size])
+        if not rows:
+            return 0
+        ArchivedOrder.objects.bulk_create([ArchivedOrder(**dict(zip(ARCHIVED_FIELDS, row))) for row in rows])
+        Order.objects.filter(id__in=[row[0] for row in rows]).delete()
+    return len(rows)
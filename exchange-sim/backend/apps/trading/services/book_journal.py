@@ -0,0 +1,358 @@
+import os
+import struct
+import threading
+import zlib
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Count, Max, Sum
+
+from common.constants import (
+    ORDER_SIDE_BUY,
+    ORDER_SIDE_SELL,
+    ORDER_STATUS_OPEN,
+    ORDER_STATUS_PARTIALLY_FILLED,
+)
+from common.money import to_units
+from .order_book import (
+    BOOK_SCALE,
+    BookOrder,
+    OrderBook,
+    cached_order_book,
+    load_order_book,
+    memory_engine_enabled,
+)
+
+# Journal: fixed-size records, each followed by the CRC32 of its body, so a
+# torn write at the tail is detected and replay stops there.
+ENTRY_ORDER = b"O"
+ENTRY_CANCEL = b"C"
+ENTRY_FORMAT = struct.Struct("<cqqqBqqq")
+ENTRY_CRC = struct.Struct("<I")
+ENTRY_SIZE = ENTRY_FORMAT.size + ENTRY_CRC.size
+
+# Snapshot: header, resting orders in time priority per level, CRC32 trailer.
+SNAPSHOT_MAGIC = b"OBS1"
+SNAPSHOT_HEADER = struct.Struct("<4sqI")
+SNAPSHOT_ORDER = struct.Struct("<qqBqqq")
+
+SIDE_CODES = {ORDER_SIDE_BUY: 0, ORDER_SIDE_SELL: 1}
+SIDE_NAMES = {code: side for side, code in SIDE_CODES.items()}
+
+
+class JournalEntry(NamedTuple):
+    kind: bytes
+    seq: int
+    order_id: int
+    user_id: int = 0
+    side: str = ORDER_SIDE_BUY
+    price: int = 0
+    amount: int = 0
+    filled: int = 0
+
+    def pack(self) -> bytes:
+        body = ENTRY_FORMAT.pack(
+            self.kind, self.seq, self.order_id, self.user_id, SIDE_CODES[self.side],
+            self.price, self.amount, self.filled,
+        )
+        return body + ENTRY_CRC.pack(zlib.crc32(body))
+
+    @classmethod
+    def unpack(cls, data: bytes):
+        body = data[:ENTRY_FORMAT.size]
+        (crc,) = ENTRY_CRC.unpack(data[ENTRY_FORMAT.size:])
+        if zlib.crc32(body) != crc:
+            return None
+        kind, seq, order_id, user_id, side, price, amount, filled = ENTRY_FORMAT.unpack(body)
+        return cls(kind, seq, order_id, user_id, SIDE_NAMES[side], price, amount, filled)
+
+
+def journal_enabled() -> bool:
+    return memory_engine_enabled() and bool(getattr(settings, "ORDER_BOOK_JOURNAL_DIR", ""))
+
+
+def snapshot_path(directory: str, market_symbol: str) -> str:
+    return os.path.join(directory, f"{market_symbol}.snap")
+
+
+def segment_paths(directory: str, market_symbol: str) -> list:
+    """Journal segments for a market as `(first_seq, path)`, oldest first."""
+    prefix = f"{market_symbol}."
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith(".log"):
+            first_seq = name[len(prefix):-len(".log")]
+            if first_seq.isdigit():
+                segments.append((int(first_seq), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def write_snapshot(path: str, book: OrderBook, seq: int) -> None:
+    """Atomically replace the snapshot at `path` with `book` as of journal `seq`."""
+    chunks = []
+    for book_side in (book.bids, book.asks):
+        for price in book_side.prices:
+            for r in book_side.levels[price]:
+                chunks.append(SNAPSHOT_ORDER.pack(r.id, r.user_id, SIDE_CODES[r.side], r.price, r.amount, r.filled_amount))
+    data = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, seq, len(chunks)) + b"".join(chunks)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data + ENTRY_CRC.pack(zlib.crc32(data)))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: str, market_symbol: str):
+    """`(book, seq)` from a snapshot file, or `(None, 0)` if missing or corrupt."""
+    try:
+        with open(path, "rb") as fh:
+            data = fh.read()
+    except FileNotFoundError:
+        return None, 0
+    if len(data) < SNAPSHOT_HEADER.size + ENTRY_CRC.size:
+        return None, 0
+    body, (crc,) = data[:-ENTRY_CRC.size], ENTRY_CRC.unpack(data[-ENTRY_CRC.size:])
+    magic, seq, count = SNAPSHOT_HEADER.unpack_from(body)
+    if magic != SNAPSHOT_MAGIC or zlib.crc32(body) != crc:
+        return None, 0
+    if len(body) != SNAPSHOT_HEADER.size + count * SNAPSHOT_ORDER.size:
+        return None, 0
+    book = OrderBook(market_symbol)
+    for fields in SNAPSHOT_ORDER.iter_unpack(body[SNAPSHOT_HEADER.size:]):
+        order_id, user_id, side, price, amount, filled = fields
+        book.add(BookOrder(order_id, user_id, SIDE_NAMES[side], price, amount, filled))
+    return book, seq
+
+
+def read_journal(directory: str, market_symbol: str, after_seq: int = 0, until_seq: int = None):
+    """Yield entries with `after_seq < seq <= until_seq`, stopping at the first gap or torn record."""
+    expected = None
+    for _, path in segment_paths(directory, market_symbol):
+        with open(path, "rb") as fh:
+            while True:
+                data = fh.read(ENTRY_SIZE)
+                if len(data) < ENTRY_SIZE:
+                    break
+                entry = JournalEntry.unpack(data)
+                if entry is None or (expected is not None and entry.seq != expected):
+                    return
+                expected = entry.seq + 1
+                if until_seq is not None and entry.seq > until_seq:
+                    return
+                if entry.seq > after_seq:
+                    yield entry
+
+
+def truncate_journal(directory: str, market_symbol: str, last_seq: int) -> None:
+    """Cut every segment back to entries up to `last_seq`, dropping torn tails."""
+    for first_seq, path in segment_paths(directory, market_symbol):
+        if first_seq > last_seq:
+            os.remove(path)
+            continue
+        size = (last_seq - first_seq + 1) * ENTRY_SIZE
+        if os.path.getsize(path) > size:
+            os.truncate(path, size)
+
+
+def apply_entry(book: OrderBook, entry: JournalEntry) -> list:
+    """Apply one command exactly as the live engine did. Returns the fills."""
+    if entry.kind == ENTRY_CANCEL:
+        book.remove(entry.order_id)
+        return []
+    book.remove(entry.order_id)
+    fills = book.match(entry.side, entry.price, entry.amount - entry.filled)
+    filled = entry.filled + sum(trade_units for _, trade_units, _ in fills)
+    book.add(BookOrder(entry.order_id, entry.user_id, entry.side, entry.price, entry.amount, filled))
+    return fills
+
+
+def replay(directory: str, market_symbol: str, from_snapshot: bool = True, until_seq: int = None, on_entry=None):
+    """Rebuild a book from the snapshot (or from empty) plus the journal. Returns `(book, last_seq)`."""
+    book, seq = (None, 0)
+    if from_snapshot:
+        book, seq = read_snapshot(snapshot_path(directory, market_symbol), market_symbol)
+    if book is None:
+        book, seq = OrderBook(market_symbol), 0
+    for entry in read_journal(directory, market_symbol, after_seq=seq, until_seq=until_seq):
+        fills = apply_entry(book, entry)
+        seq = entry.seq
+        if on_entry is not None:
+            on_entry(entry, fills)
+    return book, seq
+
+
+def book_matches_database(book: OrderBook) -> bool:
+    """Cheap consistency check of a recovered book against the open orders table."""
+    from ..models import Order
+
+    stats = Order.objects.filter(
+        market_symbol=book.market_symbol,
+        status__in=(ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED),
+    ).aggregate(count=Count("id"), max_id=Max("id"), remaining=Sum(F("amount") - F("filled_amount")))
+    remaining = to_units(stats["remaining"], BOOK_SCALE) if stats["remaining"] is not None else 0
+    return (
+        stats["count"] == len(book.orders)
+        and stats["max_id"] == (max(book.orders) if book.orders else None)
+        and remaining == sum(r.remaining for r in book.orders.values())
+    )
+
+
+class BookJournal:
+    """Append-only command journal for one market with group-commit fsync.
+
+    `append` returns once its entry is on disk. Entries from threads that
+    arrive while an fsync is in flight are written and synced together by the
+    next one, so the cost of fsync is shared instead of paid per command.
+    """
+
+    def __init__(self, directory: str, market_symbol: str, last_seq: int):
+        self.directory = directory
+        self.market_symbol = market_symbol
+        self.seq = last_seq
+        self.durable_seq = last_seq
+        self.snapshot_seq = last_seq
+        self.needs_snapshot = False
+        self.broken = None
+        self.pending = []
+        self.flushing = False
+        self.cond = threading.Condition()
+        self.file = self._open_segment(last_seq + 1)
+        self.thread = threading.Thread(target=self._run, name=f"journal-{market_symbol}", daemon=True)
+        self.thread.start()
+
+    def _open_segment(self, first_seq: int):
+        return open(os.path.join(self.directory, f"{self.market_symbol}.{first_seq:012d}.log"), "ab")
+
+    def append(self, kind: bytes, order_id: int, user_id=0, side=ORDER_SIDE_BUY, price=0, amount=0, filled=0) -> int:
+        with self.cond:
+            self.seq += 1
+            seq = self.seq
+            self.pending.append(JournalEntry(kind, seq, order_id, user_id, side, price, amount, filled).pack())
+            self.cond.notify_all()
+            while self.durable_seq < seq:
+                self.cond.wait()
+            if self.broken is not None:
+                raise self.broken
+        return seq
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                batch, self.pending = self.pending, []
+                target = self.seq
+                self.flushing = True
+                fh = self.file
+            try:
+                fh.write(b"".join(batch))
+                fh.flush()
+                os.fsync(fh.fileno())
+            except OSError as exc:
+                # The journal now has a hole; recovery will notice and fall
+                # back to the database, so stop accepting entries.
+                self.broken = exc
+            finally:
+                with self.cond:
+                    self.durable_seq = target
+                    self.flushing = False
+                    self.cond.notify_all()
+
+    def maybe_snapshot(self, book: OrderBook, seq: int) -> None:
+        """Snapshot `book`, which reflects every entry up to `seq`, when one is due."""
+        interval = getattr(settings, "ORDER_BOOK_SNAPSHOT_INTERVAL", 10000)
+        if not self.needs_snapshot and seq - self.snapshot_seq < interval:
+            return
+        with self.cond:
+            while self.pending or self.flushing or self.seq != seq:
+                if self.seq != seq:
+                    # Another command got in after ours; the next one will snapshot.
+                    return
+                self.cond.wait()
+            write_snapshot(snapshot_path(self.directory, self.market_symbol), book, seq)
+            self.file.close()
+            self.file = self._open_segment(seq + 1)
+            self.snapshot_seq = seq
+            self.needs_snapshot = False
+        self._prune_segments(seq)
+
+    def _prune_segments(self, snapshot_seq: int) -> None:
+        """Drop segments fully covered by the snapshot beyond the retained few."""
+        retain = getattr(settings, "ORDER_BOOK_JOURNAL_RETAIN", 10)
+        covered = [path for first_seq, path in segment_paths(self.directory, self.market_symbol) if first_seq <= snapshot_seq]
+        for path in covered[:max(len(covered) - retain, 0)]:
+            os.remove(path)
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def open_order_book(market_symbol: str) -> OrderBook:
+    """Load snapshot and replay the journal tail, falling back to the database.
+
+    A recovered book is only used if it agrees with the open orders table; a
+    book rebuilt from the database is snapshotted with the next command.
+    """
+    directory = settings.ORDER_BOOK_JOURNAL_DIR
+    with _journals_lock:
+        os.makedirs(directory, exist_ok=True)
+        journal = _journals.get(market_symbol)
+        book, seq = replay(directory, market_symbol)
+        if journal is None:
+            truncate_journal(directory, market_symbol, seq)
+            journal = _journals[market_symbol] = BookJournal(directory, market_symbol, seq)
+        if seq == journal.seq and book_matches_database(book):
+            return book
+        journal.needs_snapshot = True
+    return load_order_book(market_symbol)
+
+
+def discard_journal(market_symbol: str) -> None:
+    """Stop journaling a market and delete its files, for a market that is being removed."""
+    if not journal_enabled():
+        return
+    directory = settings.ORDER_BOOK_JOURNAL_DIR
+    with _journals_lock:
+        journal = _journals.pop(market_symbol, None)
+        if journal is not None:
+            with journal.cond:
+                journal.file.close()
+        paths = [path for _, path in segment_paths(directory, market_symbol)] if os.path.isdir(directory) else []
+        snapshot = snapshot_path(directory, market_symbol)
+        for path in paths + ([snapshot] if os.path.exists(snapshot) else []):
+            os.remove(path)
+
+
+def _append(market_symbol: str, kind: bytes, **fields) -> None:
+    journal = _journals.get(market_symbol)
+    if journal is None:
+        return
+    seq = journal.append(kind, **fields)
+    book = cached_order_book(market_symbol)
+    if book is not None:
+        journal.maybe_snapshot(book, seq)
+
+
+def record_order(order) -> None:
+    """Journal an accepted order once its transaction commits."""
+    if not journal_enabled():
+        return
+    fields = dict(
+        order_id=order.id,
+        user_id=order.user_id,
+        side=order.side,
+        price=to_units(order.price, BOOK_SCALE),
+        amount=to_units(order.amount, BOOK_SCALE),
+        filled=to_units(order.filled_amount, BOOK_SCALE),
+    )
+    transaction.on_commit(lambda: _append(order.market_symbol, ENTRY_ORDER, **fields), robust=True)
+
+
+def record_cancel(market_symbol: str, order_id: int) -> None:
+    """Journal a cancel once its transaction commits."""
+    if not journal_enabled():
+        return
+    transaction.on_commit(lambda: _append(market_symbol, ENTRY_CANCEL, order_id=order_id), robust=True)
@@ -0,0 +1,247 @@
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Sum
+
+from common.constants import (
+    ORDER_SIDE_BUY,
+    ORDER_SIDE_SELL,
+    ORDER_STATUS_OPEN,
+    ORDER_STATUS_PARTIALLY_FILLED,
+)
+
+CACHE_KEY_DEPTH_VERSION = "orderbook:depth_version:{symbol}"
+
+
+def format_levels(levels) -> list:
+    """Render levels at the storage scale so a price always has one spelling."""
+    return [[f"{price:.8f}", f"{qty:.8f}"] for price, qty in levels]
+
+
+class DepthSide:
+    """Aggregated remaining quantity per price, with prices kept sorted."""
+
+    def __init__(self, descending: bool):
+        self.descending = descending
+        self.prices = []
+        self.qty = {}
+
+    def apply(self, price, delta) -> None:
+        qty = self.qty.get(price)
+        if qty is None:
+            if delta <= 0:
+                return
+            insort(self.prices, price)
+            self.qty[price] = delta
+            return
+        qty += delta
+        if qty > 0:
+            self.qty[price] = qty
+        else:
+            del self.qty[price]
+            del self.prices[bisect_left(self.prices, price)]
+
+    def top(self, limit: int) -> list:
+        if limit <= 0:
+            return []
+        prices = self.prices[-limit:][::-1] if self.descending else self.prices[:limit]
+        return [(p, self.qty[p]) for p in prices]
+
+
+class MarketDepth:
+    def __init__(self, market_symbol: str, version: int):
+        self.market_symbol = market_symbol
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.bids = DepthSide(descending=True)
+        self.asks = DepthSide(descending=False)
+        self.lock = threading.Lock()
+
+    def side_for(self, side: str) -> DepthSide:
+        return self.bids if side == ORDER_SIDE_BUY else self.asks
+
+    def apply(self, changes, version: int = None) -> None:
+        with self.lock:
+            for side, price, delta in changes:
+                self.side_for(side).apply(price, delta)
+            if version is not None:
+                self.version = version
+
+    def top(self, side: str, limit: int) -> list:
+        with self.lock:
+            return self.side_for(side).top(limit)
+
+    def snapshot(self, limit: int):
+        """`(version, bids, asks)` read together, so the version describes the levels."""
+        with self.lock:
+            return self.version, self.bids.top(limit), self.asks.top(limit)
+
+    def levels(self, side: str, prices) -> list:
+        """Current quantity at each of `prices`, zero for levels that are gone."""
+        book_side = self.side_for(side)
+        with self.lock:
+            return [(p, book_side.qty.get(p, 0)) for p in prices]
+
+
+_depths = {}
+_depths_lock = threading.Lock()
+
+
+def _shared_version(market_symbol: str) -> int:
+    return cache.get(CACHE_KEY_DEPTH_VERSION.format(symbol=market_symbol)) or 0
+
+
+def _bump_shared_version(market_symbol: str) -> int:
+    key = CACHE_KEY_DEPTH_VERSION.format(symbol=market_symbol)
+    cache.add(key, 0, None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Evicted between add and incr; start over rather than guess.
+        cache.set(key, 1, None)
+        return 1
+
+
+def aggregate_depth(market_symbol: str, side: str) -> list:
+    """Price levels for one side straight from the database, unordered."""
+    from ..models import Order
+
+    return list(
+        Order.objects.filter(
+            market_symbol=market_symbol,
+            side=side,
+            status__in=(ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED),
+        )
+        .values("price")
+        .annotate(total_qty=Sum(F("amount") - F("filled_amount")))
+        .values_list("price", "total_qty")
+    )
+
+
+def load_market_depth(market_symbol: str) -> MarketDepth:
+    """Rebuild a market's depth from open orders."""
+    depth = MarketDepth(market_symbol, _shared_version(market_symbol))
+    depth.apply(
+        [(ORDER_SIDE_BUY, price, qty) for price, qty in aggregate_depth(market_symbol, ORDER_SIDE_BUY)]
+        + [(ORDER_SIDE_SELL, price, qty) for price, qty in aggregate_depth(market_symbol, ORDER_SIDE_SELL)]
+    )
+    return depth
+
+
+def get_market_depth(market_symbol: str) -> MarketDepth:
+    """Current depth for a market, reloading it if another process has written since.
+
+    Copies are also reloaded after ORDERBOOK_DEPTH_MAX_AGE seconds, which bounds
+    the damage of a reload racing a commit whose change is not yet applied.
+    """
+    depth = _depths.get(market_symbol)
+    max_age = getattr(settings, "ORDERBOOK_DEPTH_MAX_AGE", 30)
+    if (
+        depth is None
+        or depth.version != _shared_version(market_symbol)
+        or time.monotonic() - depth.loaded_at > max_age
+    ):
+        depth = load_market_depth(market_symbol)
+        # Inside a transaction the load may see changes that are only applied
+        # on commit, so it is served but not kept.
+        if not transaction.get_connection().in_atomic_block:
+            with _depths_lock:
+                _depths[market_symbol] = depth
+    return depth
+
+
+def discard_market_depth(market_symbol: str | None = None) -> None:
+    with _depths_lock:
+        if market_symbol is None:
+            _depths.clear()
+        else:
+            _depths.pop(market_symbol, None)
+
+
+def invalidate_market_depth(market_symbol: str) -> None:
+    """Force every process to reload after orders were changed behind the cache's back."""
+    discard_market_depth(market_symbol)
+    _bump_shared_version(market_symbol)
+
+
+def record_depth_changes(market_symbol: str, changes) -> None:
+    """Apply `(side, price, qty_delta)` changes once the current transaction commits.
+
+    With the realtime outbox enabled the delta is numbered and written to the
+    outbox now, inside the transaction, so it is relayed only if that commits.
+    """
+    from apps.realtime.services import outbox_enabled
+
+    changes = [(side, price, delta) for side, price, delta in changes if delta]
+    if not changes:
+        return
+    version = None
+    if outbox_enabled():
+        version = _bump_shared_version(market_symbol)
+        _publish_uncommitted_delta(market_symbol, version, changes)
+    transaction.on_commit(lambda: _apply_committed(market_symbol, changes, version), robust=True)
+
+
+def _apply_committed(market_symbol: str, changes, version: int = None) -> None:
+    depth = _depths.get(market_symbol)
+    published = version is not None
+    if not published:
+        version = _bump_shared_version(market_symbol)
+    if depth is not None and depth.version + 1 == version:
+        depth.apply(changes, version)
+    else:
+        # Cold, or another process wrote in between and our copy is missing
+        # its changes. The transaction has committed, so a reload is exact.
+        depth = load_market_depth(market_symbol)
+        with _depths_lock:
+            _depths[market_symbol] = depth
+    if not published:
+        _publish_delta(depth, version, changes)
+
+
+def _changed_prices(changes) -> dict:
+    changed = {ORDER_SIDE_BUY: [], ORDER_SIDE_SELL: []}
+    for side, price, _ in changes:
+        if price not in changed[side]:
+            changed[side].append(price)
+    return changed
+
+
+def _publish_delta(depth: MarketDepth, version: int, changes) -> None:
+    from apps.realtime.services import broadcast_orderbook_delta
+
+    changed = _changed_prices(changes)
+    broadcast_orderbook_delta(
+        depth.market_symbol,
+        version,
+        format_levels(depth.levels(ORDER_SIDE_BUY, changed[ORDER_SIDE_BUY])),
+        format_levels(depth.levels(ORDER_SIDE_SELL, changed[ORDER_SIDE_SELL])),
+    )
+
+
+def _publish_uncommitted_delta(market_symbol: str, version: int, changes) -> None:
+    """Send the changed levels as this transaction leaves them, read from the database."""
+    from apps.realtime.services import broadcast_orderbook_delta
+    from ..models import Order
+
+    levels = {}
+    for side, prices in _changed_prices(changes).items():
+        totals = {}
+        if prices:
+            totals = dict(
+                Order.objects.filter(
+                    market_symbol=market_symbol,
+                    side=side,
+                    status__in=(ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED),
+                    price__in=prices,
+                )
+                .values("price")
+                .annotate(total_qty=Sum(F("amount") - F("filled_amount")))
+                .values_list("price", "total_qty")
+            )
+        levels[side] = format_levels([(p, totals.get(p, 0)) for p in prices])
+    broadcast_orderbook_delta(market_symbol, version, levels[ORDER_SIDE_BUY], levels[ORDER_SIDE_SELL])
@@ -1,6 +1,8 @@
 from decimal import Decimal
 from django.db import transaction
+from django.db.models import F
 
+from common.money import from_units, to_units
 from common.constants import (
     ORDER_SIDE_BUY,
     ORDER_SIDE_SELL,
@@ -9,12 +11,15 @@ from common.constants import (
     ORDER_STATUS_FILLED,
 )
 from ..models import Order, Trade
-from .settlement_service import settle_trade
-from apps.analytics.services import update_market_stats_after_trade
-from apps.realtime.services import broadcast_trade, broadcast_ticker, broadcast_orderbook_update
+from .book_journal import record_order
+from .depth_cache import record_depth_changes
+from .order_book import BOOK_SCALE, BookOrder, get_order_book, memory_engine_enabled
+from .settlement_service import SettlementBatch
+from apps.analytics.services import update_market_stats_after_trades
+from apps.realtime.services import broadcast_trade, broadcast_ticker
 
 
-def match_order(incoming: Order) -> None:
+def _counter_orders_sql(incoming: Order, remaining_new: Decimal):
     if incoming.side == ORDER_SIDE_BUY:
         counter_queryset = (
             Order.objects.filter(
@@ -38,10 +43,6 @@ def match_order(incoming: Order) -> None:
             .select_for_update()
         )
 
-    remaining_new = incoming.amount - incoming.filled_amount
-    if remaining_new <= 0:
-        return
-
     for counter in counter_queryset:
         if remaining_new <= 0:
             break
@@ -49,29 +50,87 @@ def match_order(incoming: Order) -> None:
         if remaining_counter <= 0:
             continue
         trade_amount = min(remaining_new, remaining_counter)
-        trade_price = counter.price
-        with transaction.atomic():
-            trade = Trade.objects.create(
-                market_symbol=incoming.market_symbol,
-                price=trade_price,
-                amount=trade_amount,
-                buy_order=incoming if incoming.side == ORDER_SIDE_BUY else counter,
-                sell_order=counter if incoming.side == ORDER_SIDE_SELL else incoming,
-                taker_side=incoming.side,
-            )
-            settle_trade(trade)
-            update_market_stats_after_trade(incoming.market_symbol, trade_price, trade_amount)
-            broadcast_trade(incoming.market_symbol, trade_price, trade_amount, incoming.side)
-            broadcast_ticker(incoming.market_symbol, trade_price)
-            broadcast_orderbook_update(incoming.market_symbol)
-            incoming.filled_amount += trade_amount
-            counter.filled_amount += trade_amount
-            incoming.status = (
-                ORDER_STATUS_FILLED if incoming.filled_amount >= incoming.amount else ORDER_STATUS_PARTIALLY_FILLED
-            )
-            counter.status = (
-                ORDER_STATUS_FILLED if counter.filled_amount >= counter.amount else ORDER_STATUS_PARTIALLY_FILLED
-            )
-            incoming.save(update_fields=["filled_amount", "status"])
-            counter.save(update_fields=["filled_amount", "status"])
+        yield counter, trade_amount
         remaining_new -= trade_amount
+
+
+def _counter_orders_memory(incoming: Order, remaining_new: Decimal):
+    book = get_order_book(incoming.market_symbol)
+    # A book loaded cold inside this transaction already sees the incoming order.
+    book.remove(incoming.id)
+    fills = book.match(
+        incoming.side,
+        to_units(incoming.price, BOOK_SCALE),
+        to_units(remaining_new, BOOK_SCALE),
+    )
+    counters = Order.objects.select_for_update().in_bulk([maker.id for maker, _, _ in fills])
+    for maker, trade_units, _ in fills:
+        yield counters[maker.id], from_units(trade_units, BOOK_SCALE)
+
+
+def match_order(incoming: Order) -> None:
+    remaining_new = incoming.amount - incoming.filled_amount
+    if remaining_new <= 0:
+        return
+
+    if memory_engine_enabled():
+        record_order(incoming)
+        counter_orders = _counter_orders_memory(incoming, remaining_new)
+    else:
+        counter_orders = _counter_orders_sql(incoming, remaining_new)
+
+    settlement = SettlementBatch(incoming.market_symbol)
+    trades = []
+    filled_counter_ids = []
+    partial_counters = []
+    for counter, trade_amount in counter_orders:
+        trade = Trade(
+            market_symbol=incoming.market_symbol,
+            price=counter.price,
+            amount=trade_amount,
+            buy_order=incoming if incoming.side == ORDER_SIDE_BUY else counter,
+            sell_order=counter if incoming.side == ORDER_SIDE_SELL else incoming,
+            taker_side=incoming.side,
+        )
+        settlement.add(trade)
+        trades.append(trade)
+        incoming.filled_amount += trade_amount
+        counter.filled_amount += trade_amount
+        if counter.filled_amount >= counter.amount:
+            counter.status = ORDER_STATUS_FILLED
+            filled_counter_ids.append(counter.id)
+        else:
+            counter.status = ORDER_STATUS_PARTIALLY_FILLED
+            partial_counters.append(counter)
+
+    if trades:
+        incoming.status = (
+            ORDER_STATUS_FILLED if incoming.filled_amount >= incoming.amount else ORDER_STATUS_PARTIALLY_FILLED
+        )
+        _persist_fills(incoming, trades, filled_counter_ids, partial_counters, settlement)
+
+    remaining_new = incoming.amount - incoming.filled_amount
+    if remaining_new > 0:
+        record_depth_changes(incoming.market_symbol, [(incoming.side, incoming.price, remaining_new)])
+        if memory_engine_enabled():
+            get_order_book(incoming.market_symbol).add(BookOrder.from_order(incoming))
+
+
+def _persist_fills(incoming: Order, trades, filled_counter_ids, partial_counters, settlement) -> None:
+    """Write one match's fills with a fixed number of statements however many makers were hit."""
+    symbol = incoming.market_symbol
+    with transaction.atomic():
+        Trade.objects.bulk_create(trades)
+        if filled_counter_ids:
+            Order.objects.filter(id__in=filled_counter_ids).update(
+                filled_amount=F("amount"),
+                status=ORDER_STATUS_FILLED,
+            )
+        Order.objects.bulk_update([incoming, *partial_counters], ["filled_amount", "status"])
+        settlement.apply()
+        maker_side = ORDER_SIDE_SELL if incoming.side == ORDER_SIDE_BUY else ORDER_SIDE_BUY
+        record_depth_changes(symbol, [(maker_side, trade.price, -trade.amount) for trade in trades])
+        update_market_stats_after_trades(symbol, trades)
+        for trade in trades:
+            broadcast_trade(symbol, trade.price, trade.amount, incoming.side)
+        broadcast_ticker(symbol, trades[-1].price)
@@ -0,0 +1,237 @@
+import threading
+from bisect import bisect_left, insort
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from common.constants import (
+    ORDER_SIDE_BUY,
+    ORDER_STATUS_OPEN,
+    ORDER_STATUS_PARTIALLY_FILLED,
+)
+from common.money import to_units
+
+MATCHING_ENGINE_SQL = "sql"
+MATCHING_ENGINE_MEMORY = "memory"
+
+# decimal_places of the Order price/amount columns: every stored value, and
+# every amount quantized to an asset's precision, is an exact integer here.
+BOOK_SCALE = 8
+
+
+class BookOrder:
+    """Compact resting order record kept in a price level queue.
+
+    Prices and amounts are integer units at BOOK_SCALE.
+    """
+
+    __slots__ = ("id", "user_id", "side", "price", "amount", "filled_amount")
+
+    def __init__(self, id, user_id, side, price, amount, filled_amount):
+        self.id = id
+        self.user_id = user_id
+        self.side = side
+        self.price = price
+        self.amount = amount
+        self.filled_amount = filled_amount
+
+    @classmethod
+    def from_order(cls, order):
+        return cls.from_values(order.id, order.user_id, order.side, order.price, order.amount, order.filled_amount)
+
+    @classmethod
+    def from_values(cls, id, user_id, side, price, amount, filled_amount):
+        return cls(
+            id,
+            user_id,
+            side,
+            to_units(price, BOOK_SCALE),
+            to_units(amount, BOOK_SCALE),
+            to_units(filled_amount, BOOK_SCALE),
+        )
+
+    @property
+    def remaining(self):
+        return self.amount - self.filled_amount
+
+
+class BookSide:
+    """Price levels of one side. `prices` is kept ascending; each level is a FIFO queue."""
+
+    def __init__(self, descending: bool):
+        self.descending = descending
+        self.prices = []
+        self.levels = {}
+
+    def __bool__(self):
+        return bool(self.prices)
+
+    def best_price(self):
+        if not self.prices:
+            return None
+        return self.prices[-1] if self.descending else self.prices[0]
+
+    def add(self, record: BookOrder) -> None:
+        level = self.levels.get(record.price)
+        if level is None:
+            level = self.levels[record.price] = deque()
+            insort(self.prices, record.price)
+        level.append(record)
+
+    def remove(self, record: BookOrder) -> None:
+        level = self.levels[record.price]
+        level.remove(record)
+        if not level:
+            self._drop_level(record.price)
+
+    def _drop_level(self, price) -> None:
+        del self.levels[price]
+        del self.prices[bisect_left(self.prices, price)]
+
+
+class OrderBook:
+    """Price-time priority book for a single market.
+
+    Produces the same fills as the SQL path in `match_order`: counter orders are
+    consumed best price first and, within a price, in arrival order.
+    """
+
+    def __init__(self, market_symbol: str):
+        self.market_symbol = market_symbol
+        self.bids = BookSide(descending=True)
+        self.asks = BookSide(descending=False)
+        self.orders = {}
+        self.version = 0
+
+    def __contains__(self, order_id) -> bool:
+        return order_id in self.orders
+
+    def side_for(self, side: str) -> BookSide:
+        return self.bids if side == ORDER_SIDE_BUY else self.asks
+
+    def add(self, record: BookOrder) -> None:
+        if record.remaining <= 0 or record.id in self.orders:
+            return
+        self.side_for(record.side).add(record)
+        self.orders[record.id] = record
+        self.version += 1
+
+    def remove(self, order_id) -> BookOrder | None:
+        record = self.orders.pop(order_id, None)
+        if record is not None:
+            self.side_for(record.side).remove(record)
+            self.version += 1
+        return record
+
+    def match(self, side: str, price: int, amount: int) -> list:
+        """Fill `amount` against the opposite side up to `price`, both in units.
+
+        Returns a list of `(maker, trade_amount, trade_price)` tuples. Makers are
+        updated in place and fully filled ones leave the book.
+        """
+        counter_side = self.asks if side == ORDER_SIDE_BUY else self.bids
+        fills = []
+        remaining = amount
+        while remaining > 0 and counter_side:
+            level_price = counter_side.best_price()
+            if side == ORDER_SIDE_BUY and level_price > price:
+                break
+            if side != ORDER_SIDE_BUY and level_price < price:
+                break
+            level = counter_side.levels[level_price]
+            while remaining > 0 and level:
+                maker = level[0]
+                trade_amount = min(remaining, maker.remaining)
+                maker.filled_amount += trade_amount
+                remaining -= trade_amount
+                fills.append((maker, trade_amount, level_price))
+                if maker.remaining <= 0:
+                    level.popleft()
+                    del self.orders[maker.id]
+            if not level:
+                counter_side._drop_level(level_price)
+        if fills:
+            self.version += 1
+        return fills
+
+    def depth(self, side: str) -> list:
+        book_side = self.side_for(side)
+        prices = reversed(book_side.prices) if book_side.descending else book_side.prices
+        return [(p, sum(r.remaining for r in book_side.levels[p])) for p in prices]
+
+
+_books = {}
+_books_lock = threading.Lock()
+
+
+def memory_engine_enabled() -> bool:
+    return getattr(settings, "MATCHING_ENGINE", MATCHING_ENGINE_SQL) == MATCHING_ENGINE_MEMORY
+
+
+def load_order_book(market_symbol: str) -> OrderBook:
+    """Rebuild a market's book from its open orders in the database."""
+    from ..models import Order
+
+    book = OrderBook(market_symbol)
+    qs = (
+        Order.objects.filter(
+            market_symbol=market_symbol,
+            status__in=(ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED),
+        )
+        .order_by("created_at", "id")
+        .values_list("id", "user_id", "side", "price", "amount", "filled_amount")
+    )
+    for row in qs.iterator():
+        book.add(BookOrder.from_values(*row))
+    return book
+
+
+def get_order_book(market_symbol: str) -> OrderBook:
+    book = _books.get(market_symbol)
+    if book is None:
+        with _books_lock:
+            book = _books.get(market_symbol)
+            if book is None:
+                book = _books[market_symbol] = _open_order_book(market_symbol)
+    return book
+
+
+def _open_order_book(market_symbol: str) -> OrderBook:
+    from .book_journal import journal_enabled, open_order_book
+
+    if journal_enabled():
+        return open_order_book(market_symbol)
+    return load_order_book(market_symbol)
+
+
+def cached_order_book(market_symbol: str) -> OrderBook | None:
+    """The market's book if this process has one loaded, without loading it."""
+    return _books.get(market_symbol)
+
+
+def discard_order_book(market_symbol: str | None = None) -> None:
+    """Forget in-memory state so the next access reloads it from the database."""
+    with _books_lock:
+        if market_symbol is None:
+            _books.clear()
+        else:
+            _books.pop(market_symbol, None)
+
+
+@contextmanager
+def order_book_guard(market_symbol: str):
+    """Drop the market's book if it changed inside a block that then failed.
+
+    The database transaction rolls back on error but the book does not, so any
+    mutation made inside the block would otherwise leave the two out of sync.
+    """
+    book = _books.get(market_symbol)
+    version = book.version if book is not None else None
+    try:
+        yield
+    except Exception:
+        book = _books.get(market_symbol)
+        if book is not None and book.version != version:
+            discard_order_book(market_symbol)
+        raise
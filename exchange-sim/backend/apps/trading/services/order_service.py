@@ -10,28 +10,33 @@ from common.constants import (
     LEDGER_KIND_LOCK,
     LEDGER_KIND_UNLOCK,
 )
-from common.money import quantize_usdt, quantize_btc
-from apps.markets.models import Market
+from common.money import quantize_precision
+from apps.markets.registry import get_market
 from apps.wallet.models import Balance
 from apps.wallet.services import add_ledger
+from apps.realtime.services import collect_events
 from .fee_service import compute_order_fee
+from .book_journal import record_cancel
+from .depth_cache import record_depth_changes
 from .matching_engine import match_order
+from .order_book import get_order_book, memory_engine_enabled, order_book_guard
 from ..models import Order
 
 
 def create_limit_order(user, market_symbol: str, side: str, price: Decimal, amount: Decimal) -> Order:
     if price <= 0 or amount <= 0:
         raise ValueError("price and amount must be positive")
-    try:
-        market = Market.objects.get(symbol=market_symbol, is_active=True)
-    except Market.DoesNotExist:
+    market = get_market(market_symbol)
+    if market is None or not market.is_active:
         raise InvalidMarket()
-    base_code = market.base_asset.code
-    quote_code = market.quote_asset.code
-    price = quantize_usdt(price)
-    amount = quantize_btc(amount) if base_code == "BTC" else amount
+    base_code = market.base_code
+    quote_code = market.quote_code
+    price = quantize_precision(price, market.quote_asset.precision)
+    amount = quantize_precision(amount, market.base_asset.precision)
+    if price <= 0 or amount <= 0:
+        raise ValueError("price and amount must be at least one unit of asset precision")
 
-    with transaction.atomic():
+    with order_book_guard(market_symbol), transaction.atomic(), collect_events():
         if side == ORDER_SIDE_BUY:
             cost = price * amount
             fee = compute_order_fee(cost)
@@ -77,13 +82,15 @@ def create_limit_order(user, market_symbol: str, side: str, price: Decimal, amou
 
 def cancel_order(user, order_id: int) -> Order:
     from common.constants import ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED, ORDER_STATUS_CANCELED
-    with transaction.atomic():
+    with transaction.atomic(), collect_events():
         order = Order.objects.select_for_update().get(id=order_id, user=user)
         if order.status not in (ORDER_STATUS_OPEN, ORDER_STATUS_PARTIALLY_FILLED):
             raise OrderNotCancelable()
-        market = Market.objects.get(symbol=order.market_symbol)
-        base_code = market.base_asset.code
-        quote_code = market.quote_asset.code
+        market = get_market(order.market_symbol)
+        if market is None:
+            raise InvalidMarket()
+        base_code = market.base_code
+        quote_code = market.quote_code
         remaining = order.amount - order.filled_amount
         if order.side == ORDER_SIDE_BUY:
             cost = order.price * remaining
@@ -102,7 +109,11 @@ def cancel_order(user, order_id: int) -> Order:
             add_ledger(user, base_code, remaining, LEDGER_KIND_UNLOCK, {"order_id": order.id})
         order.status = ORDER_STATUS_CANCELED
         order.save(update_fields=["status"])
-        from apps.realtime.services import broadcast_orderbook_update, send_order_update
-        broadcast_orderbook_update(order.market_symbol)
+        record_depth_changes(order.market_symbol, [(order.side, order.price, -remaining)])
+        if memory_engine_enabled():
+            book = get_order_book(order.market_symbol)
+            transaction.on_commit(lambda: book.remove(order.id))
+            record_cancel(order.market_symbol, order.id)
+        from apps.realtime.services import send_order_update
         send_order_update(user.id, order.id, order.status, str(order.filled_amount))
     return order
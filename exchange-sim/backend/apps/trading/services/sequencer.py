@@ -0,0 +1,89 @@
+import queue
+import threading
+from concurrent import futures
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from common.errors import OrderQueueBusy
+from ..models import Order
+from .order_service import create_limit_order, cancel_order
+
+
+class MarketSequencer:
+    """Single-writer command queue for one market.
+
+    Every command for the market runs, in submission order, on one dedicated
+    thread. Orders on the same market never contend for row locks with each
+    other, and different markets proceed in parallel on their own threads.
+    """
+
+    def __init__(self, market_symbol: str):
+        self.market_symbol = market_symbol
+        self.commands = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"sequencer-{market_symbol}", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs) -> futures.Future:
+        future = futures.Future()
+        self.commands.put((future, fn, args, kwargs))
+        return future
+
+    def _run(self):
+        while True:
+            future, fn, args, kwargs = self.commands.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            close_old_connections()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as exc:
+                future.set_exception(exc)
+            finally:
+                close_old_connections()
+
+
+_sequencers = {}
+_sequencers_lock = threading.Lock()
+
+
+def sequencer_enabled() -> bool:
+    return getattr(settings, "ORDER_SEQUENCER_ENABLED", False)
+
+
+def get_sequencer(market_symbol: str) -> MarketSequencer:
+    sequencer = _sequencers.get(market_symbol)
+    if sequencer is None:
+        with _sequencers_lock:
+            sequencer = _sequencers.get(market_symbol)
+            if sequencer is None:
+                sequencer = _sequencers[market_symbol] = MarketSequencer(market_symbol)
+    return sequencer
+
+
+def run_sequenced(market_symbol: str, fn, *args, **kwargs):
+    """Run `fn` on the market's sequencer and wait for its result.
+
+    Falls back to a direct call when sequencing is disabled. On timeout a
+    command that has not started yet is withdrawn from the queue and
+    `OrderQueueBusy` raised; one that has started will take effect, so its
+    outcome is still waited for.
+    """
+    if not sequencer_enabled():
+        return fn(*args, **kwargs)
+    future = get_sequencer(market_symbol).submit(fn, *args, **kwargs)
+    try:
+        return future.result(timeout=getattr(settings, "ORDER_SEQUENCER_TIMEOUT", 30))
+    except futures.TimeoutError:
+        if future.cancel():
+            raise OrderQueueBusy(market_symbol) from None
+    return future.result()
+
+
+def submit_limit_order(user, market_symbol: str, side: str, price, amount) -> Order:
+    return run_sequenced(market_symbol, create_limit_order, user, market_symbol, side, price, amount)
+
+
+def submit_cancel_order(user, order_id: int) -> Order:
+    market_symbol = Order.objects.values_list("market_symbol", flat=True).get(id=order_id, user=user)
+    return run_sequenced(market_symbol, cancel_order, user, order_id)
@@ -1,84 +1,122 @@
-from decimal import Decimal
+from functools import reduce
+from operator import or_
 from django.db import transaction
+from django.db.models import Q
 
 from common.constants import (
-    ORDER_SIDE_BUY,
     LEDGER_KIND_TRADE,
     LEDGER_KIND_FEE,
     LEDGER_KIND_UNLOCK,
 )
-from common.money import quantize_btc, quantize_usdt
-from apps.markets.models import Market
-from apps.wallet.models import Balance
-from apps.wallet.services import add_ledger
-from .fee_service import compute_order_fee
-from ..models import Order, Trade
+from common.money import FIXED_ZERO, Fixed, compute_fee_fixed
+from apps.markets.registry import get_market
+from apps.wallet.models import Balance, LedgerEntry
+from ..models import Trade
 
 
-def settle_trade(trade: Trade) -> None:
-    market = Market.objects.get(symbol=trade.market_symbol)
-    base_code = market.base_asset.code
-    quote_code = market.quote_asset.code
-    buy_order = trade.buy_order
-    sell_order = trade.sell_order
-    price = trade.price
-    amount = trade.amount
-    cost = quantize_usdt(price * amount)
-    fee = compute_order_fee(cost)
-    amount_q = quantize_btc(amount) if base_code == "BTC" else amount
+class SettlementBatch:
+    """Balance and ledger effects of a run of fills, written in one pass.
+
+    `add` must be called for each trade before its orders' `filled_amount` is
+    advanced, exactly where `settle_trade` used to run. `apply` then locks every
+    touched balance once, writes one update per (user, asset) and bulk-inserts
+    the ledger rows in the same order per-fill settlement would have.
+    """
+
+    def __init__(self, market_symbol: str):
+        self.market_symbol = market_symbol
+        self.market = None
+        self.deltas = {}
+        self.ledger = []
+
+    def _move(self, user_id: int, asset_code: str, available=FIXED_ZERO, locked=FIXED_ZERO):
+        delta = self.deltas.setdefault((user_id, asset_code), [FIXED_ZERO, FIXED_ZERO])
+        delta[0] += available
+        delta[1] += locked
+
+    def _log(self, user_id: int, asset_code: str, delta: Fixed, kind: str, trade: Trade = None, order_id=None):
+        self.ledger.append((user_id, asset_code, delta, kind, trade, order_id))
+
+    def add(self, trade: Trade) -> None:
+        if self.market is None:
+            self.market = get_market(self.market_symbol)
+        base_code = self.market.base_code
+        quote_code = self.market.quote_code
+        buy_order = trade.buy_order
+        sell_order = trade.sell_order
+        price = Fixed.from_decimal(trade.price)
+        amount = Fixed.from_decimal(trade.amount)
+        cost = (price * amount).quantize(self.market.quote_asset.precision)
+        fee = compute_fee_fixed(cost)
+        amount_q = amount.quantize(self.market.base_asset.precision)
 
-    with transaction.atomic():
-        buy_bal = Balance.objects.select_for_update().get(user=buy_order.user, asset_code=base_code)
-        buy_bal.available += amount_q
-        buy_bal.save(update_fields=["available"])
-        add_ledger(
-            buy_order.user,
-            base_code,
-            amount_q,
-            LEDGER_KIND_TRADE,
-            {"trade_id": trade.id, "order_id": buy_order.id},
-        )
-        cost_plus_fee = cost + fee
-        buy_quote = Balance.objects.select_for_update().get(user=buy_order.user, asset_code=quote_code)
-        buy_quote.locked -= cost_plus_fee
-        buy_quote.save(update_fields=["locked"])
-        if buy_order.filled_amount + amount >= buy_order.amount:
-            remainder = buy_order.amount - buy_order.filled_amount - amount
-            if remainder > 0:
-                unlock_q = (buy_order.price * remainder) + compute_order_fee(buy_order.price * remainder)
-                buy_quote.available += unlock_q
-                buy_quote.locked -= unlock_q
-                buy_quote.save(update_fields=["available", "locked"])
-                add_ledger(buy_order.user, quote_code, unlock_q, LEDGER_KIND_UNLOCK, {"order_id": buy_order.id})
+        self._move(buy_order.user_id, base_code, available=amount_q)
+        self._log(buy_order.user_id, base_code, amount_q, LEDGER_KIND_TRADE, trade, buy_order.id)
+        self._move(buy_order.user_id, quote_code, locked=-(cost + fee))
+        buy_amount = Fixed.from_decimal(buy_order.amount)
+        buy_filled = Fixed.from_decimal(buy_order.filled_amount)
+        if buy_filled + amount >= buy_amount:
+            remainder = buy_amount - buy_filled - amount
+            if remainder.units > 0:
+                unlocked_cost = Fixed.from_decimal(buy_order.price) * remainder
+                unlock_q = unlocked_cost + compute_fee_fixed(unlocked_cost)
+                self._move(buy_order.user_id, quote_code, available=unlock_q, locked=-unlock_q)
+                self._log(buy_order.user_id, quote_code, unlock_q, LEDGER_KIND_UNLOCK, order_id=buy_order.id)
 
-        sell_bal = Balance.objects.select_for_update().get(user=sell_order.user, asset_code=base_code)
-        sell_bal.locked -= amount_q
-        sell_bal.save(update_fields=["locked"])
-        if sell_order.filled_amount + amount >= sell_order.amount:
-            remainder = sell_order.amount - sell_order.filled_amount - amount
-            if remainder > 0:
-                sell_bal.available += remainder
-                sell_bal.save(update_fields=["available"])
-                add_ledger(sell_order.user, base_code, remainder, LEDGER_KIND_UNLOCK, {"order_id": sell_order.id})
-        sell_quote = Balance.objects.select_for_update().get(user=sell_order.user, asset_code=quote_code)
-        sell_quote.available += cost - fee
-        sell_quote.save(update_fields=["available"])
-        add_ledger(
-            sell_order.user,
-            quote_code,
-            cost - fee,
-            LEDGER_KIND_TRADE,
-            {"trade_id": trade.id, "order_id": sell_order.id},
-        )
-        add_ledger(
-            sell_order.user,
-            quote_code,
-            -fee,
-            LEDGER_KIND_FEE,
-            {"trade_id": trade.id},
-        )
-        from apps.realtime.services import send_balance_update
-        send_balance_update(buy_order.user_id, base_code, str(buy_bal.available), str(buy_bal.locked))
-        send_balance_update(buy_order.user_id, quote_code, str(buy_quote.available), str(buy_quote.locked))
-        send_balance_update(sell_order.user_id, base_code, str(sell_bal.available), str(sell_bal.locked))
-        send_balance_update(sell_order.user_id, quote_code, str(sell_quote.available), str(sell_quote.locked))
+        self._move(sell_order.user_id, base_code, locked=-amount_q)
+        sell_amount = Fixed.from_decimal(sell_order.amount)
+        sell_filled = Fixed.from_decimal(sell_order.filled_amount)
+        if sell_filled + amount >= sell_amount:
+            remainder = sell_amount - sell_filled - amount
+            if remainder.units > 0:
+                self._move(sell_order.user_id, base_code, available=remainder)
+                self._log(sell_order.user_id, base_code, remainder, LEDGER_KIND_UNLOCK, order_id=sell_order.id)
+        self._move(sell_order.user_id, quote_code, available=cost - fee)
+        self._log(sell_order.user_id, quote_code, cost - fee, LEDGER_KIND_TRADE, trade, sell_order.id)
+        self._log(sell_order.user_id, quote_code, -fee, LEDGER_KIND_FEE, trade)
+
+    def apply(self) -> None:
+        if not self.deltas:
+            return
+        with transaction.atomic():
+            # Lock in primary key order so concurrent batches cannot deadlock.
+            match = reduce(or_, (Q(user_id=u, asset_code=a) for u, a in self.deltas))
+            balances = {
+                (b.user_id, b.asset_code): b
+                for b in Balance.objects.select_for_update().filter(match).order_by("id")
+            }
+            for key, (available, locked) in self.deltas.items():
+                bal = balances.get(key)
+                if bal is None:
+                    raise Balance.DoesNotExist(f"No {key[1]} balance for user {key[0]}")
+                bal.available += available.to_decimal()
+                bal.locked += locked.to_decimal()
+            Balance.objects.bulk_update(balances.values(), ["available", "locked"])
+            LedgerEntry.objects.bulk_create([
+                LedgerEntry(
+                    user_id=user_id,
+                    asset_code=asset_code,
+                    delta=delta.to_decimal(),
+                    kind=kind,
+                    meta=_ledger_meta(trade, order_id),
+                )
+                for user_id, asset_code, delta, kind, trade, order_id in self.ledger
+            ])
+            from apps.realtime.services import send_balance_update
+            for (user_id, asset_code), bal in balances.items():
+                send_balance_update(user_id, asset_code, str(bal.available), str(bal.locked))
+
+
+def _ledger_meta(trade: Trade, order_id) -> dict:
+    meta = {}
+    if trade is not None:
+        meta["trade_id"] = trade.id
+    if order_id is not None:
+        meta["order_id"] = order_id
+    return meta
+
+
+def settle_trade(trade: Trade) -> None:
+    batch = SettlementBatch(trade.market_symbol)
+    batch.add(trade)
+    batch.apply()
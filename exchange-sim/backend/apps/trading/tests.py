@@ -1 +1,802 @@
-from django.test import TestCase
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from decimal import Decimal
+from io import StringIO
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import transaction
+from django.utils import timezone
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+
+from apps.analytics import candles, rolling_stats
+from apps.analytics.candles import discard_series
+from apps.analytics.models import Candle, MarketStats
+from apps.analytics.rolling_stats import discard_rolling_stats, flush_market_stats
+from apps.markets.models import Asset, Market
+from apps.realtime.models import OutboxEvent
+from apps.users.models import User
+from apps.wallet.models import Balance, LedgerEntry
+from common.constants import (
+    ORDER_SIDE_BUY,
+    ORDER_SIDE_SELL,
+    ORDER_STATUS_FILLED,
+    ORDER_STATUS_OPEN,
+    ORDER_STATUS_PARTIALLY_FILLED,
+    ORDER_TYPE_LIMIT,
+)
+from common.errors import OrderQueueBusy
+from common.money import (
+    Fixed,
+    compute_fee,
+    compute_fee_fixed,
+    from_units,
+    quantize_btc,
+    quantize_precision,
+    quantize_usdt,
+    to_units,
+)
+from .benchmark import BENCH_USER_PREFIX, generate_flow, run_benchmark
+from .models import ArchivedOrder, Order, Trade
+from .selectors import get_order_history, get_orderbook_snapshot
+from .services import book_journal, cancel_order, create_limit_order, depth_cache, sequencer
+from .services.archive_service import archive_closed_orders
+from .services.fee_service import compute_order_fee
+from .services.order_book import discard_order_book, get_order_book
+from .services.settlement_service import SettlementBatch, settle_trade
+
+CASES = 2000
+
+
+def random_decimal(rnd: random.Random, scale: int, max_int_digits: int = 7, signed: bool = False) -> Decimal:
+    units = rnd.randrange(10 ** (max_int_digits + scale))
+    if signed and rnd.random() < 0.5:
+        units = -units
+    return Decimal(units).scaleb(-scale)
+
+
+class FixedMoneyPropertyTests(SimpleTestCase):
+    """Fixed must agree with the Decimal arithmetic it replaces on every input."""
+
+    def setUp(self):
+        self.rnd = random.Random(20260205)
+
+    def test_round_trip_is_exact(self):
+        for _ in range(CASES):
+            value = random_decimal(self.rnd, self.rnd.randint(0, 14), signed=True)
+            self.assertEqual(Fixed.from_decimal(value).to_decimal(), value)
+
+    def test_add_and_sub_match_decimal(self):
+        for _ in range(CASES):
+            a = random_decimal(self.rnd, self.rnd.randint(0, 14), signed=True)
+            b = random_decimal(self.rnd, self.rnd.randint(0, 14), signed=True)
+            fa, fb = Fixed.from_decimal(a), Fixed.from_decimal(b)
+            self.assertEqual((fa + fb).to_decimal(), a + b)
+            self.assertEqual((fa - fb).to_decimal(), a - b)
+            self.assertEqual(fa < fb, a < b)
+            self.assertEqual(fa >= fb, a >= b)
+            self.assertEqual(fa == fb, a == b)
+
+    def test_trade_cost_matches_quantize_usdt(self):
+        for _ in range(CASES):
+            price = random_decimal(self.rnd, 6)
+            amount = random_decimal(self.rnd, 8, max_int_digits=4)
+            cost = (Fixed.from_decimal(price) * Fixed.from_decimal(amount)).quantize(6)
+            self.assertEqual(cost.to_decimal(), quantize_usdt(price * amount))
+
+    def test_fee_matches_compute_fee(self):
+        for _ in range(CASES):
+            cost = random_decimal(self.rnd, self.rnd.choice((6, 14)))
+            self.assertEqual(compute_fee_fixed(Fixed.from_decimal(cost)).to_decimal(), compute_fee(cost))
+
+    def test_quantize_rounds_down_like_decimal(self):
+        for _ in range(CASES):
+            value = random_decimal(self.rnd, self.rnd.randint(0, 14), signed=True)
+            scale = self.rnd.randint(0, 10)
+            self.assertEqual(
+                Fixed.from_decimal(value).quantize(scale).to_decimal(),
+                quantize_precision(value, scale),
+            )
+        for _ in range(CASES):
+            value = random_decimal(self.rnd, 12)
+            self.assertEqual(Fixed.from_decimal(value).quantize(8).to_decimal(), quantize_btc(value))
+
+    def test_order_lock_total_matches_decimal(self):
+        # create_limit_order locks price * amount + fee without quantizing the cost.
+        for _ in range(CASES):
+            price = Fixed.from_decimal(random_decimal(self.rnd, 6))
+            amount = Fixed.from_decimal(random_decimal(self.rnd, 8, max_int_digits=4))
+            cost = price * amount
+            expected = cost.to_decimal() + compute_fee(cost.to_decimal())
+            self.assertEqual((cost + compute_fee_fixed(cost)).to_decimal(), expected)
+
+    def test_units_helpers(self):
+        for _ in range(CASES):
+            value = random_decimal(self.rnd, 8)
+            self.assertEqual(from_units(to_units(value, 8), 8), value)
+            self.assertEqual(from_units(to_units(value, 6), 6), quantize_usdt(value))
+
+
+class TradingFixtures:
+    """Markets and funded users; every order and cancel runs its on-commit work."""
+
+    quote_balance = Decimal("100000")
+    base_balance = Decimal("100")
+
+    def setUp(self):
+        cache.clear()
+        discard_order_book()
+        discard_rolling_stats()
+        self.addCleanup(discard_order_book)
+        self.addCleanup(discard_rolling_stats)
+        self.quote = Asset.objects.get_or_create(code="USDT", defaults={"name": "Tether", "precision": 6})[0]
+
+    def make_market(self, base_code: str) -> str:
+        base = Asset.objects.create(code=base_code, name=base_code, precision=8)
+        return Market.objects.create(symbol=f"{base_code}USDT", base_asset=base, quote_asset=self.quote).symbol
+
+    def make_user(self, username: str, base_code: str) -> User:
+        user = User.objects.create_user(username)
+        Balance.objects.create(user=user, asset_code=base_code, available=self.base_balance)
+        Balance.objects.create(user=user, asset_code="USDT", available=self.quote_balance)
+        return user
+
+    def committed(self):
+        """Outside a test transaction, on-commit work already runs as each command commits."""
+        return nullcontext()
+
+    def place(self, user, symbol: str, side: str, price: str, amount: str) -> Order:
+        with self.committed():
+            return create_limit_order(user, symbol, side, Decimal(price), Decimal(amount))
+
+    def cancel(self, order: Order) -> Order:
+        with self.committed():
+            return cancel_order(order.user, order.id)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class TradingTestCase(TradingFixtures, TestCase):
+    def committed(self):
+        return self.captureOnCommitCallbacks(execute=True)
+
+
+# One market's order flow: resting orders, a taker filling several makers at
+# one price, a partial fill then cancel, a fill against the bid side and a
+# self-trade. `restart` marks where the process's in-memory state is dropped.
+FLOW = (
+    ("a", ORDER_SIDE_SELL, "101", "1"),
+    ("b", ORDER_SIDE_SELL, "100", "2"),
+    ("a", ORDER_SIDE_SELL, "100", "0.5"),
+    ("c", ORDER_SIDE_BUY, "99", "1"),
+    ("c", ORDER_SIDE_BUY, "100", "2.5"),
+    ("c", ORDER_SIDE_BUY, "102", "0.5"),
+    ("cancel", 0),
+    ("b", ORDER_SIDE_SELL, "98", "3"),
+    ("restart",),
+    ("a", ORDER_SIDE_BUY, "98", "1.5"),
+    ("c", ORDER_SIDE_SELL, "97", "1"),
+    ("a", ORDER_SIDE_BUY, "99", "2"),
+    ("cancel", 11),
+    ("a", ORDER_SIDE_BUY, "96", "0.3"),
+    ("a", ORDER_SIDE_SELL, "96", "0.3"),
+)
+
+
+class MatchingEngineEquivalenceTests(TradingTestCase):
+    """The in-memory book must leave exactly the rows the SQL matcher does."""
+
+    def run_flow(self, base_code: str) -> dict:
+        symbol = self.make_market(base_code)
+        users = {name: self.make_user(f"{base_code}-{name}", base_code) for name in "abc"}
+        placed = {}
+        for index, op in enumerate(FLOW):
+            if op[0] == "restart":
+                book = get_order_book(symbol)
+                depth = (book.depth(ORDER_SIDE_BUY), book.depth(ORDER_SIDE_SELL))
+                discard_order_book(symbol)
+                book = get_order_book(symbol)
+                self.assertEqual((book.depth(ORDER_SIDE_BUY), book.depth(ORDER_SIDE_SELL)), depth)
+            elif op[0] == "cancel":
+                self.cancel(placed[op[1]])
+            else:
+                name, side, price, amount = op
+                placed[index] = self.place(users[name], symbol, side, price, amount)
+
+        refs = {order.id: index for index, order in placed.items()}
+        names = {user.id: name for name, user in users.items()}
+        assets = {base_code: "base", "USDT": "quote"}
+        return {
+            "trades": [
+                (refs[t.buy_order_id], refs[t.sell_order_id], t.price, t.amount, t.taker_side)
+                for t in Trade.objects.filter(market_symbol=symbol).order_by("id")
+            ],
+            "orders": {
+                refs[o.id]: (o.status, o.filled_amount)
+                for o in Order.objects.filter(market_symbol=symbol)
+            },
+            "balances": {
+                (names[b.user_id], assets[b.asset_code]): (b.available, b.locked)
+                for b in Balance.objects.filter(user__in=users.values())
+            },
+            "ledger": [
+                (names[e.user_id], assets[e.asset_code], e.delta, e.kind)
+                for e in LedgerEntry.objects.filter(user__in=users.values()).order_by("id")
+            ],
+        }
+
+    def test_sql_and_memory_engines_agree(self):
+        with override_settings(MATCHING_ENGINE="sql"):
+            sql = self.run_flow("SQL")
+        with override_settings(MATCHING_ENGINE="memory"):
+            memory = self.run_flow("MEM")
+        self.assertTrue(sql["trades"])
+        for key in sql:
+            with self.subTest(key):
+                self.assertEqual(memory[key], sql[key])
+
+
+class MarketSequencerTests(SimpleTestCase):
+    def setUp(self):
+        self.gates = []
+        self.addCleanup(lambda: [gate.set() for gate in self.gates])
+
+    def blocked(self, market_symbol: str):
+        """Occupy the market's worker until the returned event is set."""
+        gate = threading.Event()
+        started = threading.Event()
+        self.gates.append(gate)
+
+        def hold():
+            started.set()
+            gate.wait(5)
+
+        future = sequencer.get_sequencer(market_symbol).submit(hold)
+        self.assertTrue(started.wait(5))
+        return gate, future
+
+    def use(self, market_symbol: str) -> str:
+        self.addCleanup(sequencer._sequencers.pop, market_symbol, None)
+        return market_symbol
+
+    def test_commands_for_one_market_run_in_submission_order_on_one_thread(self):
+        worker = sequencer.get_sequencer(self.use("SEQFIFO"))
+        seen = []
+        futures = [worker.submit(lambda i=i: seen.append((i, threading.current_thread().name))) for i in range(200)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual([i for i, _ in seen], list(range(200)))
+        self.assertEqual({name for _, name in seen}, {"sequencer-SEQFIFO"})
+
+    def test_markets_progress_independently(self):
+        gate, held = self.blocked(self.use("SEQBUSY"))
+        other = sequencer.get_sequencer(self.use("SEQFREE")).submit(lambda: "done")
+        self.assertEqual(other.result(timeout=5), "done")
+        self.assertFalse(held.done())
+        gate.set()
+        held.result(timeout=5)
+
+    @override_settings(ORDER_SEQUENCER_ENABLED=True, ORDER_SEQUENCER_TIMEOUT=0.05)
+    def test_timed_out_command_is_withdrawn(self):
+        symbol = self.use("SEQSLOW")
+        gate, _ = self.blocked(symbol)
+        ran = []
+        with self.assertRaises(OrderQueueBusy):
+            sequencer.run_sequenced(symbol, ran.append, "late")
+        gate.set()
+        self.assertEqual(sequencer.run_sequenced(symbol, lambda: "next"), "next")
+        self.assertEqual(ran, [])
+
+    @override_settings(ORDER_SEQUENCER_ENABLED=True, ORDER_SEQUENCER_TIMEOUT=0.05)
+    def test_started_command_is_waited_for_past_the_timeout(self):
+        symbol = self.use("SEQSTARTED")
+        started = threading.Event()
+
+        def slow():
+            started.set()
+            time.sleep(0.2)
+            return "placed"
+
+        self.assertEqual(sequencer.run_sequenced(symbol, slow), "placed")
+        self.assertTrue(started.is_set())
+
+    @override_settings(ORDER_SEQUENCER_ENABLED=True)
+    def test_failed_command_does_not_stop_the_worker(self):
+        symbol = self.use("SEQFAIL")
+
+        def fail():
+            raise ValueError("rejected")
+
+        with self.assertRaisesMessage(ValueError, "rejected"):
+            sequencer.run_sequenced(symbol, fail)
+        self.assertEqual(sequencer.run_sequenced(symbol, lambda: "still running"), "still running")
+        self.assertTrue(sequencer.get_sequencer(symbol).thread.is_alive())
+
+    @override_settings(ORDER_SEQUENCER_ENABLED=False)
+    def test_disabled_runs_on_the_calling_thread(self):
+        name = sequencer.run_sequenced(self.use("SEQOFF"), lambda: threading.current_thread().name)
+        self.assertEqual(name, threading.current_thread().name)
+        self.assertNotIn("SEQOFF", sequencer._sequencers)
+
+
+class SettlementBatchTests(TradingTestCase):
+    """One batch per incoming order must book what settling each fill did."""
+
+    # (maker owner, maker price, fill amount); the taker buys 3 at 101.
+    FILLS = (("s1", "100", "1"), ("s2", "101", "1.5"), ("taker", "101", "0.5"))
+
+    def setUp(self):
+        super().setUp()
+        self.symbol = self.make_market("BTC")
+
+    def open_order(self, user, side: str, price: str, amount: str) -> Order:
+        price, amount = Decimal(price), Decimal(amount)
+        if side == ORDER_SIDE_BUY:
+            asset, locked = "USDT", price * amount + compute_order_fee(price * amount)
+        else:
+            asset, locked = "BTC", amount
+        bal = Balance.objects.get(user=user, asset_code=asset)
+        bal.available -= locked
+        bal.locked += locked
+        bal.save()
+        return Order.objects.create(
+            user=user,
+            market_symbol=self.symbol,
+            side=side,
+            type=ORDER_TYPE_LIMIT,
+            price=price,
+            amount=amount,
+            filled_amount=Decimal("0"),
+            status=ORDER_STATUS_OPEN,
+        )
+
+    def fill(self, prefix: str, settle) -> dict:
+        """Fill a buy against three makers, one of them the buyer's own, via `settle(trade)`."""
+        users = {name: self.make_user(f"{prefix}-{name}", "BTC") for name in ("taker", "s1", "s2")}
+        taker = self.open_order(users["taker"], ORDER_SIDE_BUY, "101", "3")
+        makers = [self.open_order(users[owner], ORDER_SIDE_SELL, price, amount) for owner, price, amount in self.FILLS]
+        trades = []
+        for maker in makers:
+            trade = Trade.objects.create(
+                market_symbol=self.symbol,
+                price=maker.price,
+                amount=maker.amount,
+                buy_order=taker,
+                sell_order=maker,
+                taker_side=ORDER_SIDE_BUY,
+            )
+            settle(trade)
+            trades.append(trade)
+            taker.filled_amount += trade.amount
+            maker.filled_amount += trade.amount
+        return {
+            "users": users,
+            "orders": {taker.id: "taker", **{maker.id: f"maker{i}" for i, maker in enumerate(makers)}},
+            "trades": {trade.id: i for i, trade in enumerate(trades)},
+        }
+
+    def booked(self, run: dict) -> tuple:
+        """Balances and ledger rows of a run, keyed so two runs compare equal."""
+        names = {user.id: name for name, user in run["users"].items()}
+        balances = {
+            (names[b.user_id], b.asset_code): (b.available, b.locked)
+            for b in Balance.objects.filter(user__in=run["users"].values())
+        }
+        ledger = [
+            (
+                names[e.user_id],
+                e.asset_code,
+                e.delta,
+                e.kind,
+                run["trades"].get(e.meta.get("trade_id")),
+                run["orders"].get(e.meta.get("order_id")),
+            )
+            for e in LedgerEntry.objects.filter(user__in=run["users"].values()).order_by("id")
+        ]
+        return balances, ledger
+
+    def test_batch_matches_per_fill_settlement(self):
+        per_fill = self.booked(self.fill("single", settle_trade))
+        batch = SettlementBatch(self.symbol)
+        run = self.fill("batch", batch.add)
+        # Lock balances, update them, insert the ledger, inside one savepoint.
+        with self.assertNumQueries(5):
+            batch.apply()
+        batched = self.booked(run)
+
+        self.assertEqual(batched, per_fill)
+        balances, ledger = batched
+        # The taker bought 0.5 of their own 0.5 and 2.5 from others, paying fees on all three.
+        self.assertEqual(balances[("taker", "BTC")], (Decimal("102.5"), Decimal("0")))
+        self.assertEqual(balances[("s1", "USDT")], (Decimal("100099.9"), Decimal("0")))
+        self.assertEqual(balances[("s2", "USDT")], (Decimal("100151.3485"), Decimal("0")))
+        self.assertEqual([row[0] for row in ledger if row[3] == "FEE"], ["s1", "s2", "taker"])
+
+    def test_batch_rolls_back_with_the_enclosing_transaction(self):
+        batch = SettlementBatch(self.symbol)
+        run = self.fill("rollback", batch.add)
+        before = self.booked(run)
+        with self.assertRaisesMessage(RuntimeError, "abort"), transaction.atomic():
+            batch.apply()
+            self.assertNotEqual(self.booked(run), before)
+            raise RuntimeError("abort")
+        self.assertEqual(self.booked(run), before)
+
+
+# A matching order: lock and debit the balance, insert the order and its lock
+# ledger row, select the makers, then one statement each for the trades, the
+# filled makers, the partial ones with the taker, and the settlement's lock,
+# update and ledger insert, plus savepoints around the nested blocks.
+QUERIES_PER_SWEEP = 17
+
+
+def create_limit_order_decimal(user, symbol: str, side: str, price: str, amount: str) -> Order:
+    return create_limit_order(user, symbol, side, Decimal(price), Decimal(amount))
+
+
+class PersistFillsTests(TradingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.symbol = self.make_market("BTC")
+        self.maker = self.make_user("maker", "BTC")
+        self.taker = self.make_user("taker", "BTC")
+
+    def rest_asks(self, count: int) -> list:
+        return [self.place(self.maker, self.symbol, ORDER_SIDE_SELL, str(100 + i), "1") for i in range(count)]
+
+    def sweep(self, makers: list, place=None) -> Order:
+        """Buy through every maker, leaving half of the last one resting."""
+        amount = Decimal(len(makers)) - Decimal("0.5")
+        return (place or self.place)(self.taker, self.symbol, ORDER_SIDE_BUY, str(100 + len(makers)), str(amount))
+
+    def test_taker_sweeps_several_makers(self):
+        makers = self.rest_asks(4)
+        taker = self.sweep(makers)
+
+        self.assertEqual((taker.status, taker.filled_amount), (ORDER_STATUS_FILLED, Decimal("3.5")))
+        stored = Order.objects.in_bulk([m.id for m in makers])
+        self.assertEqual(
+            [(stored[m.id].status, stored[m.id].filled_amount) for m in makers],
+            [(ORDER_STATUS_FILLED, Decimal("1"))] * 3 + [(ORDER_STATUS_PARTIALLY_FILLED, Decimal("0.5"))],
+        )
+        trades = list(Trade.objects.filter(market_symbol=self.symbol).order_by("id"))
+        self.assertEqual(
+            [(t.price, t.amount, t.taker_side) for t in trades],
+            [
+                (Decimal("100"), Decimal("1"), ORDER_SIDE_BUY),
+                (Decimal("101"), Decimal("1"), ORDER_SIDE_BUY),
+                (Decimal("102"), Decimal("1"), ORDER_SIDE_BUY),
+                (Decimal("103"), Decimal("0.5"), ORDER_SIDE_BUY),
+            ],
+        )
+        self.assertEqual(Order.objects.get(id=taker.id).filled_amount, Decimal("3.5"))
+
+    def test_query_count_does_not_grow_with_makers(self):
+        # Counted up to commit; what runs after it does not depend on the makers.
+        for count in (2, 8):
+            makers = self.rest_asks(count)
+            with self.subTest(makers=count), self.assertNumQueries(QUERIES_PER_SWEEP):
+                self.sweep(makers, create_limit_order_decimal)
+
+
+class DepthCacheTests(TradingTestCase):
+    def setUp(self):
+        super().setUp()
+        depth_cache.discard_market_depth()
+        self.addCleanup(depth_cache.discard_market_depth)
+        self.symbol = self.make_market("BTC")
+        self.alice = self.make_user("alice", "BTC")
+        self.bob = self.make_user("bob", "BTC")
+
+    def assert_depth_matches_database(self) -> None:
+        depth = depth_cache._depths[self.symbol]
+        for side in (ORDER_SIDE_BUY, ORDER_SIDE_SELL):
+            expected = sorted(depth_cache.aggregate_depth(self.symbol, side), reverse=side == ORDER_SIDE_BUY)
+            self.assertEqual(depth.top(side, 1000), expected)
+
+    def subscribe(self) -> str:
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f"market_{self.symbol}_orderbook", channel)
+        return channel
+
+    def received(self, channel: str, count: int) -> list:
+        layer = get_channel_layer()
+        return [async_to_sync(layer.receive)(channel)["data"] for _ in range(count)]
+
+    def test_depth_tracks_the_database_through_place_fill_and_cancel(self):
+        self.place(self.alice, self.symbol, ORDER_SIDE_SELL, "101", "2")
+        depth = depth_cache._depths[self.symbol]
+        self.place(self.alice, self.symbol, ORDER_SIDE_SELL, "101", "1")
+        self.place(self.alice, self.symbol, ORDER_SIDE_SELL, "102", "1")
+        resting_bid = self.place(self.bob, self.symbol, ORDER_SIDE_BUY, "99", "1.5")
+        self.assert_depth_matches_database()
+
+        # Fills the whole 101 level and part of 102, and rests nothing.
+        self.place(self.bob, self.symbol, ORDER_SIDE_BUY, "102", "3.25")
+        self.assert_depth_matches_database()
+        # Takes part of the resting bid and rests the remainder as an ask.
+        self.place(self.alice, self.symbol, ORDER_SIDE_SELL, "99", "1")
+        self.assert_depth_matches_database()
+        self.cancel(resting_bid)
+        self.assert_depth_matches_database()
+
+        # Every change was applied to the same copy rather than reloaded.
+        self.assertIs(depth_cache._depths[self.symbol], depth)
+        self.assertEqual(depth.top(ORDER_SIDE_BUY, 10), [])
+        self.assertEqual(depth.top(ORDER_SIDE_SELL, 10), [(Decimal("102"), Decimal("0.75"))])
+
+    def test_deltas_carry_consecutive_seqs(self):
+        channel = self.subscribe()
+        self.place(self.alice, self.symbol, ORDER_SIDE_SELL, "101", "1")
+        resting_ask = self.place(self.alice, self.symbol, ORDER_SIDE_SELL, "102", "1")
+        self.place(self.bob, self.symbol, ORDER_SIDE_BUY, "101", "0.5")
+        self.place(self.bob, self.symbol, ORDER_SIDE_BUY, "100", "2")
+        self.cancel(resting_ask)
+
+        deltas = self.received(channel, 5)
+        seqs = [delta["seq"] for delta in deltas]
+        self.assertEqual(seqs, list(range(seqs[0], seqs[0] + 5)))
+        self.assertEqual(deltas[2]["asks"], [["101.00000000", "0.50000000"]])
+        self.assertEqual(deltas[4]["asks"], [["102.00000000", "0.00000000"]])
+        self.assertEqual(get_orderbook_snapshot(self.symbol)["seq"], seqs[-1])
+
+    @override_settings(REALTIME_OUTBOX_ENABLED=True)
+    def test_outbox_deltas_are_written_inside_the_order_transaction(self):
+        group = f"market_{self.symbol}_orderbook"
+        self.place(self.alice, self.symbol, ORDER_SIDE_SELL, "101", "1")
+        with self.captureOnCommitCallbacks() as callbacks:
+            create_limit_order(self.bob, self.symbol, ORDER_SIDE_BUY, Decimal("101"), Decimal("1.5"))
+            # Alice's resting ask, then Bob's fill and his resting remainder.
+            rows = list(OutboxEvent.objects.filter(group=group).order_by("id").values_list("data", flat=True))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual([row["seq"] for row in rows], [rows[0]["seq"], rows[0]["seq"] + 1, rows[0]["seq"] + 2])
+        self.assertEqual((rows[1]["asks"], rows[1]["bids"]), ([["101.00000000", "0.00000000"]], []))
+        self.assertEqual(rows[2]["bids"], [["101.00000000", "0.50000000"]])
+
+        # Applying the commit updates the local copy under the same seq without writing again.
+        for callback in callbacks:
+            callback()
+        self.assertEqual(OutboxEvent.objects.filter(group=group).count(), 3)
+        self.assertEqual(depth_cache._depths[self.symbol].version, rows[2]["seq"])
+        self.assert_depth_matches_database()
+
+        with transaction.atomic():
+            self.place(self.alice, self.symbol, ORDER_SIDE_SELL, "105", "1")
+            transaction.set_rollback(True)
+        self.assertEqual(OutboxEvent.objects.filter(group=group).count(), 3)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class BenchmarkTests(TradingFixtures, TransactionTestCase):
+    """Runs outside a test transaction, so on-commit work happens as in a real run."""
+
+    def setUp(self):
+        super().setUp()
+        discard_series()
+        self.addCleanup(discard_series)
+        self.symbol = self.make_market("BTC")
+
+    def real_trade(self) -> None:
+        seller, buyer = self.make_user("seller", "BTC"), self.make_user("buyer", "BTC")
+        self.place(seller, self.symbol, ORDER_SIDE_SELL, "100", "1")
+        self.place(buyer, self.symbol, ORDER_SIDE_BUY, "100", "1")
+        flush_market_stats()
+        Candle.objects.create(
+            market_symbol=self.symbol, interval="1m", open_time=timezone.now().replace(second=0, microsecond=0),
+            open=Decimal("100"), high=Decimal("100"), low=Decimal("100"), close=Decimal("100"),
+            volume=Decimal("1"), quote_volume=Decimal("100"), trade_count=1,
+        )
+
+    def analytics(self) -> tuple:
+        return (
+            list(MarketStats.objects.values_list("market_symbol", "last_price", "high_24h", "trades_24h")),
+            list(Candle.objects.values_list("market_symbol", "interval", "open_time", "close", "trade_count")),
+        )
+
+    def test_flow_is_determined_by_the_seed(self):
+        self.assertEqual(generate_flow(3, 200, [self.symbol], 4), generate_flow(3, 200, [self.symbol], 4))
+        self.assertNotEqual(generate_flow(3, 200, [self.symbol], 4), generate_flow(4, 200, [self.symbol], 4))
+
+    @override_settings(REALTIME_OUTBOX_ENABLED=True, MARKET_STATS_FLUSH_INTERVAL=0)
+    def test_run_is_repeatable_and_leaves_nothing_behind(self):
+        self.real_trade()
+        before = self.analytics()
+        outbox_before = OutboxEvent.objects.count()
+        self.assertEqual(before[0][0][0], self.symbol)
+
+        first = run_benchmark(seed=7, orders=80, users=3, depth_levels=3)
+        self.assertEqual(first["config"]["markets"], [self.symbol])
+        self.assertEqual(first["overall"]["count"], 80)
+        self.assertGreater(first["fills"], 0)
+        self.assertFalse(User.objects.filter(username__startswith=BENCH_USER_PREFIX).exists())
+        self.assertEqual(Order.objects.exclude(market_symbol=self.symbol).count(), 0)
+        self.assertEqual(Trade.objects.exclude(market_symbol=self.symbol).count(), 0)
+        self.assertEqual(list(Market.objects.values_list("symbol", flat=True)), [self.symbol])
+        self.assertFalse(Asset.objects.filter(code__startswith="BENCH").exists())
+        self.assertEqual(self.analytics(), before)
+        self.assertEqual(OutboxEvent.objects.count(), outbox_before)
+        self.assertEqual(set(rolling_stats._stats), {self.symbol})
+        self.assertFalse(set(candles._series) - {self.symbol})
+
+        second = run_benchmark(seed=7, orders=80, users=3, depth_levels=3)
+        self.assertEqual(second["fills"], first["fills"])
+        self.assertEqual(
+            {kind: stats["count"] for kind, stats in second["by_kind"].items()},
+            {kind: stats["count"] for kind, stats in first["by_kind"].items()},
+        )
+
+    def test_real_orders_are_not_traded_against(self):
+        resting = self.place(self.make_user("real", "BTC"), self.symbol, ORDER_SIDE_BUY, "100.5", "1")
+        call_command("bench_matching", orders=40, users=2, depth=2, stdout=StringIO())
+        resting.refresh_from_db()
+        self.assertEqual((resting.status, resting.filled_amount), (ORDER_STATUS_OPEN, Decimal("0")))
+        self.assertEqual(Trade.objects.count(), 0)
+
+    def test_command_reports_throughput(self):
+        out = StringIO()
+        call_command("bench_matching", orders=20, users=2, stdout=out)
+        self.assertIn("orders/s", out.getvalue())
+        self.assertIn("sql engine", out.getvalue())
+
+
+class BookJournalTests(TradingTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        settings = override_settings(
+            MATCHING_ENGINE="memory",
+            ORDER_BOOK_JOURNAL_DIR=self.dir,
+            ORDER_BOOK_SNAPSHOT_INTERVAL=4,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.symbol = self.make_market("BTC")
+        self.addCleanup(self.forget)
+        alice = self.make_user("alice", "BTC")
+        bob = self.make_user("bob", "BTC")
+        self.place(alice, self.symbol, ORDER_SIDE_SELL, "101", "1")
+        resting = self.place(alice, self.symbol, ORDER_SIDE_SELL, "102", "2")
+        self.place(bob, self.symbol, ORDER_SIDE_BUY, "99", "1")
+        self.place(bob, self.symbol, ORDER_SIDE_BUY, "98", "1")
+        # The first command snapshotted the book it loaded from the database;
+        # the next snapshot is taken here, and the last two entries follow it.
+        self.place(bob, self.symbol, ORDER_SIDE_BUY, "101.5", "1.5")
+        self.cancel(resting)
+        self.place(alice, self.symbol, ORDER_SIDE_SELL, "99", "0.25")
+        self.bob = bob
+
+    def forget(self) -> None:
+        """Drop the process's journal handle and book, as a restart would."""
+        with book_journal._journals_lock:
+            journal = book_journal._journals.pop(self.symbol, None)
+        if journal is not None:
+            journal.file.close()
+        discard_order_book(self.symbol)
+
+    def depth(self, book) -> tuple:
+        return book.depth(ORDER_SIDE_BUY), book.depth(ORDER_SIDE_SELL)
+
+    def last_segment(self) -> str:
+        return book_journal.segment_paths(self.dir, self.symbol)[-1][1]
+
+    def test_replay_from_snapshot_matches_live_book(self):
+        live = get_order_book(self.symbol)
+        _, snapshot_seq = book_journal.read_snapshot(book_journal.snapshot_path(self.dir, self.symbol), self.symbol)
+        book, seq = book_journal.replay(self.dir, self.symbol)
+        self.assertEqual(snapshot_seq, 5)
+        self.assertEqual(seq, 7)
+        self.assertEqual(self.depth(book), self.depth(live))
+        self.assertTrue(book_journal.book_matches_database(book))
+
+        full, full_seq = book_journal.replay(self.dir, self.symbol, from_snapshot=False)
+        self.assertEqual((self.depth(full), full_seq), (self.depth(live), seq))
+
+    def test_restart_recovers_the_book_from_the_journal(self):
+        expected = self.depth(get_order_book(self.symbol))
+        self.forget()
+        book = get_order_book(self.symbol)
+        self.assertEqual(self.depth(book), expected)
+        self.assertFalse(book_journal._journals[self.symbol].needs_snapshot)
+
+    def test_torn_final_record_is_ignored_and_cut_off(self):
+        expected = self.depth(get_order_book(self.symbol))
+        self.forget()
+        entry = book_journal.JournalEntry(book_journal.ENTRY_ORDER, 8, 999, self.bob.id, ORDER_SIDE_BUY, 1, 1, 0)
+        with open(self.last_segment(), "ab") as fh:
+            fh.write(entry.pack()[: book_journal.ENTRY_SIZE // 2])
+        book, seq = book_journal.replay(self.dir, self.symbol)
+        self.assertEqual((self.depth(book), seq), (expected, 7))
+
+        # Recovery truncates the tail, so entries written after it replay cleanly.
+        self.assertEqual(self.depth(get_order_book(self.symbol)), expected)
+        self.assertEqual(os.path.getsize(self.last_segment()) % book_journal.ENTRY_SIZE, 0)
+        self.place(self.bob, self.symbol, ORDER_SIDE_BUY, "97", "1")
+        book, seq = book_journal.replay(self.dir, self.symbol)
+        self.assertEqual(seq, 8)
+        self.assertEqual(self.depth(book), self.depth(get_order_book(self.symbol)))
+
+    def test_record_with_bad_checksum_ends_replay(self):
+        self.forget()
+        data = bytearray(book_journal.JournalEntry(book_journal.ENTRY_CANCEL, 8, 1).pack())
+        data[-1] ^= 0xFF
+        with open(self.last_segment(), "ab") as fh:
+            fh.write(bytes(data))
+        _, seq = book_journal.replay(self.dir, self.symbol)
+        self.assertEqual(seq, 7)
+
+    def test_replay_journal_command_checks_against_the_database(self):
+        out = StringIO()
+        call_command("replay_journal", self.symbol, dir=self.dir, verbose=True, check=True, stdout=out)
+        output = out.getvalue()
+        self.assertIn(f"{self.symbol} at seq 7", output)
+        self.assertIn("CANCEL #", output)
+        self.assertIn("Matches open orders in the database", output)
+
+        out = StringIO()
+        call_command("replay_journal", self.symbol, dir=self.dir, until=4, from_start=True, stdout=out)
+        self.assertIn(f"{self.symbol} at seq 4", out.getvalue())
+
+
+class ArchiveOrdersTests(TradingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.symbol = self.make_market("BTC")
+        self.alice = self.make_user("alice", "BTC")
+        self.bob = self.make_user("bob", "BTC")
+        self.maker = self.place(self.alice, self.symbol, ORDER_SIDE_SELL, "100", "1")
+        self.taker = self.place(self.bob, self.symbol, ORDER_SIDE_BUY, "100", "1")
+        self.resting = self.place(self.bob, self.symbol, ORDER_SIDE_BUY, "90", "1")
+        Order.objects.update(created_at=timezone.now() - timezone.timedelta(hours=2))
+        self.trade = Trade.objects.get(market_symbol=self.symbol)
+
+    def test_filled_orders_with_trades_are_archived(self):
+        self.assertEqual(archive_closed_orders(older_than=timezone.now() - timezone.timedelta(hours=1)), 2)
+        self.assertEqual(
+            set(ArchivedOrder.objects.values_list("id", "status")),
+            {(self.maker.id, ORDER_STATUS_FILLED), (self.taker.id, ORDER_STATUS_FILLED)},
+        )
+        self.assertEqual(list(Order.objects.values_list("id", flat=True)), [self.resting.id])
+        self.assertEqual({o.id for o in get_order_history(self.bob)}, {self.taker.id, self.resting.id})
+
+    def test_trade_reads_its_archived_orders(self):
+        archive_closed_orders(older_than=timezone.now() - timezone.timedelta(hours=1))
+        trade = Trade.objects.get(id=self.trade.id)
+        self.assertEqual((trade.buy_order_id, trade.sell_order_id), (self.trade.buy_order_id, self.trade.sell_order_id))
+        self.assertIsInstance(trade.buy_order, ArchivedOrder)
+        self.assertEqual((trade.buy_order.id, trade.buy_order.user_id), (self.trade.buy_order_id, self.bob.id))
+        self.assertEqual(trade.buy_order.status, ORDER_STATUS_FILLED)
+
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        response = client.get("/api/trades/", {"symbol": self.symbol})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(row["buy_order"], row["sell_order"]) for row in response.json()],
+            [(self.trade.buy_order_id, self.trade.sell_order_id)],
+        )
+
+    def test_trade_outlives_a_deleted_user(self):
+        self.bob.delete()
+        trade = Trade.objects.get(id=self.trade.id)
+        self.assertEqual(trade.buy_order_id, self.taker.id)
+        self.assertIsNone(trade.buy_order)
+
+    def test_recent_orders_stay(self):
+        self.assertEqual(archive_closed_orders(older_than=timezone.now() - timezone.timedelta(hours=3)), 0)
+        self.assertEqual(Order.objects.count(), 3)
+
+    def test_command_archives_in_batches(self):
+        out = StringIO()
+        call_command("archive_orders", once=True, batch_size=1, min_age=3600, stdout=out)
+        self.assertIn("Archived 2 orders", out.getvalue())
+        self.assertEqual(ArchivedOrder.objects.count(), 2)
+
@@ -3,11 +3,11 @@ from rest_framework import generics, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from common.errors import InsufficientFunds, InvalidMarket, OrderNotCancelable
+from common.errors import InsufficientFunds, InvalidMarket, OrderNotCancelable, OrderQueueBusy
 from .models import Order, Trade
 from .serializers import OrderSerializer, TradeSerializer
-from .services import create_limit_order, cancel_order
-from .selectors import get_orderbook_bids, get_orderbook_asks
+from .services import submit_limit_order, submit_cancel_order
+from .selectors import get_order_history, get_orderbook_snapshot
 
 
 class OrderCreateView(APIView):
@@ -27,22 +27,26 @@ class OrderCreateView(APIView):
         except Exception:
             return Response({"error": "invalid price or amount"}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            order = create_limit_order(request.user, market_symbol, side.upper(), price, amount)
+            order = submit_limit_order(request.user, market_symbol, side.upper(), price, amount)
         except InvalidMarket:
             return Response({"error": "Invalid market"}, status=status.HTTP_400_BAD_REQUEST)
         except InsufficientFunds:
             return Response({"error": "Insufficient funds"}, status=status.HTTP_400_BAD_REQUEST)
+        except OrderQueueBusy:
+            return Response({"error": "Order queue busy"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
 
 
 class OrderCancelView(APIView):
     def post(self, request, pk):
         try:
-            order = cancel_order(request.user, pk)
+            order = submit_cancel_order(request.user, pk)
         except Order.DoesNotExist:
             return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
         except OrderNotCancelable:
             return Response({"error": "Order cannot be canceled"}, status=status.HTTP_400_BAD_REQUEST)
+        except OrderQueueBusy:
+            return Response({"error": "Order queue busy"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         return Response(OrderSerializer(order).data)
 
 
@@ -62,7 +66,7 @@ class OrderHistoryView(generics.ListAPIView):
 
     def get_queryset(self):
         limit = int(self.request.query_params.get("limit", 100))
-        return Order.objects.filter(user=self.request.user).order_by("-created_at")[:limit]
+        return get_order_history(self.request.user, limit)
 
 
 class TradesListView(generics.ListAPIView):
@@ -82,12 +86,7 @@ class OrderbookView(APIView):
         if not symbol:
             return Response({"error": "symbol required"}, status=status.HTTP_400_BAD_REQUEST)
         limit = int(request.query_params.get("limit", 50))
-        bids = get_orderbook_bids(symbol, limit=limit)
-        asks = get_orderbook_asks(symbol, limit=limit)
+        snapshot = get_orderbook_snapshot(symbol, limit=limit)
         from django.utils import timezone
-        return Response({
-            "symbol": symbol,
-            "bids": bids,
-            "asks": asks,
-            "ts": int(timezone.now().timestamp() * 1000),
-        })
+        snapshot["ts"] = int(timezone.now().timestamp() * 1000)
+        return Response(snapshot)
@@ -17,3 +17,14 @@ LEDGER_KIND_FEE = "FEE"
 CASHFLOW_TYPE_DEPOSIT = "DEPOSIT"
 CASHFLOW_TYPE_WITHDRAW = "WITHDRAW"
 CASHFLOW_STATUS_COMPLETED = "COMPLETED"
+
+CANDLE_INTERVAL_1M = "1m"
+# Interval name -> length in seconds. Everything above 1m is built from 1m.
+CANDLE_INTERVALS = {
+    CANDLE_INTERVAL_1M: 60,
+    "5m": 300,
+    "15m": 900,
+    "1h": 3600,
+    "4h": 14400,
+    "1d": 86400,
+}
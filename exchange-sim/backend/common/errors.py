@@ -12,3 +12,7 @@ class InvalidMarket(Exception):
 
 class OrderNotCancelable(Exception):
     pass
+
+
+class OrderQueueBusy(Exception):
+    """The command waited too long in the market's queue and was withdrawn unrun."""
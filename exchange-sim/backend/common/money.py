@@ -11,5 +11,120 @@ def quantize_usdt(value: Decimal) -> Decimal:
     return value.quantize(Decimal("0.000001"), rounding=ROUND_DOWN)
 
 
+def quantize_precision(value: Decimal, precision: int) -> Decimal:
+    return value.quantize(Decimal(1).scaleb(-precision), rounding=ROUND_DOWN)
+
+
 def compute_fee(cost: Decimal) -> Decimal:
     return (cost * FEE_RATE).quantize(Decimal("0.000001"), rounding=ROUND_DOWN)
+
+
+class Fixed:
+    """Exact decimal amount held as an integer count of 10**-scale units.
+
+    Addition and multiplication are exact (products carry the sum of the
+    scales); `quantize` truncates toward zero like `Decimal` ROUND_DOWN. Used on
+    the matching and settlement hot paths; convert with `to_decimal` at the
+    ORM/API boundary.
+    """
+
+    __slots__ = ("units", "scale")
+
+    def __init__(self, units: int, scale: int):
+        self.units = units
+        self.scale = scale
+
+    @classmethod
+    def from_decimal(cls, value: Decimal) -> "Fixed":
+        sign, digits, exponent = value.as_tuple()
+        units = int("".join(map(str, digits)) or "0")
+        if exponent > 0:
+            units *= 10 ** exponent
+            exponent = 0
+        return cls(-units if sign else units, -exponent)
+
+    def to_decimal(self) -> Decimal:
+        return Decimal(self.units).scaleb(-self.scale)
+
+    def rescale(self, scale: int) -> "Fixed":
+        """Same value at a scale at least as fine as the current one."""
+        if scale < self.scale:
+            raise ValueError("rescale cannot drop digits; use quantize")
+        return Fixed(self.units * 10 ** (scale - self.scale), scale)
+
+    def quantize(self, scale: int) -> "Fixed":
+        if scale >= self.scale:
+            return self.rescale(scale)
+        factor = 10 ** (self.scale - scale)
+        units = self.units // factor if self.units >= 0 else -(-self.units // factor)
+        return Fixed(units, scale)
+
+    def _aligned(self, other: "Fixed"):
+        if self.scale == other.scale:
+            return self.units, other.units, self.scale
+        scale = max(self.scale, other.scale)
+        return self.rescale(scale).units, other.rescale(scale).units, scale
+
+    def __add__(self, other: "Fixed") -> "Fixed":
+        a, b, scale = self._aligned(other)
+        return Fixed(a + b, scale)
+
+    def __sub__(self, other: "Fixed") -> "Fixed":
+        a, b, scale = self._aligned(other)
+        return Fixed(a - b, scale)
+
+    def __neg__(self) -> "Fixed":
+        return Fixed(-self.units, self.scale)
+
+    def __mul__(self, other: "Fixed") -> "Fixed":
+        return Fixed(self.units * other.units, self.scale + other.scale)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Fixed):
+            return NotImplemented
+        a, b, _ = self._aligned(other)
+        return a == b
+
+    def __lt__(self, other: "Fixed") -> bool:
+        a, b, _ = self._aligned(other)
+        return a < b
+
+    def __le__(self, other: "Fixed") -> bool:
+        a, b, _ = self._aligned(other)
+        return a <= b
+
+    def __gt__(self, other: "Fixed") -> bool:
+        a, b, _ = self._aligned(other)
+        return a > b
+
+    def __ge__(self, other: "Fixed") -> bool:
+        a, b, _ = self._aligned(other)
+        return a >= b
+
+    def __hash__(self) -> int:
+        return hash(self.to_decimal())
+
+    def __bool__(self) -> bool:
+        return self.units != 0
+
+    def __repr__(self) -> str:
+        return f"Fixed({self.to_decimal()})"
+
+
+FIXED_ZERO = Fixed(0, 0)
+FEE_RATE_FIXED = Fixed.from_decimal(FEE_RATE)
+FEE_SCALE = 6
+
+
+def to_units(value: Decimal, scale: int) -> int:
+    """Integer units of `value` at `scale`, truncating like ROUND_DOWN."""
+    return Fixed.from_decimal(value).quantize(scale).units
+
+
+def from_units(units: int, scale: int) -> Decimal:
+    return Fixed(units, scale).to_decimal()
+
+
+def compute_fee_fixed(cost: Fixed) -> Fixed:
+    """Same result as `compute_fee` on the equivalent Decimal."""
+    return (cost * FEE_RATE_FIXED).quantize(FEE_SCALE)
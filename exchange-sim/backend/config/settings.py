@@ -142,5 +142,77 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Order book depth versions and delta seqs, the market registry version and
+# the stats counters live in the cache and must be shared by every process
+# serving orders. Without REDIS_URL the cache is per process, which is only
+# correct when a single process runs the API.
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["REDIS_URL"],
+        }
+    }
+
 BINANCE_API_BASE = "https://api.binance.com"
+BINANCE_STREAM_BASE = "wss://stream.binance.com:9443"
+COINGECKO_API_BASE = "https://api.coingecko.com/api/v3"
 DAILY_CASHFLOW_LIMIT = 100_000
+
+# "sql" matches against the Order table on every request; "memory" keeps a
+# per-market price-time book in process (single writer per market only).
+MATCHING_ENGINE = os.environ.get("MATCHING_ENGINE", "sql")
+
+# Route order placement and cancels through one worker thread per market so
+# commands on a market are applied in a fixed order without lock contention.
+ORDER_SEQUENCER_ENABLED = os.environ.get("ORDER_SEQUENCER_ENABLED", "0") == "1"
+# Seconds a command may wait in the queue before it is withdrawn with a 503;
+# one that has started by then is always waited for.
+ORDER_SEQUENCER_TIMEOUT = float(os.environ.get("ORDER_SEQUENCER_TIMEOUT", "30"))
+
+# Order book depth is cached per process and kept current incrementally; this
+# forces a periodic reload from the database as a safety net.
+ORDERBOOK_DEPTH_MAX_AGE = int(os.environ.get("ORDERBOOK_DEPTH_MAX_AGE", "30"))
+
+# Write realtime events to an outbox table inside the order transaction and
+# let `manage.py relay_outbox` publish them, instead of publishing from the
+# request thread.
+REALTIME_OUTBOX_ENABLED = os.environ.get("REALTIME_OUTBOX_ENABLED", "0") == "1"
+
+# How often (seconds) each process checks the shared cache for market/asset
+# changes made elsewhere; local saves invalidate immediately via signals.
+MARKET_REGISTRY_CHECK_INTERVAL = int(os.environ.get("MARKET_REGISTRY_CHECK_INTERVAL", "5"))
+# Seconds after which a process reloads the registry regardless, to pick up
+# changes that send no signal (QuerySet.update(), raw SQL).
+MARKET_REGISTRY_MAX_AGE = int(os.environ.get("MARKET_REGISTRY_MAX_AGE", "60"))
+
+# With the memory engine, journal accepted orders and cancels under this
+# directory and snapshot each book every ORDER_BOOK_SNAPSHOT_INTERVAL entries,
+# so a restart replays the tail instead of reloading every open order.
+ORDER_BOOK_JOURNAL_DIR = os.environ.get("ORDER_BOOK_JOURNAL_DIR", "")
+ORDER_BOOK_SNAPSHOT_INTERVAL = int(os.environ.get("ORDER_BOOK_SNAPSHOT_INTERVAL", "10000"))
+# Journal segments already covered by a snapshot that are kept for replay.
+ORDER_BOOK_JOURNAL_RETAIN = int(os.environ.get("ORDER_BOOK_JOURNAL_RETAIN", "10"))
+
+# Raw trades older than this many whole UTC days are rolled into 1m candles
+# and deleted by `manage.py rollup_trades`.
+TRADE_RETENTION_DAYS = int(os.environ.get("TRADE_RETENTION_DAYS", "30"))
+
+# Minimum seconds between MarketStats writes; the rolling 24h window itself
+# is updated on every trade. Rows are written by the request that commits a
+# trade; `manage.py flush_market_stats` catches up markets left pending.
+MARKET_STATS_FLUSH_INTERVAL = float(os.environ.get("MARKET_STATS_FLUSH_INTERVAL", "1"))
+
+# Minimum seconds between in-progress candle messages per connection on the
+# kline WebSocket stream; a closing candle is always sent immediately.
+KLINE_STREAM_CONFLATE_SECONDS = float(os.environ.get("KLINE_STREAM_CONFLATE_SECONDS", "1"))
+
+# Upstream market data client: connections kept alive per host (requests wait
+# for a free one beyond this), and (connect, read) timeouts in seconds.
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get("UPSTREAM_POOL_MAXSIZE", "10"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "3.05"))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", "10"))
+
+# On a market data cache miss one caller fetches while the rest wait for its
+# result; this bounds both the wait and the shared cache lock (seconds).
+MARKET_DATA_LOCK_TIMEOUT = float(os.environ.get("MARKET_DATA_LOCK_TIMEOUT", "15"))
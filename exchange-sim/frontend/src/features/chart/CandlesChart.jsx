@@ -1,6 +1,7 @@
 import React, { useEffect, useRef, useState } from 'react';
 import { createChart, ColorType, LineStyle } from 'lightweight-charts';
 import { motion, AnimatePresence } from 'framer-motion';
+import { createKlineWS } from '../../shared/api/ws';
 
 const TIMEFRAMES = [
   { label: '1m', value: '1m' },
@@ -18,7 +19,9 @@ const DRAWING_TOOLS = [
   { id: 'fibonacci', label: 'Fibonacci', icon: '🔢' },
 ];
 
-const CandlesChart = ({ symbol = 'BTCUSDT' }) => {
+// `source="internal"` charts our own markets' candles and keeps the last one
+// live over the kline WebSocket instead of the upstream exchange's data.
+const CandlesChart = ({ symbol = 'BTCUSDT', source = 'upstream' }) => {
   const chartContainerRef = useRef(null);
   const chartRef = useRef(null);
   const candlestickSeriesRef = useRef(null);
@@ -106,7 +109,8 @@ const CandlesChart = ({ symbol = 'BTCUSDT' }) => {
     const fetchData = async () => {
       try {
         const API_BASE_URL = import.meta.env.VITE_API_BASE_URL || 'http://localhost:8000';
-        const res = await fetch(`${API_BASE_URL}/api/markets/${symbol}/candles/?interval=${interval}&limit=1000`);
+        const sourceParam = source === 'internal' ? '&source=internal' : '';
+        const res = await fetch(`${API_BASE_URL}/api/markets/${symbol}/candles/?interval=${interval}&limit=1000${sourceParam}`);
         const data = await res.json();
 
         if (!Array.isArray(data)) return;
@@ -140,7 +144,25 @@ const CandlesChart = ({ symbol = 'BTCUSDT' }) => {
     };
 
     fetchData();
-  }, [symbol, interval]);
+  }, [symbol, interval, source]);
+
+  // Live updates for internal candles
+  useEffect(() => {
+    if (source !== 'internal') return;
+    const ws = createKlineWS(symbol, interval, (k) => {
+      const time = k[0] / 1000;
+      const open = parseFloat(k[1]);
+      const close = parseFloat(k[4]);
+      candlestickSeriesRef.current?.update({ time, open, high: parseFloat(k[2]), low: parseFloat(k[3]), close });
+      volumeSeriesRef.current?.update({
+        time,
+        value: parseFloat(k[5]),
+        color: close >= open ? 'rgba(14, 203, 129, 0.5)' : 'rgba(246, 70, 93, 0.5)',
+      });
+      lineSeriesRef.current?.update({ time, value: close });
+    });
+    return () => ws.close();
+  }, [symbol, interval, source]);
 
   // Handle Mode Switch
   useEffect(() => {
@@ -1,6 +1,7 @@
 import React, { useEffect, useRef } from 'react';
 import { motion } from 'framer-motion';
 import { useAutoAnimate } from '@formkit/auto-animate/react';
+import { useTickers } from './useMarketData';
 
 const MARKETS = [
     { symbol: 'BTC/USDT', price: 43421.44, change: -1.89, volume: 24.6 },
@@ -11,8 +12,20 @@ const MARKETS = [
     { symbol: 'ADA/USDT', price: 0.647, change: 4.5, volume: 1.8 },
 ];
 
+// Live 24h ticker values over the placeholder row, once they have loaded.
+const withTicker = (market, ticker) => {
+    if (!ticker) return market;
+    return {
+        ...market,
+        price: parseFloat(ticker.lastPrice),
+        change: parseFloat(parseFloat(ticker.priceChangePercent).toFixed(2)),
+        volume: parseFloat((parseFloat(ticker.quoteVolume) / 1e9).toFixed(2)),
+    };
+};
+
 const MarketsSidebar = ({ selectedSymbol, onSelectSymbol }) => {
     const [listRef] = useAutoAnimate();
+    const tickers = useTickers();
 
     return (
         <motion.div
@@ -68,7 +81,8 @@ const MarketsSidebar = ({ selectedSymbol, onSelectSymbol }) => {
 
             {/* Markets List */}
             <div ref={listRef} className="flex-1 overflow-y-auto">
-                {MARKETS.map((market, index) => {
+                {MARKETS.map((placeholder, index) => {
+                    const market = withTicker(placeholder, tickers[placeholder.symbol.replace('/', '')]);
                     const isSelected = selectedSymbol === market.symbol.replace('/', '');
                     const isPositive = market.change >= 0;
 
@@ -1,9 +1,10 @@
 import { useState, useEffect, useRef } from 'react';
 import BinanceStream from '../../shared/api/binance.ws';
+import { getTickers } from '../../shared/api/markets.api';
+import { createOrderbookWS } from '../../shared/api/ws';
 
 export const useMarketData = (symbol = 'BTCUSDT') => {
     const [ticker, setTicker] = useState(null);
-    const [orderBook, setOrderBook] = useState({ bids: [], asks: [] });
     const [trades, setTrades] = useState([]);
 
     const streamRef = useRef(null);
@@ -31,14 +32,6 @@ export const useMarketData = (symbol = 'BTCUSDT') => {
                     volume: parseFloat(data.v),
                     quoteVolume: parseFloat(data.q),
                 });
-            } else if (data.lastUpdateId) {
-                // OrderBook (depthUpdate or snapshot)
-                // For depth20 stream, data has 'bids' and 'asks' arrays directly
-                // Stream: @depth20 returns { lastUpdateId, bids: [], asks: [] }
-                setOrderBook({
-                    bids: data.bids.map(b => [parseFloat(b[0]), parseFloat(b[1])]),
-                    asks: data.asks.map(a => [parseFloat(a[0]), parseFloat(a[1])]),
-                });
             } else if (data.e === 'aggTrade') {
                 // aggTrade
                 // p: price, q: quantity, T: timestamp, m: isBuyerMaker
@@ -61,5 +54,49 @@ export const useMarketData = (symbol = 'BTCUSDT') => {
         };
     }, [symbol]);
 
-    return { ticker, orderBook, trades };
+    return { ticker, trades };
+};
+
+// 24h tickers of every active market, keyed by symbol, from one request per refresh.
+export const useTickers = (refreshMs = 5000) => {
+    const [tickers, setTickers] = useState({});
+
+    useEffect(() => {
+        let cancelled = false;
+
+        const load = async () => {
+            try {
+                const list = await getTickers();
+                if (!cancelled) setTickers(Object.fromEntries(list.map(t => [t.symbol, t])));
+            } catch (err) {
+                console.error('Failed to fetch tickers:', err);
+            }
+        };
+
+        load();
+        const timer = setInterval(load, refreshMs);
+        return () => {
+            cancelled = true;
+            clearInterval(timer);
+        };
+    }, [refreshMs]);
+
+    return tickers;
+};
+
+// Order book of one of our markets, kept in sync from the snapshot and
+// seq-numbered deltas of the order book WebSocket.
+export const useOrderBook = (symbol) => {
+    const [orderBook, setOrderBook] = useState({ bids: [], asks: [] });
+
+    useEffect(() => {
+        setOrderBook({ bids: [], asks: [] });
+        const toNumbers = levels => levels.map(([price, qty]) => [parseFloat(price), parseFloat(qty)]);
+        const ws = createOrderbookWS(symbol, ({ bids, asks }) => {
+            setOrderBook({ bids: toNumbers(bids), asks: toNumbers(asks) });
+        });
+        return () => ws.close();
+    }, [symbol]);
+
+    return orderBook;
 };
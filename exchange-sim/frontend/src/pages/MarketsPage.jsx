@@ -1,6 +1,6 @@
 import { useEffect, useState } from 'react'
 import { Link } from 'react-router-dom'
-import { getMarkets, getTicker } from '../shared/api/markets.api'
+import { getMarkets, getTickers } from '../shared/api/markets.api'
 import { formatPrice, formatPercent } from '../shared/lib/format'
 import Header from '../shared/ui/Header'
 import ParticleBackground from '../shared/ui/ParticleBackground'
@@ -34,29 +34,34 @@ export default function MarketsPage() {
 
     async function fetchTickers(marketList) {
       const updates = {}
+      let bySymbol
+      try {
+        // One request for every market instead of one per row.
+        bySymbol = Object.fromEntries((await getTickers()).map(t => [t.symbol, t]))
+      } catch (err) {
+        console.error('Failed to fetch tickers:', err)
+        return
+      }
+      if (cancelled) return
       for (const m of marketList) {
-        try {
-          const ticker = await getTicker(m.symbol)
-          if (cancelled) return
-          const newPrice = parseFloat(ticker.price)
-          const oldPrice = tickers[m.symbol]?.price
+        const ticker = bySymbol[m.symbol]
+        if (!ticker) continue
+        const newPrice = parseFloat(ticker.lastPrice)
+        const oldPrice = tickers[m.symbol]?.price
 
-          updates[m.symbol] = {
-            price: newPrice,
-            prevPrice: oldPrice || newPrice
-          }
+        updates[m.symbol] = {
+          price: newPrice,
+          prevPrice: oldPrice || newPrice
+        }
 
-          if (oldPrice && newPrice !== oldPrice) {
-            setPriceAnimations(prev => ({ ...prev, [m.symbol]: newPrice > oldPrice ? 'up' : 'down' }))
-            setTimeout(() => {
-              setPriceAnimations(prev => ({ ...prev, [m.symbol]: null }))
-            }, 500)
-          }
-        } catch (err) {
-          console.error(`Failed to fetch ${m.symbol}:`, err)
+        if (oldPrice && newPrice !== oldPrice) {
+          setPriceAnimations(prev => ({ ...prev, [m.symbol]: newPrice > oldPrice ? 'up' : 'down' }))
+          setTimeout(() => {
+            setPriceAnimations(prev => ({ ...prev, [m.symbol]: null }))
+          }, 500)
         }
       }
-      if (!cancelled) setTickers(prev => ({ ...prev, ...updates }))
+      setTickers(prev => ({ ...prev, ...updates }))
     }
 
     loadMarkets()
@@ -1,6 +1,6 @@
 import React, { useEffect, useState } from 'react';
 import { useParams } from 'react-router-dom';
-import { useMarketData } from '../features/markets/useMarketData';
+import { useMarketData, useOrderBook } from '../features/markets/useMarketData';
 import MarketsSidebar from '../features/markets/MarketsSidebar';
 import OrderBook from '../features/orderbook/OrderBook';
 import TradeTape from '../features/trades/TradeTape';
@@ -10,7 +10,8 @@ import TradingPanel from '../features/trading/TradingPanel';
 const TradePage = () => {
   const { symbol: urlSymbol } = useParams();
   const [selectedSymbol, setSelectedSymbol] = useState(urlSymbol || 'BTCUSDT');
-  const { ticker, orderBook, trades } = useMarketData(selectedSymbol);
+  const { ticker, trades } = useMarketData(selectedSymbol);
+  const orderBook = useOrderBook(selectedSymbol);
 
   // Update title
   useEffect(() => {
@@ -104,7 +105,7 @@ const TradePage = () => {
         <div className="flex-1 flex flex-col min-w-0">
           {/* Chart Area */}
           <div className="flex-1 bg-bg-1 border-r border-border-0 relative min-h-0">
-            <CandlesChart symbol={selectedSymbol} />
+            <CandlesChart symbol={selectedSymbol} source="internal" />
           </div>
 
           {/* Bottom Section: Order Book + Trades */}
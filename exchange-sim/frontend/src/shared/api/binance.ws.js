@@ -4,7 +4,7 @@ const BINANCE_WS_BASE = 'wss://stream.binance.com:9443/ws';
 
 /**
  * Manages WebSocket connection to Binance for a specific symbol.
- * Subscribes to: miniTicker, depth20, aggTrade.
+ * Subscribes to: miniTicker, aggTrade.
  */
 class BinanceStream {
     constructor(symbol, onMessage) {
@@ -19,10 +19,9 @@ class BinanceStream {
     connect() {
         if (this.isClosed) return;
 
-        // Streams: <symbol>@miniTicker / <symbol>@depth20@100ms / <symbol>@aggTrade
+        // Streams: <symbol>@miniTicker / <symbol>@aggTrade
         const streams = [
             `${this.symbol}@miniTicker`,
-            `${this.symbol}@depth20@100ms`,
             `${this.symbol}@aggTrade`
         ].join('/');
 
@@ -8,6 +8,10 @@ export async function getTicker(symbol) {
   return apiFetch(`/api/markets/${symbol}/ticker/`)
 }
 
+export async function getTickers() {
+  return apiFetch('/api/markets/tickers/')
+}
+
 export async function getCandles(symbol, interval = '1d', limit = 365) {
   return apiFetch(`/api/markets/${symbol}/candles/?interval=${interval}&limit=${limit}`)
 }
@@ -34,3 +34,57 @@ export function createUserWS(onMessage) {
   }
   return ws
 }
+
+function applyLevels(levels, changes) {
+  for (const [price, qty] of changes) {
+    if (Number(qty) === 0) levels.delete(price)
+    else levels.set(price, qty)
+  }
+}
+
+function sortedLevels(levels, descending) {
+  const rows = [...levels.entries()]
+  rows.sort((a, b) => (descending ? Number(b[0]) - Number(a[0]) : Number(a[0]) - Number(b[0])))
+  return rows
+}
+
+// Keeps a local copy of the backend order book from a snapshot plus seq-numbered
+// deltas, and asks for a fresh snapshot whenever a delta is missed.
+export function createOrderbookWS(symbol, onBook) {
+  const bids = new Map()
+  const asks = new Map()
+  let seq = null
+
+  const emit = () => onBook({ bids: sortedLevels(bids, true), asks: sortedLevels(asks, false), seq })
+
+  const ws = createMarketWS(symbol, 'orderbook', (event, data) => {
+    if (event === 'orderbook:snapshot') {
+      bids.clear()
+      asks.clear()
+      applyLevels(bids, data.bids)
+      applyLevels(asks, data.asks)
+      seq = data.seq
+      emit()
+    } else if (event === 'orderbook:delta') {
+      if (seq === null || data.seq <= seq) return
+      if (data.seq !== seq + 1) {
+        seq = null
+        ws.send(JSON.stringify({ action: 'snapshot' }))
+        return
+      }
+      applyLevels(bids, data.bids)
+      applyLevels(asks, data.asks)
+      seq = data.seq
+      emit()
+    }
+  })
+  return ws
+}
+
+// Streams the in-progress candle of one interval from the internal candle
+// engine. `onKline` gets the Binance-layout kline array and whether it closed.
+export function createKlineWS(symbol, interval, onKline) {
+  return createMarketWS(symbol, `kline/${interval}`, (event, data) => {
+    if (event === 'kline:update') onKline(data.kline, data.closed)
+  })
+}